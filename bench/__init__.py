@@ -0,0 +1,8 @@
+"""
+Benchmarks for Sphinx VHS.
+
+These measure overhead of the extension itself, not of VHS: real VHS
+is replaced with a stand-in that writes a fake GIF after a short delay.
+Run ``python -m bench --help`` for usage.
+
+"""
@@ -0,0 +1,322 @@
+from __future__ import annotations
+
+import argparse
+import io
+import json
+import pathlib
+import pickle
+import sys
+import tempfile
+import time
+import types
+import typing as _t
+
+import sphinx.application
+import sphinx.util.docutils
+
+import sphinx_vhs
+from bench import fake_vhs, fs_ops, project
+
+# Metrics where bigger is better; all other metrics are compared as timings.
+_HIGHER_IS_BETTER = {"directive_throughput", "scheduler_efficiency"}
+
+# Metrics that aren't compared against baseline.
+_INFO = {"tapes", "docs", "renders", "edit_renders", "env_pickle_bytes"}
+
+
+class Build:
+    """
+    A single Sphinx build of a synthetic project, with timings
+    of its main phases.
+
+    """
+
+    def __init__(
+        self,
+        workdir: pathlib.Path,
+        parallel: int,
+        confoverrides: dict[str, _t.Any],
+        freshenv: bool = False,
+    ):
+        self.warnings = io.StringIO()
+        self.app = sphinx.application.Sphinx(
+            srcdir=workdir / "src",
+            confdir=workdir / "src",
+            outdir=workdir / "out",
+            doctreedir=workdir / "doctrees",
+            buildername="html",
+            parallel=parallel,
+            status=None,
+            warning=self.warnings,
+            confoverrides=confoverrides,
+            freshenv=freshenv,
+        )
+        self.marks: dict[str, float] = {}
+        self.app.connect("env-before-read-docs", lambda *_: self._mark("read"))
+        self.app.connect("env-updated", lambda *_: self._mark("render"), priority=100)
+        self.app.connect("env-updated", lambda *_: self._mark("write"), priority=900)
+
+    def _mark(self, name: str):
+        self.marks[name] = time.perf_counter()
+
+    def run(self) -> dict[str, float]:
+        started_at = time.perf_counter()
+        self.app.build()
+        finished_at = time.perf_counter()
+
+        read = self.marks.get("read", started_at)
+        render = self.marks.get("render", read)
+        write = self.marks.get("write", render)
+        return {
+            "build_time": finished_at - started_at,
+            "read_time": render - read,
+            "render_phase_time": write - render,
+        }
+
+    def report(self) -> tuple[dict[str, _t.Any], list[dict[str, _t.Any]]]:
+        path = pathlib.Path(self.app.doctreedir, "vhs_report.jsonl")
+        build, *tapes = map(json.loads, path.read_text().splitlines())
+        return build, tapes
+
+
+def run_build(
+    workdir: pathlib.Path,
+    parallel: int,
+    confoverrides: dict[str, _t.Any],
+    freshenv: bool = False,
+) -> tuple[Build, dict[str, float]]:
+    # Every build registers Sphinx's nodes and directives in docutils,
+    # they should not leak into the next build.
+    with sphinx.util.docutils.docutils_namespace():
+        build = Build(workdir, parallel, confoverrides, freshenv)
+        return build, build.run()
+
+
+def _timeit(fn: _t.Callable[[], object], repeat: int) -> float:
+    times: list[float] = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - started_at)
+    return min(times)
+
+
+def _copy_env(env: _t.Any) -> _t.Any:
+    return types.SimpleNamespace(
+        vhs_used_files=pickle.loads(pickle.dumps(env.vhs_used_files))
+    )
+
+
+def bench_env_hooks(
+    app: sphinx.application.Sphinx, spec: project.ProjectSpec, repeat: int
+) -> dict[str, float]:
+    """
+    Measure environment hooks in isolation, on a fully built environment.
+
+    """
+
+    env: _t.Any = app.env
+    docnames = [project.docname(i) for i in range(min(spec.docs, 20))]
+
+    def purge():
+        copy = _copy_env(env)
+        started_at = time.perf_counter()
+        for docname in docnames:
+            sphinx_vhs.purge_used_files(app, copy, docname)
+        return (time.perf_counter() - started_at) / len(docnames)
+
+    def merge():
+        # Simulate merging a chunk of documents from a parallel reader.
+        copy = _copy_env(env)
+        other = _copy_env(env)
+        for docname in docnames:
+            sphinx_vhs.purge_used_files(app, copy, docname)
+        started_at = time.perf_counter()
+        sphinx_vhs.merge_used_files(app, copy, docnames, other)
+        return time.perf_counter() - started_at
+
+    return {
+        "purge_time": min(purge() for _ in range(repeat)),
+        "merge_time": min(merge() for _ in range(repeat)),
+        "clear_unused_time": _timeit(
+            lambda: sphinx_vhs.clear_unused_files(env), repeat
+        ),
+        "env_pickle_bytes": len(pickle.dumps(env.vhs_used_files)),
+    }
+
+
+def bench_project(
+    spec: project.ProjectSpec,
+    workdir: pathlib.Path,
+    runner: fake_vhs.FakeVhs,
+    parallel: int,
+    render_jobs: int,
+    repeat: int,
+) -> dict[str, float]:
+    project.generate(spec, workdir / "src")
+    confoverrides = {"vhs_n_jobs": render_jobs}
+    results: dict[str, float] = {"tapes": spec.tapes, "docs": spec.docs}
+
+    # Clean build: every tape is parsed and rendered.
+    runner.calls.clear()
+    with fs_ops.count_directive_fs_ops() as ops:
+        build, timings = run_build(workdir, parallel, confoverrides)
+    results.update(timings)
+    results["fs_ops_per_directive"] = ops.per_directive
+    report, tapes = build.report()
+    results["renders"] = len(runner.calls)
+    parse_time = sum(tape["parse_time"] for tape in tapes)
+    results["directive_time"] = parse_time
+    results["directive_throughput"] = len(tapes) / parse_time if parse_time else 0
+    results["render_makespan"] = report["makespan"]
+    if report["makespan"]:
+        results["scheduler_efficiency"] = report["render_time"] / (
+            report["makespan"] * report["parallel"]
+        )
+    results.update(bench_env_hooks(build.app, spec, repeat))
+    warnings = build.warnings.getvalue()
+
+    # Fresh environment: every document is re-read, but tapes are already in cache.
+    with fs_ops.count_directive_fs_ops() as ops:
+        _, timings = run_build(workdir, parallel, confoverrides, freshenv=True)
+    results["reread_time"] = timings["read_time"]
+    results["reread_fs_ops_per_directive"] = ops.per_directive
+
+    # No-op rebuild: nothing is read or rendered.
+    _, timings = run_build(workdir, parallel, confoverrides)
+    results["noop_rebuild_time"] = timings["build_time"]
+
+    # One document changed, tapes are the same.
+    project.touch_doc(spec, workdir / "src", 0, revision=1)
+    _, timings = run_build(workdir, parallel, confoverrides)
+    results["touch_rebuild_time"] = timings["build_time"]
+
+    # One tape changed, it should be the only one re-rendered.
+    runner.calls.clear()
+    project.edit_tape(workdir / "src", 1, revision=1)
+    _, timings = run_build(workdir, parallel, confoverrides)
+    results["edit_rebuild_time"] = timings["build_time"]
+    results["edit_renders"] = len(runner.calls)
+
+    if warnings:
+        sys.stderr.write(warnings)
+    return results
+
+
+def compare(
+    results: dict[str, dict[str, float]],
+    baseline: dict[str, dict[str, float]],
+    tolerance: float,
+) -> list[str]:
+    """
+    Compare results against a baseline, return a list of regressions.
+
+    """
+
+    regressions: list[str] = []
+    for case, metrics in results.items():
+        for name, value in metrics.items():
+            base = baseline.get(case, {}).get(name)
+            if name in _INFO or not base or not value:
+                continue
+            if name in _HIGHER_IS_BETTER:
+                ratio = base / value
+            else:
+                ratio = value / base
+            if ratio > 1 + tolerance:
+                regressions.append(
+                    f"{case}: {name} regressed {ratio:.2f}x ({base:.4g} -> {value:.4g})"
+                )
+    return regressions
+
+
+def format_results(results: dict[str, dict[str, float]]) -> str:
+    cases = list(results)
+    names = list(dict.fromkeys(name for r in results.values() for name in r))
+    width = max(map(len, names))
+    lines = [" " * width + "".join(f"{case:>16}" for case in cases)]
+    for name in names:
+        values = (results[case].get(name) for case in cases)
+        lines.append(
+            name.ljust(width)
+            + "".join(f"{'-' if v is None else f'{v:.4g}':>16}" for v in values)
+        )
+    return "\n".join(lines)
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m bench",
+        description="Benchmark Sphinx VHS on synthetic projects, with fake VHS.",
+    )
+    parser.add_argument(
+        "--tapes",
+        default="100,1000",
+        help="comma-separated project sizes, in tapes (default: %(default)s)",
+    )
+    parser.add_argument("--tapes-per-doc", type=int, default=10)
+    parser.add_argument(
+        "--depth", type=int, default=5, help="length of Source include chains"
+    )
+    parser.add_argument(
+        "--delay",
+        type=float,
+        default=0.001,
+        help="fake render time per second of tape (default: %(default)s)",
+    )
+    parser.add_argument("--size", type=int, default=1024, help="fake GIF size")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Sphinx -j")
+    parser.add_argument("--render-jobs", type=int, default=4, help="vhs_n_jobs")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--workdir", type=pathlib.Path, help="keep projects here")
+    parser.add_argument("-o", "--output", type=pathlib.Path, help="save results")
+    parser.add_argument("--baseline", type=pathlib.Path, help="compare results")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="allowed slowdown relative to baseline (default: %(default)s)",
+    )
+    args = parser.parse_args(argv)
+
+    runner = fake_vhs.FakeVhs(delay=args.delay, output_size=args.size)
+    results: dict[str, dict[str, float]] = {}
+    with (
+        tempfile.TemporaryDirectory(prefix="sphinx-vhs-bench-") as tmp,
+        fake_vhs.patch_vhs(runner),
+    ):
+        root = args.workdir or pathlib.Path(tmp)
+        for tapes in map(int, args.tapes.split(",")):
+            spec = project.ProjectSpec(
+                tapes=tapes,
+                tapes_per_doc=args.tapes_per_doc,
+                include_depth=args.depth,
+            )
+            case = f"tapes={tapes}"
+            sys.stderr.write(f"running {case}...\n")
+            results[case] = bench_project(
+                spec,
+                root / case,
+                runner,
+                parallel=args.jobs,
+                render_jobs=args.render_jobs,
+                repeat=args.repeat,
+            )
+
+    sys.stdout.write(format_results(results) + "\n")
+
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2) + "\n")
+
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text())
+        if regressions := compare(results, baseline, args.tolerance):
+            sys.stdout.write("\nregressions:\n  " + "\n  ".join(regressions) + "\n")
+            return 1
+        sys.stdout.write(f"\nno regressions against {args.baseline}\n")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+import contextlib
+import pathlib
+import threading
+import time
+import typing as _t
+
+import vhs
+
+from sphinx_vhs import _estimate
+
+# Fake GIF header, padded to a fixed size.
+_GIF_HEADER = b"GIF89a"
+
+
+class FakeVhs:
+    """
+    Stand-in for `vhs.Vhs`. Instead of recording a tape, it sleeps
+    for `delay` seconds per second of tape duration, and writes a fake GIF
+    of a fixed size.
+
+    """
+
+    # Makes `_runner.get_version` fail fast and return ``"unknown"``.
+    _vhs_path = pathlib.Path("/nonexistent/vhs")
+
+    def __init__(self, delay: float = 0, output_size: int = 1024):
+        self.delay = delay
+        self.output_size = output_size
+        self.calls: list[pathlib.Path] = []
+        self._lock = threading.Lock()
+
+    def run(
+        self,
+        input_path: str | pathlib.Path,
+        output_path: str | pathlib.Path | None = None,
+        **kwargs: _t.Any,
+    ):
+        input_path = pathlib.Path(input_path)
+        with self._lock:
+            self.calls.append(input_path)
+        lines = input_path.read_text().splitlines()
+        if self.delay:
+            time.sleep(self.delay * _estimate.estimate_tape(lines).duration)
+        outputs = [output_path] if output_path is not None else []
+        # Like VHS, write every `Output` of the tape when output isn't given.
+        outputs = outputs or [
+            line.split(None, 1)[1].strip("\"'`")
+            for line in lines
+            if line.startswith("Output ")
+        ]
+        for output in outputs:
+            pathlib.Path(output).write_bytes(_GIF_HEADER.ljust(self.output_size, b"\0"))
+
+
+@contextlib.contextmanager
+def patch_vhs(runner: FakeVhs):
+    """
+    Make `vhs.resolve` return the given runner.
+
+    """
+
+    resolve = vhs.resolve
+    vhs.resolve = lambda *args, **kwargs: runner  # type: ignore
+    try:
+        yield runner
+    finally:
+        vhs.resolve = resolve
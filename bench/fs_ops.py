@@ -0,0 +1,64 @@
+from __future__ import annotations
+
+import collections
+import contextlib
+import sys
+import threading
+import typing as _t
+
+import sphinx_vhs
+
+_local = threading.local()
+_installed = False
+
+
+def _audit_hook(event: str, args: tuple[_t.Any, ...]):
+    counter: collections.Counter[str] | None = getattr(_local, "counter", None)
+    if counter is not None and (event == "open" or event.startswith("os.")):
+        counter[event] += 1
+
+
+class DirectiveFsOps:
+    """
+    Counts filesystem operations made by tape directives, using audit hooks.
+
+    Only audited operations are counted: opening, creating, renaming
+    and removing files, changing their times, listing directories, etc.
+    ``stat`` calls aren't audited, and neither are operations made
+    in forked parallel readers.
+
+    """
+
+    def __init__(self):
+        self.directives = 0
+        self.ops: collections.Counter[str] = collections.Counter()
+
+    @property
+    def per_directive(self) -> float:
+        return self.ops.total() / self.directives if self.directives else 0
+
+
+@contextlib.contextmanager
+def count_directive_fs_ops() -> _t.Iterator[DirectiveFsOps]:
+    global _installed
+    if not _installed:
+        # Audit hooks can't be removed, so we install one and keep it forever.
+        sys.addaudithook(_audit_hook)
+        _installed = True
+
+    result = DirectiveFsOps()
+    run = sphinx_vhs.VhsDirective.run
+
+    def counting_run(self: sphinx_vhs.VhsDirective):
+        _local.counter = result.ops
+        try:
+            return run(self)
+        finally:
+            _local.counter = None
+            result.directives += 1
+
+    sphinx_vhs.VhsDirective.run = counting_run
+    try:
+        yield result
+    finally:
+        sphinx_vhs.VhsDirective.run = run
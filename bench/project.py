@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+import pathlib
+import shutil
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True)
+class ProjectSpec:
+    """
+    Shape of a synthetic documentation project.
+
+    """
+
+    #: Total number of tape directives.
+    tapes: int
+
+    #: Number of tape directives per document.
+    tapes_per_doc: int = 10
+
+    #: Length of the `Source` include chain that every tape starts with.
+    include_depth: int = 5
+
+    #: Render format.
+    format: str = "gif"
+
+    @property
+    def docs(self) -> int:
+        return -(-self.tapes // self.tapes_per_doc)
+
+
+def docname(i: int) -> str:
+    return f"doc{i:05}"
+
+
+def tape(i: int) -> str:
+    # Tape durations vary from 1 to 5 seconds, so that scheduling matters.
+    return (
+        f'Source _tapes/chain0.tape\nType "echo tape {i}"\nEnter\nSleep {i % 5 + 1}s\n'
+    )
+
+
+def doc(spec: ProjectSpec, i: int, revision: int = 0) -> str:
+    first = i * spec.tapes_per_doc
+    last = min(first + spec.tapes_per_doc, spec.tapes)
+    title = f"Document {i}" + (f" (revision {revision})" if revision else "")
+    text = f"{title}\n{'=' * len(title)}\n\n"
+    for j in range(first, last):
+        if j % 2:
+            text += f".. vhs:: _tapes/tape{j}.tape\n   :alt: tape {j}\n\n"
+        else:
+            body = "\n".join(f"   {line}" for line in tape(j).splitlines())
+            text += f".. vhs-inline::\n   :alt: tape {j}\n\n{body}\n\n"
+    return text
+
+
+def generate(spec: ProjectSpec, srcdir: pathlib.Path):
+    """
+    Generate a project with the given shape in `srcdir`, removing
+    any existing contents.
+
+    Half of tapes are inline, and half are in separate files. Every tape
+    sources a shared chain of `include_depth` tapes, and every document
+    has `tapes_per_doc` tapes.
+
+    """
+
+    shutil.rmtree(srcdir, ignore_errors=True)
+    tapes_dir = srcdir / "_tapes"
+    tapes_dir.mkdir(parents=True)
+
+    (srcdir / "conf.py").write_text(
+        f'extensions = ["sphinx_vhs"]\nvhs_format = "{spec.format}"\n'
+    )
+
+    for depth in range(spec.include_depth):
+        text = f"Set FontSize {12 + depth}\n"
+        if depth + 1 < spec.include_depth:
+            text += f"Source _tapes/chain{depth + 1}.tape\n"
+        (tapes_dir / f"chain{depth}.tape").write_text(text)
+    if not spec.include_depth:
+        (tapes_dir / "chain0.tape").write_text("")
+
+    for j in range(1, spec.tapes, 2):
+        (tapes_dir / f"tape{j}.tape").write_text(tape(j))
+
+    for i in range(spec.docs):
+        (srcdir / f"{docname(i)}.rst").write_text(doc(spec, i))
+
+    toctree = "".join(f"   {docname(i)}\n" for i in range(spec.docs))
+    (srcdir / "index.rst").write_text(
+        f"Benchmark\n=========\n\n.. toctree::\n   :maxdepth: 1\n\n{toctree}"
+    )
+
+
+def touch_doc(spec: ProjectSpec, srcdir: pathlib.Path, i: int, revision: int):
+    """
+    Change text of a document without changing its tapes.
+
+    """
+
+    (srcdir / f"{docname(i)}.rst").write_text(doc(spec, i, revision))
+
+
+def edit_tape(srcdir: pathlib.Path, j: int, revision: int):
+    """
+    Change contents of a tape file, forcing it to be re-rendered.
+
+    """
+
+    assert j % 2, "only odd tapes are stored in files"
+    (srcdir / "_tapes" / f"tape{j}.tape").write_text(
+        tape(j) + f'Type "revision {revision}"\n'
+    )
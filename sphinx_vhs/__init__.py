@@ -1,24 +1,21 @@
 from __future__ import annotations
 
-import base64
 import collections
-import hashlib
 import os
 import pathlib
-import re
 import shutil
+import sys
+import threading
+import time
 import typing as _t
 import urllib.parse
-from dataclasses import dataclass
-from datetime import datetime, timedelta
-from multiprocessing.pool import ThreadPool
+from datetime import timedelta
 
 import docutils.nodes
 import docutils.statemachine
 import sphinx.application
 import sphinx.config
 import sphinx.environment
-import sphinx.errors
 import sphinx.util.parallel
 import sphinx.writers
 import sphinx.writers.html
@@ -27,87 +24,227 @@ from docutils.parsers.rst import directives
 from docutils.parsers.rst.directives.images import Figure
 from sphinx.transforms import SphinxTransform
 from sphinx.util import logging
-from sphinx.util.console import colorize, term_width_line
+from sphinx.util.console import colorize
 from sphinx.util.docutils import SphinxDirective
 
+from sphinx_vhs import (
+    _backend,
+    _cache,
+    _estimate,
+    _optimize,
+    _poster,
+    _preview,
+    _publish,
+    _render,
+    _runner,
+    _shard,
+    _tape,
+    _telemetry,
+)
+from sphinx_vhs._data import UsedFiles, VhsData
 from sphinx_vhs._version import *  # noqa: F403
 
 vhs._logger = _logger = logging.getLogger("sphinx-vhs")
 
 
-@dataclass(unsafe_hash=True)
-class VhsData:
-    docname: str
-    lineno: int
-    tape_hash: str
-    tape_file: pathlib.Path
-    render_file: pathlib.Path
-    gif_file: pathlib.Path
-    origname: str
+def _get_storage(env: sphinx.environment.BuildEnvironment) -> UsedFiles:
+    used_files = getattr(env, "vhs_used_files", None)
+    if not isinstance(used_files, UsedFiles):
+        used_files = UsedFiles()
+        setattr(env, "vhs_used_files", used_files)
+    return used_files
 
 
 def _get_used_files(
     env: sphinx.environment.BuildEnvironment,
-) -> _t.Dict[str, list[VhsData]]:
-    res = collections.defaultdict(list)
-    for f in getattr(env, "vhs_used_files", set()):
-        res[f.tape_hash].append(f)
-    return dict(res)
+) -> _t.Mapping[str, _t.Sequence[VhsData]]:
+    return _get_storage(env).by_hash
+
+
+def get_include_graph(
+    env: sphinx.environment.BuildEnvironment,
+) -> dict[str, dict[str, set[str]]]:
+    """
+    Build a reverse include index: for every tape file, hashes of tapes
+    that read it, either directly or via ``Source``, and for every such hash,
+    documents that use it.
+
+    Paths are relative to the source directory.
+
+    """
+
+    graph: dict[str, dict[str, set[str]]] = collections.defaultdict(
+        lambda: collections.defaultdict(set)
+    )
+    for f in _get_storage(env):
+        for path in f.includes:
+            graph[path][f.tape_hash].add(f.docname)
+    return {path: dict(hashes) for path, hashes in graph.items()}
+
+
+def get_include_dependents(
+    env: sphinx.environment.BuildEnvironment, path: str | pathlib.Path
+) -> set[str]:
+    """
+    Get documents that use the given tape file, either directly
+    or via ``Source``. These documents are re-read when the file changes.
+
+    """
+
+    path = pathlib.Path(env.srcdir, path).resolve()
+    key = path.relative_to(env.srcdir, walk_up=True).as_posix()
+    return {
+        docname
+        for docnames in get_include_graph(env).get(key, {}).values()
+        for docname in docnames
+    }
+
+
+_FORMATS = ["gif", "svg", "webm", "mp4"]
+_VIDEO_FORMATS = ["webm", "mp4"]
+_AUTOPLAY = ["on", "off", "visible"]
+_MIMETYPES = {
+    "gif": "image/gif",
+    "svg": "image/svg+xml",
+    "webm": "video/webm",
+    "mp4": "video/mp4",
+}
+
+
+def _format_list(argument: str) -> str:
+    formats = [directives.choice(x.strip(), _FORMATS) for x in argument.split(",")]
+    return ",".join(dict.fromkeys(formats))
 
 
 class VhsDirective(SphinxDirective, Figure):
     option_spec = {
         **Figure.option_spec,  # type: ignore
-        "format": lambda x: directives.choice(x, ["gif", "svg", "webm", "mp4"]),
+        "format": _format_list,
+        "poster": lambda x: directives.choice(x, ["first", "last", "none"]),
+        "preload": lambda x: directives.choice(x, ["none", "metadata", "auto"]),
+        "autoplay": lambda x: directives.choice(x, _AUTOPLAY),
     }
 
     def run(self):
-        lines = self._get_tape_contents_inlined()
+        started_at = time.monotonic()
+        lines, includes = self._get_tape_contents_inlined()
+        # Tape is rendered as written, but cosmetic changes don't change its hash.
         tape = "\n".join(lines)
 
         filename = "vhs-" + (self._get_gif_filename() or "inline")
-        tape_hash = base64.urlsafe_b64encode(
-            hashlib.sha256(tape.encode()).digest()
-        ).decode()
-        dest_dir = pathlib.Path(
-            self.env.app.builder.doctreedir,
-            "vhs_tapes_cache",
-            tape_hash,
-        )
-        dest_dir.mkdir(parents=True, exist_ok=True)
-        dest_tape = dest_dir / ("vhs.tape")
+        tape_hash = _tape.get_hash(lines)
         format = self.options.get("format") or self.env.config["vhs_format"] or "gif"
-        dest_render = dest_dir / (f"vhs.{format}")
-        dest_file = dest_dir / (filename + f".{format}")
-
-        with dest_tape.open("w") as file:
-            file.write(tape)
-
-        if not hasattr(self.env, "vhs_used_files"):
-            setattr(self.env, "vhs_used_files", set())
-        getattr(self.env, "vhs_used_files").add(
-            VhsData(
-                docname=self.env.docname,
-                lineno=self.lineno,
-                tape_hash=tape_hash,
-                tape_file=dest_tape,
-                render_file=dest_render,
-                gif_file=dest_file,
-                origname=(
-                    self.env.relfn2path(self.arguments[0])[0]
-                    if self.arguments
-                    else "<inline>"
-                ),
-            )
+        if not isinstance(format, str):
+            format = ",".join(dict.fromkeys(format)) or "gif"
+
+        poster = self.options.get("poster") or self.env.config["vhs_poster"] or ""
+        if poster == "none":
+            poster = ""
+        # Resolved value is passed to `ProcessVhsNodes` via image node attributes.
+        self.options["poster"] = poster
+
+        estimate = _estimate.estimate_tape(lines)
+        for f in format.split(","):
+            self._check_estimate(estimate, f)
+
+        # Strings that repeat between records are interned,
+        # so that pickle stores them only once.
+        data = VhsData(
+            docname=self.env.docname,
+            lineno=self.lineno,
+            tape_hash=tape_hash,
+            format=sys.intern(format),
+            filename=sys.intern(filename),
+            origname=(
+                self.env.relfn2path(self.arguments[0])[0]
+                if self.arguments
+                else "<inline>"
+            ),
+            cache_dir=sys.intern(str(_cache.get_cache_dir(self.env))),
+            links_dir=sys.intern(str(_cache.get_links_dir(self.env))),
+            estimated_render_time=estimate.render_time,
+            estimated_size=sum(map(estimate.output_bytes, format.split(","))),
+            includes=tuple(map(sys.intern, includes)),
+            poster=sys.intern(poster),
         )
 
+        # Tape directories are content-addressed, so existing tapes are up to date.
+        # Link directories are created later, when renders are linked.
+        _cache.write_once(data.tape_file, tape)
+
+        data.parse_time = time.monotonic() - started_at
+        self._explain_change(data, lines)
+        _get_storage(self.env).add(data)
+        # Picked up by `submit_new_files` once the document is read.
+        if "vhs_new_files" not in self.env.temp_data:
+            self.env.temp_data["vhs_new_files"] = []
+        self.env.temp_data["vhs_new_files"].append(data)
+
         # We have to use data uri to obscure the fact that the image
         # is generated later. If we were to use `dest_file` directly,
         # HTML builder would complain that image doesn't exist.
-        # We substitute actual URI in `ProcessVhsNodes`.
-        self.arguments = [f"data:vhs-tape;{dest_file}"]
+        # We substitute actual URIs in `ProcessVhsNodes`.
+        self.arguments = [f"data:vhs-tape;{data.format};{data.link_base}"]
         return super().run()
 
+    def _explain_change(self, data: VhsData, lines: list[str]):
+        # Find this directive in the document's previous version: it's the n-th
+        # directive with the same file name.
+        purged: dict[str, list[VhsData]] = (
+            getattr(self.env, "vhs_purged_files", None) or {}
+        )
+        n = sum(
+            entry.filename == data.filename
+            for entry in _get_storage(self.env).get_docname(data.docname)
+        )
+        previous = [
+            entry
+            for entry in purged.get(data.docname, ())
+            if entry.filename == data.filename
+        ]
+        if n >= len(previous) or previous[n].tape_hash == data.tape_hash:
+            return
+        try:
+            old_lines = previous[n].tape_file.read_text().splitlines()
+        except OSError:
+            return
+        changes = _tape.diff(old_lines, lines)
+        _logger.verbose(
+            "tape changed and will be re-rendered:\n%s",
+            "\n".join(changes) if changes else "  (only cache format changed)",
+            location=(data.docname, data.lineno),
+            type="vhs",
+        )
+
+    def _check_estimate(self, estimate: _estimate.TapeEstimate, format: str):
+        max_seconds = self.env.config["vhs_max_tape_seconds"]
+        if max_seconds is not None and estimate.render_time > max_seconds:
+            _logger.warning(
+                "tape is estimated to render for %s, which is longer than "
+                "vhs_max_tape_seconds (%s)",
+                _render.format_duration(estimate.render_time),
+                _render.format_duration(max_seconds),
+                location=(self.env.docname, self.lineno),
+                type="vhs",
+                subtype="estimate",
+            )
+        max_bytes = self.env.config["vhs_max_output_bytes"]
+        size = estimate.output_bytes(format)
+        if max_bytes is not None and size > max_bytes:
+            _logger.warning(
+                "%s is estimated to be %s (%sx%s, %s frames), which is bigger than "
+                "vhs_max_output_bytes (%s)",
+                format,
+                _estimate.format_size(size),
+                estimate.width,
+                estimate.height,
+                estimate.frames,
+                _estimate.format_size(max_bytes),
+                location=(self.env.docname, self.lineno),
+                type="vhs",
+                subtype="estimate",
+            )
+
     def _get_gif_filename(self) -> str | None:
         name = pathlib.Path(self.arguments[0]).name
         if name.endswith(".tape"):
@@ -119,64 +256,61 @@ class VhsDirective(SphinxDirective, Figure):
 
     def _get_tape_contents(
         self, path: _t.Optional[pathlib.Path] = None
-    ) -> tuple[list[str], pathlib.Path | str]:
+    ) -> tuple[_tape.Tape, pathlib.Path | str]:
         if path is None:
             relpath, abspath = self.env.relfn2path(self.arguments[0])
             path = pathlib.Path(abspath)
         else:
             path = path.expanduser().resolve()
             relpath = path.relative_to(self.env.srcdir, walk_up=True)
+        # Every file in an include chain is a dependency of the current document,
+        # including files that don't exist yet.
         self.env.note_dependency(path)
-        if not path.exists():
+        try:
+            tape = _tape.parse_file(path)
+        except FileNotFoundError:
             _logger.error("Path %s does not exist", path, type="vhs")
-            return [], relpath
-        elif not path.is_file():
+            return _tape.Tape(()), relpath
+        except IsADirectoryError:
             _logger.error("Path %s is not a file", path, type="vhs")
-            return [], relpath
-        else:
-            try:
-                with path.open() as file:
-                    lines = file.read().splitlines()
-                    self.state.document.settings.record_dependencies.add(str(path))
-            except Exception as e:
-                raise self.error(str(e))
+            return _tape.Tape(()), relpath
+        except Exception as e:
+            raise self.error(str(e))
+        self.state.document.settings.record_dependencies.add(str(path))
 
-        return lines, relpath
+        return tape, relpath
 
-    def _get_tape_contents_inlined(self):
+    def _get_tape_contents_inlined(self) -> tuple[list[str], list[str]]:
         seen: list[pathlib.Path] = []
         imports: list[tuple[str, str, int]] = []
+        flatten_lines: list[str] = []
+        includes: list[str] = []
+
+        cwd = pathlib.Path(self.env.config["vhs_cwd"] or self.env.srcdir)
+
+        def inline(tape: _tape.Tape, path: pathlib.Path | str):
+            if path != "<inline>":
+                includes.append(pathlib.Path(path).as_posix())
+            for node in tape.nodes:
+                if isinstance(node, _tape.Command):
+                    flatten_lines.append(node.text)
+                    continue
+                next_path = (cwd / node.path).expanduser().resolve()
+                if next_path in seen:
+                    include_chain = "\n  -> ".join(
+                        f"{orig}:{ln + 1}: {what}" for (orig, what, ln) in imports
+                    )
+                    raise self.error(
+                        f"Circular include detected in this tape:\n  -> {include_chain}\n"
+                    )
+                seen.append(next_path)
+                imports.append((str(path), node.text, node.lineno))
+                inline(*self._get_tape_contents(next_path))
+                seen.pop()
+                imports.pop()
 
-        cwd = pathlib.Path(self.env.app.config["vhs_cwd"] or self.env.srcdir)
-
-        def inline(lines: list[str], path: pathlib.Path | str):
-            flatten_lines = []
-            for i, line in enumerate(lines):
-                if match := re.match(
-                    r"^\s*Source\s+['\"`]?(?P<path>.*?)['\"`]?\s*$", line, re.IGNORECASE
-                ):
-                    next_path = (cwd / match.group("path")).expanduser().resolve()
-                    if next_path in seen:
-                        include_chain = "\n  -> ".join(
-                            f"{orig}:{ln + 1}: {what}" for (orig, what, ln) in imports
-                        )
-                        raise self.error(
-                            f"Circular include detected in this tape:\n  -> {include_chain}\n"
-                        )
-                    seen.append(next_path)
-                    imports.append((str(path), match.group(), i))
-                    self.env.note_dependency(path)
-                    flatten_lines.extend(inline(*self._get_tape_contents(next_path)))
-                    seen.pop()
-                    imports.pop()
-                elif match := re.match(r'^((["\'`]).*?\2|[^"\'`#])*', line):
-                    line = match.group().strip()
-                    if line:
-                        flatten_lines.append(match.group().strip())
-
-            return flatten_lines
-
-        return inline(*self._get_tape_contents())
+        inline(*self._get_tape_contents())
+        return flatten_lines, includes
 
 
 class InlineVhsDirective(VhsDirective):
@@ -188,14 +322,14 @@ class InlineVhsDirective(VhsDirective):
 
     def _get_tape_contents(
         self, path: _t.Optional[pathlib.Path] = None
-    ) -> tuple[list[str], pathlib.Path | str]:
+    ) -> tuple[_tape.Tape, pathlib.Path | str]:
         if path:
             return super()._get_tape_contents(path)
 
         self.assert_has_content()
-        lines: list[str] = list(self.content)
+        tape = _tape.parse(self.content)
         self.content = docutils.statemachine.StringList()
-        return lines, "<inline>"
+        return tape, "<inline>"
 
 
 class ProgressReporter(vhs.DefaultProgressReporter):
@@ -233,20 +367,200 @@ class ProgressReporter(vhs.DefaultProgressReporter):
 
 def clear_unused_files(
     env: sphinx.environment.BuildEnvironment,
+    rendered: _t.Collection[str] = (),
 ):
-    dest_dir = pathlib.Path(env.app.builder.doctreedir, "vhs_tapes_cache")
-    dest_dir.mkdir(parents=True, exist_ok=True)
+    cache_dir = _cache.get_cache_dir(env)
+    cache_dir.mkdir(parents=True, exist_ok=True)
     used_files = _get_used_files(env)
 
     _logger.debug("cleaning up old VHS files...", type="vhs")
-    for dir in dest_dir.glob("*"):
-        if dir.name not in used_files:
-            modified = datetime.fromtimestamp(dir.stat().st_mtime)
-            if datetime.now() - modified > env.config["vhs_cleanup_delay"]:
+    index = _cache.CacheIndex.load(cache_dir)
+    now = time.time()
+    max_age: timedelta | None = env.config["vhs_cleanup_delay"]
+    for tape_hash in used_files:
+        # Only new and re-rendered entries, and entries that weren't marked
+        # for a while, are updated.
+        changed = tape_hash in rendered
+        if changed or not index.is_marked(tape_hash, now, max_age):
+            _cache.touch(cache_dir / tape_hash)
+            index.mark_used(tape_hash, now, changed=changed)
+    _cache.collect_garbage(
+        index,
+        pinned=used_files,
+        max_age=max_age,
+        max_size=env.config["vhs_cache_max_size"],
+    )
+    index.save()
+
+    if _cache.is_shared(env):
+        # Links are cheap to re-create, there's no need to keep them around.
+        links_dir = _cache.get_links_dir(env)
+        links_dir.mkdir(parents=True, exist_ok=True)
+        for dir in links_dir.glob("*"):
+            if dir.name not in used_files:
                 _logger.debug("removing %s", dir, type="vhs")
                 shutil.rmtree(dir)
 
 
+# Clean up cache in background, while Sphinx is writing output. If Sphinx forks
+# parallel writers, clean-up waits until the build is finished instead;
+# see `_forks_readers`.
+def start_garbage_collection(
+    app: sphinx.application.Sphinx,
+    env: sphinx.environment.BuildEnvironment,
+    rendered: _t.Collection[str] = (),
+):
+    errors: list[Exception] = []
+
+    def run():
+        try:
+            clear_unused_files(env, rendered)
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run, name="sphinx-vhs-gc", daemon=True)
+    if not _forks_readers(app):
+        thread.start()
+    setattr(app, "vhs_gc", (thread, errors))
+
+
+def finish_garbage_collection(
+    app: sphinx.application.Sphinx, exception: BaseException | None
+):
+    if (gc := getattr(app, "vhs_gc", None)) is not None:
+        thread, errors = gc
+        if thread.ident is None:
+            thread.start()
+        thread.join()
+        setattr(app, "vhs_gc", None)
+        # Report errors from the main thread, so that `-W` works as expected.
+        for e in errors:
+            _logger.warning(
+                "failed to clean up VHS cache: %s", e, type="vhs", subtype="cache"
+            )
+
+
+def _find_vhs(
+    app: sphinx.application.Sphinx, environ: dict[str, str], install: bool
+) -> vhs.Vhs:
+    return vhs.resolve(
+        min_version=app.config["vhs_min_version"],
+        max_version=app.config["vhs_max_version"],
+        cwd=app.config["vhs_cwd"] or app.srcdir,
+        reporter=ProgressReporter(app.verbosity),
+        install=install,
+        cache_path=app.config["vhs_auto_install_location"],
+        env=environ,
+        repo=app.config["vhs_repo"],
+    )
+
+
+def _resolve_runner(app: sphinx.application.Sphinx) -> vhs.Vhs:
+    environ = _render.get_environ()
+    return _runner.resolve(
+        app,
+        lambda: _find_vhs(app, environ, app.config["vhs_auto_install"]),
+        environ,
+    )
+
+
+def _get_backend_url(app: sphinx.application.Sphinx) -> str | None:
+    return app.config["vhs_backend"] or os.environ.get("SPHINX_VHS_BACKEND")
+
+
+def _resolve_backend(app: sphinx.application.Sphinx) -> _backend.Backend:
+    if url := _get_backend_url(app):
+        token = app.config["vhs_backend_token"] or os.environ.get(_backend.TOKEN_ENV)
+        return _backend.RemoteBackend(url, token)
+    return _backend.LocalBackend(_resolve_runner(app))
+
+
+# Find version of VHS without installing it, see `_render.RenderQueue.render_key`.
+def _probe_version(app: sphinx.application.Sphinx) -> str | None:
+    try:
+        if _get_backend_url(app):
+            backend = _resolve_backend(app)
+        else:
+            runner = _find_vhs(app, _render.get_environ(), install=False)
+            backend = _backend.LocalBackend(runner)
+        try:
+            return backend.get_version()
+        finally:
+            backend.close()
+    except vhs.VhsError:
+        _logger.debug("VHS not found", exc_info=True, type="vhs")
+        return None
+
+
+def _get_render_queue(app: sphinx.application.Sphinx) -> _render.RenderQueue:
+    if getattr(app, "vhs_render_queue", None) is None:
+        cached = None
+        if not _get_backend_url(app):
+            cached = _runner.get_cached(app, _render.get_environ())
+        queue = _render.RenderQueue(
+            app, lambda: _resolve_backend(app), cached, lambda: _probe_version(app)
+        )
+        setattr(app, "vhs_render_queue", queue)
+    return getattr(app, "vhs_render_queue")
+
+
+# Create render queue before Sphinx forks parallel readers, so that they know
+# they're not allowed to submit jobs. If previous build had tapes, start resolving
+# VHS right away, so that it doesn't delay rendering. Otherwise, VHS is resolved
+# once the first tape is read. If documents are read in parallel, VHS is resolved
+# once all of them are read; see `_forks_readers`.
+def init_render_queue(app: sphinx.application.Sphinx):
+    queue = _get_render_queue(app)
+    if len(_get_storage(app.env)) and not _forks_readers(app):
+        queue.start_resolve()
+
+
+def close_render_queue(app: sphinx.application.Sphinx, exception: BaseException | None):
+    if (queue := getattr(app, "vhs_render_queue", None)) is not None:
+        queue.close()
+        setattr(app, "vhs_render_queue", None)
+
+
+def _forks_readers(app: sphinx.application.Sphinx) -> bool:
+    # Parallel readers and writers are forked from the main process. Forking while
+    # our threads run can deadlock a child on a lock that one of them held, so no
+    # threads run while Sphinx reads or writes documents in parallel.
+    return sphinx.util.parallel.parallel_available and app.parallel > 1
+
+
+def _is_pipelined(app: sphinx.application.Sphinx) -> bool:
+    # Preview and sharded builds decide what to render once all documents are read.
+    return (
+        app.config["vhs_pipeline"]
+        and not app.config["vhs_preview"]
+        and _shard.get_shard(app) is None
+        and not _forks_readers(app)
+    )
+
+
+def _needs_render(queue: _render.RenderQueue, new_files: _t.Iterable[VhsData]) -> bool:
+    used_files: dict[str, list[VhsData]] = {}
+    for data in new_files:
+        used_files.setdefault(data.tape_hash, []).append(data)
+    return not _render.is_cached(used_files, queue.render_key)
+
+
+# In pipelined mode, start rendering tapes as soon as a document is read.
+# Dry runs never resolve VHS, as that can install it.
+def submit_new_files(app: sphinx.application.Sphinx, doctree: docutils.nodes.document):
+    new_files: list[VhsData] = app.env.temp_data.pop("vhs_new_files", None) or []
+    queue: _render.RenderQueue | None = getattr(app, "vhs_render_queue", None)
+    if queue is not None and queue.is_owner and new_files:
+        if not getattr(app, "vhs_dry_run", False) and _needs_render(queue, new_files):
+            queue.start_resolve()
+        if _is_pipelined(app):
+            by_hash: dict[str, list[VhsData]] = {}
+            for data in new_files:
+                by_hash.setdefault(data.tape_hash, []).append(data)
+            for entries in by_hash.values():
+                queue.submit(_render.merge_formats(entries))
+
+
 # Merge `vhs_used_files` from one environment into another.
 def merge_used_files(
     app: sphinx.application.Sphinx,
@@ -254,9 +568,9 @@ def merge_used_files(
     docnames: _t.List[str],
     other: sphinx.environment.BuildEnvironment,
 ):
-    if not hasattr(env, "vhs_used_files"):
-        setattr(env, "vhs_used_files", set())
-    getattr(env, "vhs_used_files").update(getattr(other, "vhs_used_files", set()))
+    # This only runs with parallel readers, so VHS is not resolved here;
+    # see `_forks_readers`.
+    _get_storage(env).merge(_get_storage(other), docnames)
 
 
 # Drop `vhs_used_files` entries from an env. This runs when sphinx is going
@@ -266,133 +580,148 @@ def purge_used_files(
     env: sphinx.environment.BuildEnvironment,
     docname: str,
 ):
-    if hasattr(env, "vhs_used_files"):
-        vhs_used_files = {
-            used_files
-            for used_files in getattr(env, "vhs_used_files")
-            if used_files.docname != docname
-        }
-        setattr(env, "vhs_used_files", vhs_used_files)
+    storage = _get_storage(env)
+    # Kept until documents are re-read, to explain why their tapes changed.
+    if entries := storage.get_docname(docname):
+        if getattr(env, "vhs_purged_files", None) is None:
+            setattr(env, "vhs_purged_files", {})
+        getattr(env, "vhs_purged_files")[docname] = list(entries)
+    storage.purge(docname)
+
+
+def _report_estimates(used_files: UsedFiles):
+    for docname, instances in sorted(used_files.by_docname.items()):
+        entries = {(entry.tape_hash, entry.format): entry for entry in instances}
+        _logger.verbose(
+            "%s: %s tapes, estimated render time %s, estimated size %s",
+            docname,
+            len(entries),
+            _render.format_duration(
+                sum(entry.estimated_render_time for entry in entries.values())
+            ),
+            _estimate.format_size(
+                sum(entry.estimated_size for entry in entries.values())
+            ),
+            type="vhs",
+        )
+
+
+def _link_render(source: pathlib.Path, dest: pathlib.Path):
+    try:
+        linked = pathlib.Path(os.readlink(dest)) == source
+    except FileNotFoundError:
+        linked = None
+    except OSError:
+        # Not a symlink, so it's a copy.
+        linked = dest.stat().st_size == source.stat().st_size
+    if linked:
+        _logger.debug("already linked: %s -> %s", source, dest)
+        return
+    if linked is not None:
+        dest.unlink()
+    _logger.debug("make link: %s -> %s", source, dest)
+    try:
+        dest.symlink_to(source)
+    except NotImplementedError:
+        shutil.copyfile(source, dest)
 
 
 # Actually runs VHS
 def generate_vhs(
     app: sphinx.application.Sphinx, env: sphinx.environment.BuildEnvironment
 ):
-    # Another clean-up run after re-reading docs and updating a list of used gifs.
-    clear_unused_files(env)
+    setattr(env, "vhs_purged_files", None)
+    if getattr(app, "vhs_dry_run", False):
+        # `python -m sphinx_vhs plan` only lists tapes, see `_cli`.
+        return
 
     used_files = _get_used_files(env)
+    if not used_files:
+        start_garbage_collection(app, env)
+        return
+
+    if app.verbosity:
+        _report_estimates(_get_storage(env))
+
+    queue = _get_render_queue(app)
+    if app.config["vhs_require_cache"]:
+        _shard.check_missing(used_files, queue.render_key)
+
+    # Sharded builds only render their part of tapes, see `_shard.partition`.
+    used_files = _shard.select(app, used_files)
+
+    # VHS is only resolved if something needs rendering, so that builds
+    # that use cached renders don't need it. Once resolved, renders are checked
+    # against its actual version.
+    if not queue.is_resolved and not _render.is_cached(used_files, queue.render_key):
+        queue.resolve()
+
+    all_used_files = used_files
+    if app.config["vhs_preview"]:
+        # Pending tapes get placeholders, and are rendered after the build.
+        pending = _preview.prepare(app, used_files, queue.render_key)
+        used_files = {
+            tape_hash: entries
+            for tape_hash, entries in used_files.items()
+            if tape_hash not in pending
+        }
+        setattr(
+            app,
+            "vhs_preview_pending",
+            [data for tape_hash in pending for data in all_used_files[tape_hash]],
+        )
+        setattr(
+            env,
+            "vhs_preview_docnames",
+            {data.docname for data in getattr(app, "vhs_preview_pending")},
+        )
 
-    outdated_files = [
-        entry
-        for entries in used_files.values()
-        for entry in entries
-        if not entry.render_file.exists()
-    ]
-
-    to_render = {
-        (entry.tape_file, entry.render_file): entry for entry in outdated_files
-    }
+    # Fresh renders are recorded as cache hits, the rest are rendered.
+    for entries in used_files.values():
+        queue.submit(_render.merge_formats(entries))
 
-    if to_render:
-        environ = os.environ.copy()
-        if "READTHEDOCS" in environ:
-            environ["VHS_NO_SANDBOX"] = "true"
-        try:
-            runner = vhs.resolve(
-                min_version=app.config["vhs_min_version"],
-                max_version=app.config["vhs_max_version"],
-                cwd=app.config["vhs_cwd"] or env.srcdir,
-                reporter=ProgressReporter(app.verbosity),
-                install=app.config["vhs_auto_install"],
-                cache_path=app.config["vhs_auto_install_location"],
-                env=environ,
-                repo=app.config["vhs_repo"],
-            )
-        except vhs.VhsError as e:
-            raise sphinx.errors.ExtensionError(str(e)) from e
+    queue.join()
+    queue.shutdown()
 
-        in_progress = collections.Counter(p.origname for p in to_render.values())
+    if _cache.is_shared(env):
+        links_dir = _cache.get_links_dir(env)
+        for tape_hash in used_files:
+            (links_dir / tape_hash).mkdir(parents=True, exist_ok=True)
 
-        def on_tape_done(origname: str | None):
-            if app.verbosity:
-                return
+    optimized: dict[tuple[str, str], _optimize.OptimizeStats] = {}
+    if app.config["vhs_optimize"]:
+        optimized = _optimize.optimize_all(app, used_files, queue.render_key)
 
-            if origname:
-                orignames_left = in_progress[origname] - 1
-                if orignames_left > 0:
-                    in_progress[origname] = orignames_left
-                else:
-                    in_progress.pop(origname, None)
-
-            total = len(to_render)
-            left = in_progress.total()
-            done = total - left
-            tape = f" {sorted(in_progress)[0]}" if in_progress else ""
-            if left > 1:
-                tape += f" +{left - 1} more"
-            _logger.info(
-                term_width_line(
-                    f"{colorize('bold', 'rendering terminal GIFs...')} [{done}/{total}]{colorize('teal', tape)}"
-                ),
-                nonl=True,
-            )
-
-        if "READTHEDOCS" in environ:
-            parallel = app.config["vhs_n_jobs_read_the_docs"] or app.parallel or 1
-        else:
-            parallel = app.config["vhs_n_jobs"] or app.parallel or 1
-
-        if sphinx.util.parallel.parallel_available and parallel <= 1:
-            _logger.info(
-                colorize(
-                    "yellow",
-                    "rendering terminal GIFs in sequence; pass -j auto to enable parallel run",
-                ),
-                type="vhs",
-            )
-        else:
-            _logger.info(
-                "rendering terminal GIFs: %s files, parallel=%s",
-                len(to_render),
-                parallel,
-                type="vhs",
-            )
-            on_tape_done(None)
-
-        def worker(arg: VhsData):
-            _logger.debug("rendering %s", arg.tape_file, type="vhs")
-            try:
-                runner.run(arg.tape_file, arg.render_file)
-            except vhs.VhsError as e:
-                path = env.doc2path(arg.docname)
-                raise sphinx.errors.ExtensionError(
-                    f"at {path}:{arg.lineno}:\n{e}"
-                ) from e
-            on_tape_done(arg.origname)
-
-        with ThreadPool(parallel) as tasks:
-            for _ in tasks.imap_unordered(worker, to_render.values()):
-                pass
-
-        if not app.verbosity:
-            _logger.info("")
+    posters = _poster.make_posters(app, used_files, queue.path, queue.render_key)
 
+    link_times: dict[VhsData, float] = {}
     for instances in used_files.values():
         for data in instances:
-            if data.render_file != data.gif_file and not data.gif_file.exists(
-                follow_symlinks=False
-            ):
-                _logger.debug("make link: %s -> %s", data.render_file, data.gif_file)
-                try:
-                    data.gif_file.symlink_to(data.render_file)
-                except NotImplementedError:
-                    shutil.copyfile(data.render_file, data.gif_file)
-            else:
-                _logger.debug(
-                    "already linked: %s -> %s", data.render_file, data.gif_file
-                )
+            started_at = time.monotonic()
+            for format in data.formats:
+                stats = optimized.get((data.tape_hash, format))
+                if stats and stats.output:
+                    source = stats.output
+                else:
+                    source = data.get_render_file(format)
+                _link_render(source, data.get_link_file(format))
+            if poster := posters.get((data.tape_hash, data.poster)):
+                _link_render(poster, data.get_link_file(f"{data.poster}.png"))
+            link_times[data] = time.monotonic() - started_at
+
+    build, tapes = _telemetry.make_report(queue, all_used_files, link_times, optimized)
+    if report_path := _telemetry.get_report_path(app):
+        _telemetry.write_report(report_path, build, tapes)
+    if app.config["vhs_report_summary"]:
+        _telemetry.log_summary(build, tapes)
+
+    # Cache is cleaned up after rendering, so that it doesn't delay the build.
+    rendered = {
+        tape_hash
+        for (tape_hash, _), stats in queue.stats.items()
+        if stats.cache != "hit"
+    }
+    start_garbage_collection(app, env, rendered)
 
 
 class ProcessVhsNodes(SphinxTransform):
@@ -400,28 +729,144 @@ class ProcessVhsNodes(SphinxTransform):
     default_priority = 100
 
     def apply(self, **kwargs: _t.Any):
-        for image in self.document.findall(docutils.nodes.image):
+        for image in list(self.document.findall(docutils.nodes.image)):
             uri = image["uri"]
             if uri.startswith("data:vhs-tape;"):
-                uri = uri[len("data:vhs-tape;") :]
-                ext = pathlib.Path(uri).suffix.lstrip(".")
-                if ext in ["mp4", "webm"]:
-                    image.replace_self(
-                        video_node(
-                            ids=image["ids"],
-                            sources=[(uri, f"video/{ext}")],
-                            alt=image.get("alt", ""),
-                            attrs=["autoplay", "loop", "muted", "playsinline"],
-                            height=image.get("height", ""),
-                            width=image.get("width", ""),
-                        )
-                    )
-                    self.env.images.add_file(self.env.docname, uri)
-                    self.app.builder.images[uri] = self.env.images[uri][1]
-                else:
-                    image["uri"] = uri
-                    image["candidates"] = {"*": uri, f"image/{ext}": uri}
-                    self.env.images.add_file(self.env.docname, uri)
+                formats, base = uri[len("data:vhs-tape;") :].split(";", 1)
+                self._process_image(image, formats.split(","), base)
+
+    def _process_image(
+        self, image: docutils.nodes.image, formats: list[str], base: str
+    ):
+        uris = {format: f"{base}.{format}" for format in formats}
+        if self.config["vhs_preview"]:
+            # Pending videos don't have placeholders.
+            uris = {
+                format: uri for format, uri in uris.items() if os.path.lexists(uri)
+            } or {"svg": f"{base}.preview.svg"}
+        videos = [
+            (uri, _MIMETYPES[format])
+            for format, uri in uris.items()
+            if format in _VIDEO_FORMATS
+        ]
+        images = [
+            (uri, _MIMETYPES[format])
+            for format, uri in uris.items()
+            if format not in _VIDEO_FORMATS
+        ]
+
+        # GIF is the most widely supported, so it's the preferred fallback.
+        fallback = uris.get("gif") or (images[-1][0] if images else None)
+        if fallback is not None:
+            ext = pathlib.Path(fallback).suffix.lstrip(".")
+            image["uri"] = fallback
+            image["candidates"] = {"*": fallback, f"image/{ext}": fallback}
+            self.env.images.add_file(self.env.docname, fallback)
+            if "loading" not in image and self.config["vhs_loading"] == "lazy":
+                image["loading"] = "lazy"
+
+        for uri, _ in [*videos, *images]:
+            if uri != fallback:
+                self._add_file(uri)
+
+        if videos:
+            video = video_node(
+                ids=image["ids"],
+                sources=videos,
+                alt=image.get("alt", ""),
+                attrs=self._get_video_attrs(image),
+                height=image.get("height", ""),
+                width=image.get("width", ""),
+            )
+            poster = image.get("poster") and f"{base}.{image['poster']}.png"
+            # Poster is missing if it couldn't be extracted.
+            if poster and os.path.exists(poster):
+                video["poster"] = poster
+                self._add_file(poster)
+            if fallback is not None:
+                image["ids"] = []
+                video += image.deepcopy()
+            image.replace_self(video)
+        elif len(images) > 1:
+            picture = picture_node(
+                sources=[source for source in images if source[0] != fallback]
+            )
+            # Otherwise, Sphinx can wrap image into a link, which breaks
+            # `<picture>` fallback.
+            image["classes"].append("no-scaled-link")
+            picture += image.deepcopy()
+            image.replace_self(picture)
+
+    def _add_file(self, uri: str):
+        # Registered in builder by `add_extra_images`.
+        self.env.images.add_file(self.env.docname, uri)
+        self.document.setdefault("vhs_extra_images", []).append(uri)
+
+    def _get_video_attrs(self, image: docutils.nodes.image) -> list[str]:
+        autoplay = image.get("autoplay") or self.config["vhs_autoplay"]
+        preload = image.get("preload") or self.config["vhs_preload"]
+        attrs = ["loop", "muted", "playsinline"]
+        if autoplay == "on":
+            attrs.insert(0, "autoplay")
+        elif autoplay == "visible":
+            # Played and paused by `_AUTOPLAY_JS`.
+            attrs.append("data-vhs-autoplay")
+        if preload:
+            attrs.append(f'preload="{preload}"')
+        return attrs
+
+
+# Files that aren't referenced by image nodes, like videos and posters,
+# should be registered in builder directly, otherwise they're not copied.
+def add_extra_images(
+    app: sphinx.application.Sphinx, doctree: docutils.nodes.document, docname: str
+):
+    images: dict[str, str] | None = getattr(app.builder, "images", None)
+    if images is not None:
+        for uri in doctree.get("vhs_extra_images", []):
+            images[uri] = app.env.images[uri][1]
+
+
+# Plays videos while they're visible.
+_AUTOPLAY_JS = """
+document.addEventListener("DOMContentLoaded", () => {
+  const observer = new IntersectionObserver((entries) => {
+    for (const entry of entries) {
+      if (entry.isIntersecting) {
+        entry.target.play().catch(() => {});
+      } else {
+        entry.target.pause();
+      }
+    }
+  });
+  for (const video of document.querySelectorAll("video[data-vhs-autoplay]")) {
+    observer.observe(video);
+  }
+});
+"""
+
+
+# Add autoplay script only to pages that need it.
+def add_autoplay_js(
+    app: sphinx.application.Sphinx,
+    pagename: str,
+    templatename: str,
+    context: dict[str, _t.Any],
+    doctree: docutils.nodes.document | None,
+):
+    if doctree is not None and any(
+        "data-vhs-autoplay" in node["attrs"] for node in doctree.findall(video_node)
+    ):
+        app.add_js_file(None, body=_AUTOPLAY_JS)
+
+
+def _get_image_src(translator: sphinx.writers.html.HTMLTranslator, src: str) -> str:
+    builder = translator.builder
+    if src in builder.images:
+        src = pathlib.Path(
+            builder.imgpath, urllib.parse.quote(builder.images[src])
+        ).as_posix()
+    return src
 
 
 class video_node(docutils.nodes.General, docutils.nodes.Element):
@@ -433,25 +878,24 @@ def visit_video_node_html(
 ) -> None:
     # Based on sphinxcontrib-video, Apache License 2.0, by Raphael Massabot
 
-    html = "<video "
+    attrs: list[str] = []
     if node["ids"]:
-        html += f' id="{node["ids"][0]}"'
+        attrs.append(f'id="{node["ids"][0]}"')
     if width := node.get("width"):
-        html += f' width="{width}"'
+        attrs.append(f'width="{width}"')
     if height := node.get("height"):
-        html += f' height="{height}"'
-    html += " ".join(node.get("attrs", []))
-    html += ">"
+        attrs.append(f'height="{height}"')
+    if poster := node.get("poster"):
+        attrs.append(f'poster="{_get_image_src(translator, poster)}"')
+    attrs.extend(node.get("attrs", []))
+    html = f"<video {' '.join(attrs)}>"
 
-    builder = translator.builder
     for src, mimetype in node["sources"]:
-        if src in builder.images:
-            src = pathlib.Path(
-                builder.imgpath, urllib.parse.quote(builder.images[src])
-            ).as_posix()
-        html += f'<source src="{src}" type="{mimetype}">'
+        html += f'<source src="{_get_image_src(translator, src)}" type="{mimetype}">'
 
-    html += node["alt"]
+    # Fallback image, if there is one, is rendered as node's child.
+    if not node.children:
+        html += node["alt"]
 
     translator.body.append(html)
 
@@ -462,21 +906,63 @@ def depart_video_node_html(translator, node: video_node) -> None:
 
 
 def visit_video_node_unsupported(translator, node: video_node) -> None:
+    if node.children:
+        # Render fallback image instead.
+        return
     _logger.warning(
         "video %s: unsupported output format (node skipped)", node["sources"][0][0]
     )
     raise docutils.nodes.SkipNode
 
 
+def depart_video_node_unsupported(translator, node: video_node) -> None:
+    pass
+
+
+class picture_node(docutils.nodes.General, docutils.nodes.Element):
+    pass
+
+
+def visit_picture_node_html(
+    translator: sphinx.writers.html.HTMLTranslator, node: picture_node
+) -> None:
+    html = "<picture>"
+    for src, mimetype in node["sources"]:
+        html += f'<source srcset="{_get_image_src(translator, src)}" type="{mimetype}">'
+    translator.body.append(html)
+
+
+def depart_picture_node_html(translator, node: picture_node) -> None:
+    translator.body.append("</picture>")
+
+
+# Other builders only render the fallback image.
+def visit_picture_node_fallback(translator, node: picture_node) -> None:
+    pass
+
+
+def depart_picture_node_fallback(translator, node: picture_node) -> None:
+    pass
+
+
 def setup(app: sphinx.application.Sphinx):
     app.add_node(
         video_node,
         html=(visit_video_node_html, depart_video_node_html),
-        epub=(visit_video_node_unsupported, None),
-        latex=(visit_video_node_unsupported, None),
-        man=(visit_video_node_unsupported, None),
-        texinfo=(visit_video_node_unsupported, None),
-        text=(visit_video_node_unsupported, None),
+        epub=(visit_video_node_unsupported, depart_video_node_unsupported),
+        latex=(visit_video_node_unsupported, depart_video_node_unsupported),
+        man=(visit_video_node_unsupported, depart_video_node_unsupported),
+        texinfo=(visit_video_node_unsupported, depart_video_node_unsupported),
+        text=(visit_video_node_unsupported, depart_video_node_unsupported),
+    )
+    app.add_node(
+        picture_node,
+        html=(visit_picture_node_html, depart_picture_node_html),
+        epub=(visit_picture_node_fallback, depart_picture_node_fallback),
+        latex=(visit_picture_node_fallback, depart_picture_node_fallback),
+        man=(visit_picture_node_fallback, depart_picture_node_fallback),
+        texinfo=(visit_picture_node_fallback, depart_picture_node_fallback),
+        text=(visit_picture_node_fallback, depart_picture_node_fallback),
     )
 
     app.add_config_value("vhs_min_version", "0.5.0", rebuild="env", types=str)
@@ -494,29 +980,109 @@ def setup(app: sphinx.application.Sphinx):
         rebuild="env",
         types=(str, pathlib.Path, pathlib.PosixPath, pathlib.WindowsPath),
     )
-    app.add_config_value("vhs_n_jobs", None, rebuild="", types=int)
-    app.add_config_value("vhs_n_jobs_read_the_docs", 8, rebuild="", types=int)
+    app.add_config_value("vhs_n_jobs", None, rebuild="", types=(int, str))
+    app.add_config_value("vhs_n_jobs_read_the_docs", 8, rebuild="", types=(int, str))
+    app.add_config_value("vhs_render_memory", None, rebuild="", types=int)
     app.add_config_value(
         "vhs_cleanup_delay", timedelta(days=1), rebuild="env", types=timedelta
     )
+    app.add_config_value(
+        "vhs_cache_dir",
+        None,
+        rebuild="env",
+        types=(str, pathlib.Path, pathlib.PosixPath, pathlib.WindowsPath),
+    )
+    app.add_config_value("vhs_cache_max_size", None, rebuild="", types=int)
+    app.add_config_value(
+        "vhs_cache_env_vars", ["VHS_*"], rebuild="", types=(list, tuple)
+    )
+    app.add_config_value(
+        "vhs_max_tape_seconds", None, rebuild="env", types=(int, float)
+    )
+    app.add_config_value("vhs_max_output_bytes", None, rebuild="env", types=int)
+    app.add_config_value(
+        "vhs_report",
+        True,
+        rebuild="",
+        types=(bool, str, pathlib.Path, pathlib.PosixPath, pathlib.WindowsPath),
+    )
+    app.add_config_value("vhs_report_summary", False, rebuild="", types=bool)
+    app.add_config_value("vhs_pipeline", False, rebuild="", types=bool)
+    app.add_config_value("vhs_preview", False, rebuild="", types=bool)
+    app.add_config_value("vhs_shard", None, rebuild="", types=(str, type(None)))
+    app.add_config_value("vhs_require_cache", False, rebuild="", types=bool)
+    app.add_config_value("vhs_backend", None, rebuild="", types=(str, type(None)))
+    app.add_config_value("vhs_backend_token", None, rebuild="", types=(str, type(None)))
+    app.add_config_value("vhs_timeout", 120, rebuild="", types=(int, float, type(None)))
+    app.add_config_value("vhs_timeout_scale", 4, rebuild="", types=(int, float))
+    app.add_config_value("vhs_retries", 1, rebuild="", types=int)
+    app.add_config_value("vhs_keep_going", False, rebuild="", types=bool)
+    app.add_config_value("vhs_optimize", False, rebuild="", types=bool)
+    app.add_config_value(
+        "vhs_optimize_gifsicle",
+        None,
+        rebuild="",
+        types=(bool, str, pathlib.Path, pathlib.PosixPath, pathlib.WindowsPath),
+    )
+    app.add_config_value(
+        "vhs_optimize_gifsicle_args", ["-O3"], rebuild="", types=(list, tuple)
+    )
+    app.add_config_value(
+        "vhs_poster",
+        None,
+        rebuild="env",
+        types=sphinx.config.ENUM(None, "first", "last"),
+    )
+    app.add_config_value(
+        "vhs_preload",
+        "metadata",
+        rebuild="html",
+        types=sphinx.config.ENUM(None, "none", "metadata", "auto"),
+    )
+    app.add_config_value(
+        "vhs_loading", "lazy", rebuild="html", types=sphinx.config.ENUM("lazy", "eager")
+    )
+    app.add_config_value(
+        "vhs_autoplay",
+        "on",
+        rebuild="html",
+        types=sphinx.config.ENUM(*_AUTOPLAY),
+    )
+    app.add_config_value(
+        "vhs_publish",
+        "copy",
+        rebuild="",
+        types=sphinx.config.ENUM("copy", "auto", "reflink", "hardlink"),
+    )
     app.add_config_value("vhs_repo", "charmbracelet/vhs", rebuild="env", types=str)
     app.add_config_value(
         "vhs_format",
         "gif",
         rebuild="env",
-        types=sphinx.config.ENUM("gif", "svg", "webm", "mp4"),
+        types=sphinx.config.ENUM(*_FORMATS),
     )
 
     app.add_directive("vhs", VhsDirective)
     app.add_directive("vhs-inline", InlineVhsDirective)
 
+    app.connect("builder-inited", init_render_queue)
+    app.connect("doctree-read", submit_new_files)
     app.connect("env-merge-info", merge_used_files)
     app.connect("env-purge-doc", purge_used_files)
+    app.connect("env-get-outdated", _preview.get_outdated)
     app.connect("env-updated", generate_vhs)
+    app.connect("build-finished", _preview.start_worker, priority=400)
+    app.connect("build-finished", close_render_queue)
+    app.connect("build-finished", finish_garbage_collection)
+    app.connect("doctree-resolved", add_extra_images)
+    app.connect("html-page-context", add_autoplay_js)
+    app.connect("html-collect-pages", _preview.collect_destinations, priority=400)
+    app.connect("html-collect-pages", _publish.publish_images)
     app.add_post_transform(ProcessVhsNodes)
 
     return {
         "version": __version__,  # noqa: F405
+        "env_version": 3,
         "parallel_read_safe": True,
         "parallel_write_safe": True,
     }
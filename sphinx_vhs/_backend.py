@@ -0,0 +1,472 @@
+from __future__ import annotations
+
+import http.client
+import io
+import json
+import os
+import pathlib
+import re
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import typing as _t
+import urllib.parse
+import uuid
+
+import vhs
+
+from sphinx_vhs import _runner
+
+# Windows equivalent of `start_new_session`.
+_CREATE_NEW_PROCESS_GROUP: int = getattr(subprocess, "CREATE_NEW_PROCESS_GROUP", 0)
+
+# Remote renders are given this much more time than the worker's own timeout,
+# to account for queueing and transfer.
+_REMOTE_TIMEOUT_SLACK = 60.0
+
+# Size of chunks in which renders are streamed.
+CHUNK_SIZE = 1 << 16
+
+# VHS prints this when a tape has syntax errors. Such errors are deterministic,
+# so renders that fail with them are not retried.
+_PARSE_ERROR_RE = re.compile(r"\bparser: \d+ error")
+
+#: Environment variable with the token that builds send to the render worker,
+#: and that the worker requires.
+TOKEN_ENV = "SPHINX_VHS_BACKEND_TOKEN"
+
+
+class RenderTimeoutError(vhs.VhsError):
+    """
+    Raised when VHS doesn't finish rendering in time.
+
+    """
+
+
+class RenderFailedError(vhs.VhsError):
+    """
+    Raised when a render worker can't be reached, or fails to render a tape.
+
+    """
+
+
+def is_transient(e: vhs.VhsError) -> bool:
+    """
+    Check if a failed render may succeed when retried: VHS timed out, or exited
+    with an error that doesn't come from parsing the tape, or a render worker
+    failed in the same way or couldn't be reached.
+
+    """
+
+    if isinstance(e, RenderTimeoutError):
+        return True
+    if isinstance(e, vhs.VhsRunError):
+        stderr = e.stderr
+        if isinstance(stderr, bytes):
+            stderr = stderr.decode("utf-8", errors="replace")
+        return not _PARSE_ERROR_RE.search(stderr or "")
+    if isinstance(e, RenderFailedError):
+        return not _PARSE_ERROR_RE.search(str(e))
+    return False
+
+
+class Backend:
+    """
+    Renders tapes. Render queue calls `render` from several threads at once.
+
+    """
+
+    #: Search path for binaries that come with VHS, like ffmpeg,
+    #: or `None` if VHS doesn't run locally.
+    path: str | None = None
+
+    def get_version(self) -> str:
+        """
+        Get version of VHS that renders tapes.
+
+        """
+
+        raise NotImplementedError
+
+    def render(
+        self,
+        tape_file: pathlib.Path,
+        tape_hash: str,
+        outputs: _t.Mapping[str, pathlib.Path],
+        timeout: float | None,
+    ):
+        """
+        Render a tape into every format from `outputs`, writing each format
+        into its output path.
+
+        :raises vhs.VhsError: if rendering fails.
+        :raises RenderTimeoutError: if rendering takes longer than `timeout`.
+
+        """
+
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Abandon renders that are still running.
+
+        """
+
+    def to_json(self) -> dict[str, _t.Any]:
+        """
+        Describe backend, so that it can be re-created in another process
+        with `from_json`.
+
+        """
+
+        raise NotImplementedError
+
+
+class LocalBackend(Backend):
+    """
+    Renders tapes by running VHS in a subprocess.
+
+    Every VHS run is started in a new process group, so that it can be killed
+    along with all of its children if it hangs.
+
+    """
+
+    def __init__(self, runner: vhs.Vhs):
+        self.runner = runner
+        self.path = getattr(runner, "_path", None)
+        self._lock = threading.Lock()
+        self._processes: set[subprocess.Popen[bytes]] = set()
+
+    def get_version(self) -> str:
+        return _runner.get_version(self.runner)
+
+    def render(
+        self,
+        tape_file: pathlib.Path,
+        tape_hash: str,
+        outputs: _t.Mapping[str, pathlib.Path],
+        timeout: float | None,
+    ):
+        paths = list(outputs.values())
+        if len(paths) == 1:
+            self._run(tape_file, paths[0], timeout)
+        else:
+            run_with_outputs(
+                lambda tape: self._run(tape, None, timeout), tape_file, paths
+            )
+
+    def close(self):
+        with self._lock:
+            for process in self._processes:
+                kill_process_tree(process)
+            self._processes.clear()
+
+    def to_json(self) -> dict[str, _t.Any]:
+        return {
+            "vhs_path": str(self.runner._vhs_path),
+            "path": self.path or os.environ.get("PATH", ""),
+        }
+
+    def _run(
+        self,
+        tape: pathlib.Path,
+        output: pathlib.Path | None,
+        timeout: float | None,
+    ):
+        runner = self.runner
+        if not isinstance(runner, vhs.Vhs):
+            # Custom runners handle timeouts themselves.
+            runner.run(tape, output)
+            return
+
+        # Same as `vhs.Vhs.run`, but VHS is started in a new process group,
+        # so that we can kill it and its children if it hangs.
+        args: list[str | os.PathLike[str]] = [runner._vhs_path, "-q"]
+        if output is not None:
+            args += ["-o", output]
+        args += [tape]
+        env = dict(runner._env if runner._env is not None else os.environ)
+        env["PATH"] = runner._path
+        with self._lock:
+            process = subprocess.Popen(
+                args,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                env=env,
+                cwd=runner._cwd,
+                start_new_session=True,
+                creationflags=_CREATE_NEW_PROCESS_GROUP,
+            )
+            self._processes.add(process)
+        try:
+            try:
+                stdout, stderr = process.communicate(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                assert timeout is not None
+                kill_process_tree(process)
+                process.communicate()
+                raise RenderTimeoutError(
+                    f"VHS didn't finish in {timeout:.1f}s"
+                ) from None
+        finally:
+            with self._lock:
+                self._processes.discard(process)
+        if process.returncode:
+            raise vhs.VhsRunError(process.returncode, args, stdout, stderr)
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path: str, timeout: float | None):
+        super().__init__("localhost", timeout=timeout)
+        self._socket_path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self._socket_path)
+        except BaseException:
+            sock.close()
+            raise
+        self.sock = sock
+
+
+class RemoteBackend(Backend):
+    """
+    Sends tapes to a render worker started with ``python -m sphinx_vhs serve``,
+    and streams renders back.
+
+    Worker is addressed by URL: ``http://host:port``
+    or ``unix:/path/to/socket``. Every request carries the worker's token.
+
+    """
+
+    def __init__(self, url: str, token: str | None):
+        self.url = url
+        self.token = token
+        parsed = urllib.parse.urlsplit(url)
+        if parsed.scheme == "unix" and parsed.path:
+            self._socket_path: str | None = parsed.path
+            self._netloc = ""
+        elif parsed.scheme == "http" and parsed.netloc:
+            self._socket_path = None
+            self._netloc = parsed.netloc
+        else:
+            raise vhs.VhsError(
+                f"invalid render worker address {url!r}, expected"
+                " 'http://host:port' or 'unix:/path/to/socket'"
+            )
+        self._prefix = "" if parsed.scheme == "unix" else parsed.path.rstrip("/")
+        self._version: str | None = None
+        self._lock = threading.Lock()
+        self._connections: set[http.client.HTTPConnection] = set()
+
+    def get_version(self) -> str:
+        if self._version is None:
+            response, conn = self._request("GET", "/version", None, 30)
+            try:
+                self._version = str(json.loads(response.read())["version"])
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                raise vhs.VhsError(f"bad response from render worker: {e}") from e
+            finally:
+                self._release(conn)
+        return self._version
+
+    def render(
+        self,
+        tape_file: pathlib.Path,
+        tape_hash: str,
+        outputs: _t.Mapping[str, pathlib.Path],
+        timeout: float | None,
+    ):
+        request = {
+            "hash": tape_hash,
+            "tape": tape_file.read_text(),
+            "formats": list(outputs),
+            "timeout": timeout,
+        }
+        response, conn = self._request(
+            "POST",
+            "/render",
+            json.dumps(request).encode(),
+            None if timeout is None else timeout + _REMOTE_TIMEOUT_SLACK,
+        )
+        try:
+            received = receive_files(response, outputs)
+        except TimeoutError:
+            raise RenderTimeoutError("render worker didn't respond in time") from None
+        except (OSError, ValueError, http.client.HTTPException) as e:
+            raise RenderFailedError(f"failed to receive render: {e}") from e
+        finally:
+            self._release(conn)
+        if missing := set(outputs) - received:
+            raise vhs.VhsError(
+                f"render worker didn't send {', '.join(sorted(missing))}"
+            )
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+    def to_json(self) -> dict[str, _t.Any]:
+        return {"url": self.url}
+
+    def _request(
+        self, method: str, path: str, body: bytes | None, timeout: float | None
+    ) -> tuple[http.client.HTTPResponse, http.client.HTTPConnection]:
+        if self._socket_path is not None:
+            conn = _UnixHTTPConnection(self._socket_path, timeout)
+        else:
+            conn = http.client.HTTPConnection(self._netloc, timeout=timeout)
+        with self._lock:
+            self._connections.add(conn)
+        try:
+            headers = {"Content-Type": "application/json"} if body else {}
+            if self.token:
+                headers["Authorization"] = f"Bearer {self.token}"
+            conn.request(method, self._prefix + path, body, headers)
+            response = conn.getresponse()
+        except TimeoutError:
+            self._release(conn)
+            raise RenderTimeoutError("render worker didn't respond in time") from None
+        except (OSError, http.client.HTTPException) as e:
+            self._release(conn)
+            raise RenderFailedError(f"render worker at {self.url} failed: {e}") from e
+        if response.status == 200:
+            return response, conn
+
+        try:
+            error = json.loads(response.read())["error"]
+        except (OSError, ValueError, KeyError, TypeError):
+            error = f"{response.status} {response.reason}"
+        finally:
+            self._release(conn)
+        if response.status == 504:
+            raise RenderTimeoutError(error)
+        if response.status == 401:
+            raise vhs.VhsError(
+                f"render worker at {self.url} rejected the token,"
+                f" check {TOKEN_ENV} or vhs_backend_token"
+            )
+        if response.status >= 500:
+            raise RenderFailedError(f"render worker at {self.url} failed: {error}")
+        raise vhs.VhsError(f"render worker at {self.url} failed: {error}")
+
+    def _release(self, conn: http.client.HTTPConnection):
+        conn.close()
+        with self._lock:
+            self._connections.discard(conn)
+
+
+def from_json(data: _t.Mapping[str, _t.Any], env: dict[str, str], cwd: str) -> Backend:
+    """
+    Re-create a backend described by `Backend.to_json`. Tokens are not
+    serialized, remote backends take theirs from `TOKEN_ENV`.
+
+    """
+
+    if "url" in data:
+        return RemoteBackend(data["url"], os.environ.get(TOKEN_ENV))
+    return LocalBackend(
+        vhs.Vhs(
+            _vhs_path=pathlib.Path(data["vhs_path"]),
+            _path=data["path"],
+            _env=env,
+            _cwd=cwd,
+        )
+    )
+
+
+def send_files(out: io.BufferedIOBase, files: _t.Mapping[str, pathlib.Path]):
+    """
+    Stream files to `out`. Every file is preceded by a JSON header line
+    with its format and size.
+
+    """
+
+    for format, path in files.items():
+        with open(path, "rb") as file:
+            size = os.fstat(file.fileno()).st_size
+            header = {"format": format, "size": size}
+            out.write(json.dumps(header).encode() + b"\n")
+            while size > 0:
+                chunk = file.read(min(CHUNK_SIZE, size))
+                if not chunk:
+                    raise OSError(f"{path} was truncated while sending")
+                out.write(chunk)
+                size -= len(chunk)
+
+
+def receive_files(
+    response: io.BufferedIOBase, outputs: _t.Mapping[str, pathlib.Path]
+) -> set[str]:
+    """
+    Receive files sent by `send_files`, writing each one into its output path.
+    Returns formats that were received.
+
+    """
+
+    received: set[str] = set()
+    while header := response.readline():
+        data = json.loads(header)
+        format, size = str(data["format"]), int(data["size"])
+        if format not in outputs:
+            raise ValueError(f"unexpected format {format!r}")
+        with open(outputs[format], "wb") as file:
+            while size > 0:
+                chunk = response.read(min(CHUNK_SIZE, size))
+                if not chunk:
+                    raise ValueError("render was truncated")
+                file.write(chunk)
+                size -= len(chunk)
+        received.add(format)
+    return received
+
+
+def kill_process_tree(process: subprocess.Popen[bytes]):
+    """
+    Kill a process that was started in a new process group,
+    along with all of its children.
+
+    """
+
+    if sys.platform == "win32":
+        subprocess.run(
+            ["taskkill", "/F", "/T", "/PID", str(process.pid)], capture_output=True
+        )
+    else:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+    if process.poll() is None:
+        process.kill()
+
+
+def run_with_outputs(
+    run: _t.Callable[[pathlib.Path], None],
+    tape_file: pathlib.Path,
+    outputs: _t.Sequence[pathlib.Path],
+):
+    # VHS writes every `Output` of a tape, so we render all formats at once
+    # by prepending `Output` commands to a temporary copy of the tape.
+    text = "".join(f"Output {_quote(output)}\n" for output in outputs)
+    text += tape_file.read_text()
+    tmp_tape = tape_file.with_name(f".{uuid.uuid4().hex}.tape")
+    try:
+        tmp_tape.write_text(text)
+        run(tmp_tape)
+    finally:
+        tmp_tape.unlink(missing_ok=True)
+
+
+def _quote(path: pathlib.Path) -> str:
+    text = str(path)
+    for quote in "\"'`":
+        if quote not in text:
+            return f"{quote}{text}{quote}"
+    raise vhs.VhsError(f"can't quote path {text}")
@@ -0,0 +1,290 @@
+from __future__ import annotations
+
+import contextlib
+import dataclasses
+import hashlib
+import json
+import os
+import pathlib
+import re
+import struct
+import time
+import typing as _t
+
+import sphinx.errors
+
+from sphinx_vhs import _cache
+
+# Bundle starts with this magic, followed by contents of all files back to back,
+# followed by a JSON index, followed by a trailer.
+_MAGIC = b"SPHINX-VHS-CACHE"
+
+# Trailer holds offset and size of the index, and the magic again,
+# so that a truncated bundle is detected before reading its index.
+_TRAILER = struct.Struct(f"<QQ{len(_MAGIC)}s")
+
+# Version of the index format. Bundles with a different version are rejected.
+_BUNDLE_VERSION = 1
+
+# Size of chunks in which files are copied.
+_CHUNK_SIZE = 1 << 20
+
+# Formats that a bundle's manifest can name: a render, like ``gif``,
+# or a file derived from it, like ``opt.gif``. Anything else could point
+# outside of its cache entry.
+_FORMAT_RE = re.compile(r"(?:opt\.)?[a-z0-9]+")
+
+
+class BundleError(sphinx.errors.SphinxError):
+    """
+    Raised when a bundle can't be read.
+
+    """
+
+    category = "VHS bundle error"
+
+
+class _CorruptEntryError(Exception):
+    pass
+
+
+@dataclasses.dataclass
+class ImportStats:
+    #: Entries that were added or updated.
+    imported: int = 0
+
+    #: Entries that the cache already had.
+    skipped: int = 0
+
+    #: Requested entries that the bundle doesn't have.
+    missing: int = 0
+
+    #: Entries whose files didn't match their checksums.
+    corrupt: list[str] = dataclasses.field(default_factory=list)
+
+
+def _entry_files(entry_dir: pathlib.Path) -> tuple[dict[str, _t.Any], list[str]]:
+    manifest = _cache.read_manifest(entry_dir)
+    manifest = {
+        format: record
+        for format, record in manifest.items()
+        if (entry_dir / f"vhs.{format}").is_file()
+    }
+    names = [f"vhs.{format}" for format in manifest]
+    if names and (entry_dir / "vhs.tape").is_file():
+        names.append("vhs.tape")
+    return manifest, names
+
+
+def export_bundle(
+    cache_dir: pathlib.Path,
+    bundle: pathlib.Path,
+    hashes: _t.Collection[str] | None = None,
+) -> int:
+    """
+    Pack renders from a cache into a single bundle file. If `hashes` are given,
+    only these entries are exported. Entries that have no renders are skipped.
+    Returns the number of exported entries.
+
+    Every file is stored once, along with its SHA-256 checksum. Symlinks are
+    followed, so the bundle can be moved between machines.
+
+    """
+
+    entries: dict[str, dict[str, _t.Any]] = {}
+    with os.scandir(cache_dir) as entry_dirs:
+        names = sorted(
+            entry_dir.name
+            for entry_dir in entry_dirs
+            if not entry_dir.name.startswith(".")
+            and entry_dir.is_dir(follow_symlinks=False)
+            and (hashes is None or entry_dir.name in hashes)
+        )
+
+    bundle.parent.mkdir(parents=True, exist_ok=True)
+    with _cache.atomic_output(bundle) as tmp, open(tmp, "wb") as out:
+        out.write(_MAGIC)
+        for tape_hash in names:
+            entry_dir = cache_dir / tape_hash
+            manifest, file_names = _entry_files(entry_dir)
+            files: dict[str, dict[str, _t.Any]] = {}
+            for name in file_names:
+                offset = out.tell()
+                checksum = hashlib.sha256()
+                with open(entry_dir / name, "rb") as file:
+                    while chunk := file.read(_CHUNK_SIZE):
+                        checksum.update(chunk)
+                        out.write(chunk)
+                files[name] = {
+                    "offset": offset,
+                    "size": out.tell() - offset,
+                    "sha256": checksum.hexdigest(),
+                }
+            if files:
+                entries[tape_hash] = {"manifest": manifest, "files": files}
+
+        index_offset = out.tell()
+        index = json.dumps({"version": _BUNDLE_VERSION, "entries": entries}).encode()
+        out.write(index)
+        out.write(_TRAILER.pack(index_offset, len(index), _MAGIC))
+    return len(entries)
+
+
+def read_index(file: _t.BinaryIO) -> dict[str, dict[str, _t.Any]]:
+    """
+    Read index of a bundle, mapping tape hashes to manifests of their entries,
+    and to offsets, sizes and checksums of their files.
+
+    :raises BundleError: if file is not a bundle, or if it is truncated.
+
+    """
+
+    size = file.seek(0, os.SEEK_END)
+    if size < len(_MAGIC) + _TRAILER.size:
+        raise BundleError("file is too small to be a bundle")
+    file.seek(0)
+    if file.read(len(_MAGIC)) != _MAGIC:
+        raise BundleError("file is not a bundle")
+    file.seek(size - _TRAILER.size)
+    index_offset, index_size, magic = _TRAILER.unpack(file.read(_TRAILER.size))
+    if magic != _MAGIC or index_offset + index_size != size - _TRAILER.size:
+        raise BundleError("bundle is truncated")
+    file.seek(index_offset)
+    try:
+        index = json.loads(file.read(index_size))
+    except ValueError as e:
+        raise BundleError(f"bundle index is corrupt: {e}") from None
+    if not isinstance(index, dict) or index.get("version") != _BUNDLE_VERSION:
+        raise BundleError("bundle was made by an incompatible version of Sphinx VHS")
+    entries: dict[str, dict[str, _t.Any]] = index.get("entries") or {}
+    try:
+        for tape_hash, entry in entries.items():
+            if tape_hash.startswith(".") or os.path.basename(tape_hash) != tape_hash:
+                raise ValueError(f"bad entry {tape_hash!r}")
+            manifest, files = entry["manifest"], entry["files"]
+            if not isinstance(manifest, dict) or not isinstance(files, dict):
+                raise ValueError(f"bad entry {tape_hash!r}")
+            names = {"vhs.tape"}
+            for format, record in manifest.items():
+                if not _FORMAT_RE.fullmatch(format) or not isinstance(record, dict):
+                    raise ValueError(f"bad format {format!r} in entry {tape_hash!r}")
+                names.add(f"vhs.{format}")
+            if not files or not names.issuperset(files):
+                raise ValueError(f"bad files in entry {tape_hash!r}")
+            for info in files.values():
+                if (
+                    not 0
+                    <= info["offset"]
+                    <= info["offset"] + info["size"]
+                    <= index_offset
+                ):
+                    raise ValueError(f"bad offsets in entry {tape_hash!r}")
+    except (AttributeError, KeyError, TypeError, ValueError) as e:
+        raise BundleError(f"bundle index is corrupt: {e}") from None
+    return entries
+
+
+def _copy(file: _t.BinaryIO, info: _t.Mapping[str, _t.Any], dest: pathlib.Path):
+    file.seek(info["offset"])
+    size = info["size"]
+    checksum = hashlib.sha256()
+    with open(dest, "wb") as out:
+        while size > 0:
+            chunk = file.read(min(_CHUNK_SIZE, size))
+            if not chunk:
+                break
+            checksum.update(chunk)
+            out.write(chunk)
+            size -= len(chunk)
+    return size == 0 and checksum.hexdigest() == info["sha256"]
+
+
+def _import_entry(
+    file: _t.BinaryIO, entry: _t.Mapping[str, _t.Any], entry_dir: pathlib.Path
+) -> bool | None:
+    # Same rule as merging shard caches: take renders that are missing
+    # from the cache, or that were made later than the ones it has.
+    ours = _cache.read_manifest(entry_dir)
+    records = {
+        format: record
+        for format, record in entry["manifest"].items()
+        if format not in ours
+        or record.get("rendered_at", 0) > ours[format].get("rendered_at", 0)
+        or not (entry_dir / f"vhs.{format}").exists()
+    }
+    names = [f"vhs.{format}" for format in records if f"vhs.{format}" in entry["files"]]
+    if not names:
+        return False
+    if not (entry_dir / "vhs.tape").exists() and "vhs.tape" in entry["files"]:
+        names.append("vhs.tape")
+
+    entry_dir.mkdir(parents=True, exist_ok=True)
+    # Files are only moved into the cache once all of them are verified,
+    # so a corrupt bundle never leaves a half-imported entry.
+    try:
+        with contextlib.ExitStack() as stack:
+            for name in sorted(names, key=lambda name: entry["files"][name]["offset"]):
+                tmp = stack.enter_context(_cache.atomic_output(entry_dir / name))
+                if not _copy(file, entry["files"][name], tmp):
+                    raise _CorruptEntryError(name)
+    except _CorruptEntryError:
+        return None
+    _cache.merge_manifest(
+        entry_dir,
+        {
+            format: record
+            for format, record in records.items()
+            if f"vhs.{format}" in names
+        },
+    )
+    return True
+
+
+def import_bundle(
+    bundle: pathlib.Path,
+    cache_dir: pathlib.Path,
+    hashes: _t.Collection[str] | None = None,
+) -> ImportStats:
+    """
+    Unpack renders from a bundle into a cache. If `hashes` are given,
+    only these entries are imported, and the rest of the bundle is never read.
+
+    Every file is checked against its checksum; entries with corrupt files
+    are skipped as a whole.
+
+    :raises BundleError: if bundle can't be read.
+
+    """
+
+    stats = ImportStats()
+    changed: list[str] = []
+    with open(bundle, "rb") as file:
+        entries = read_index(file)
+        if hashes is None:
+            selected = sorted(entries)
+        else:
+            selected = sorted(set(hashes) & set(entries))
+            stats.missing = len(set(hashes) - set(entries))
+        # Read the bundle front to back.
+        selected.sort(
+            key=lambda tape_hash: min(
+                info["offset"] for info in entries[tape_hash]["files"].values()
+            )
+        )
+        for tape_hash in selected:
+            result = _import_entry(file, entries[tape_hash], cache_dir / tape_hash)
+            if result is None:
+                stats.corrupt.append(tape_hash)
+            elif result:
+                changed.append(tape_hash)
+            else:
+                stats.skipped += 1
+    stats.imported = len(changed)
+
+    if changed:
+        index = _cache.CacheIndex.load(cache_dir)
+        now = time.time()
+        for tape_hash in changed:
+            index.mark_used(tape_hash, now, changed=True)
+        index.save()
+    return stats
@@ -0,0 +1,536 @@
+from __future__ import annotations
+
+import contextlib
+import fnmatch
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import threading
+import time
+import typing as _t
+import uuid
+from datetime import timedelta
+
+import sphinx.environment
+from sphinx.util import logging
+
+_logger = logging.getLogger("sphinx-vhs")
+
+
+# Size-based eviction never removes entries that were used this recently,
+# so that concurrent builds don't lose renders they've just referenced.
+_EVICTION_GRACE = timedelta(hours=1)
+
+# Version of the manifest format. Manifests with a different version
+# are ignored, and their entries are re-rendered.
+_MANIFEST_VERSION = 1
+
+# Cache index file name, and version of its format.
+_INDEX_FILE = "index.json"
+_INDEX_VERSION = 1
+
+# Last use of an entry is recorded again only once this much time has passed,
+# so that builds where nothing changed don't touch every entry. It's shorter than
+# `_EVICTION_GRACE`, so that builds sharing a cache don't evict entries in use.
+_MARK_INTERVAL = timedelta(minutes=30)
+
+# Cache dir is scanned for entries missing from the index this often.
+_RESCAN_INTERVAL = timedelta(days=1)
+
+# Entry's mtime must be this much newer than its last used time in the index
+# for the entry to be considered used by another build.
+_MTIME_TOLERANCE = 2.0
+
+# Guards read-modify-write cycles on manifests. Builds that share a cache
+# can still race, but the worst outcome is a redundant re-render.
+_manifest_lock = threading.Lock()
+
+
+def get_links_dir(env: sphinx.environment.BuildEnvironment) -> pathlib.Path:
+    """
+    Directory with per-project links to rendered files. Sphinx copies images
+    from here, so file names in this directory end up in the output.
+
+    """
+
+    return pathlib.Path(env.doctreedir, "vhs_tapes_cache")
+
+
+def get_cache_dir(env: sphinx.environment.BuildEnvironment) -> pathlib.Path:
+    """
+    Root of the content-addressed render cache. Unless configured otherwise,
+    it is the same as the links dir.
+
+    """
+
+    cache_dir = env.config["vhs_cache_dir"] or os.environ.get("SPHINX_VHS_CACHE_DIR")
+    if not cache_dir:
+        return get_links_dir(env)
+    return pathlib.Path(env.srcdir, cache_dir).expanduser().resolve()
+
+
+def is_shared(env: sphinx.environment.BuildEnvironment) -> bool:
+    return get_cache_dir(env) != get_links_dir(env)
+
+
+def atomic_write_text(path: pathlib.Path, text: str):
+    """
+    Write file contents so that concurrent readers never see a partial file.
+
+    """
+
+    with atomic_output(path) as tmp:
+        tmp.write_text(text)
+
+
+def write_once(path: pathlib.Path, text: str) -> bool:
+    """
+    Atomically write a content-addressed file, unless it already exists.
+    Returns `True` if the file was written.
+
+    Existing files are never rewritten, so their directories keep
+    their modification times, and re-reads cost a single ``stat``.
+
+    """
+
+    if os.path.exists(path):
+        return False
+    path.parent.mkdir(parents=True, exist_ok=True)
+    atomic_write_text(path, text)
+    return True
+
+
+@contextlib.contextmanager
+def atomic_output(path: pathlib.Path) -> _t.Iterator[pathlib.Path]:
+    """
+    Yield a temporary path next to `path`, and move it to `path` once
+    the ``with`` block succeeds.
+
+    Temporary path has the same suffix as `path`, because VHS uses it
+    to detect output format.
+
+    """
+
+    tmp = path.with_name(f".{uuid.uuid4().hex}{path.suffix}")
+    try:
+        yield tmp
+        os.replace(tmp, path)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+
+def fingerprint_env(environ: _t.Mapping[str, str], patterns: _t.Iterable[str]) -> str:
+    """
+    Hash values of environment variables that match any of the given patterns.
+
+    """
+
+    patterns = list(patterns)
+    items = sorted(
+        (name, value)
+        for name, value in environ.items()
+        if any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns)
+    )
+    return hashlib.sha256(json.dumps(items).encode()).hexdigest()
+
+
+def read_manifest(entry_dir: pathlib.Path) -> dict[str, dict[str, _t.Any]]:
+    """
+    Read manifest of a cache entry. Manifest maps render formats to records
+    describing how they were rendered.
+
+    """
+
+    try:
+        with open(entry_dir / "manifest.json") as file:
+            data = json.load(file)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(data, dict) or data.get("version") != _MANIFEST_VERSION:
+        return {}
+    return data.get("renders", {})
+
+
+def lookup(
+    manifest: _t.Mapping[str, _t.Mapping[str, _t.Any]],
+    format: str,
+    render_key: _t.Mapping[str, _t.Any],
+) -> _t.Literal["hit", "stale", "miss"]:
+    """
+    Check whether manifest has a render in the given format (``"miss"`` if it
+    doesn't), and whether it was made with the given render key (``"hit"``)
+    or with some other key (``"stale"``).
+
+    """
+
+    record = manifest.get(format)
+    if record is None:
+        return "miss"
+    elif all(record.get(name) == value for name, value in render_key.items()):
+        return "hit"
+    else:
+        return "stale"
+
+
+def is_fresh(
+    manifest: _t.Mapping[str, _t.Mapping[str, _t.Any]],
+    format: str,
+    render_key: _t.Mapping[str, _t.Any],
+) -> bool:
+    """
+    Check that manifest has a render in the given format, and that it was
+    made with the given render key.
+
+    """
+
+    return lookup(manifest, format, render_key) == "hit"
+
+
+def update_manifest(
+    entry_dir: pathlib.Path,
+    format: str,
+    render_key: _t.Mapping[str, _t.Any],
+    duration: float | None,
+    **info: _t.Any,
+):
+    """
+    Record a freshly published render in entry's manifest,
+    along with how long it took to render it.
+
+    Format can also name a derived file, like ``"opt.gif"`` for ``vhs.opt.gif``.
+    Such records don't have a duration, so that they're not confused
+    with render durations.
+
+    """
+
+    with _manifest_lock:
+        renders = read_manifest(entry_dir)
+        try:
+            size = (entry_dir / f"vhs.{format}").stat().st_size
+        except FileNotFoundError:
+            size = 0
+        renders[format] = {
+            **render_key,
+            **info,
+            "size": size,
+            "rendered_at": time.time(),
+        }
+        if duration is not None:
+            renders[format]["duration"] = duration
+        atomic_write_text(
+            entry_dir / "manifest.json",
+            json.dumps({"version": _MANIFEST_VERSION, "renders": renders}),
+        )
+
+
+def merge_manifest(
+    entry_dir: pathlib.Path, records: _t.Mapping[str, _t.Mapping[str, _t.Any]]
+):
+    """
+    Add records copied from another cache's manifest, keeping them as is.
+
+    """
+
+    if not records:
+        return
+    with _manifest_lock:
+        renders = read_manifest(entry_dir)
+        renders.update({format: dict(record) for format, record in records.items()})
+        atomic_write_text(
+            entry_dir / "manifest.json",
+            json.dumps({"version": _MANIFEST_VERSION, "renders": renders}),
+        )
+
+
+def get_duration(
+    manifest: _t.Mapping[str, _t.Mapping[str, _t.Any]], format: str
+) -> float | None:
+    """
+    Get last measured render duration from entry's manifest. If entry wasn't
+    rendered in the given format yet, use duration for any other format.
+
+    """
+
+    for record in [manifest.get(format), *manifest.values()]:
+        if record is not None and isinstance(record.get("duration"), (int, float)):
+            return float(record["duration"])
+    return None
+
+
+def touch(entry_dir: pathlib.Path):
+    """
+    Mark cache entry as recently used.
+
+    """
+
+    try:
+        os.utime(entry_dir)
+    except FileNotFoundError:
+        pass
+
+
+def remove_entry(entry_dir: pathlib.Path):
+    """
+    Remove cache entry. Entry is renamed first, so that concurrent builds
+    either see a complete entry or don't see it at all.
+
+    """
+
+    trash = entry_dir.with_name(f".trash-{uuid.uuid4().hex}")
+    try:
+        entry_dir.rename(trash)
+    except FileNotFoundError:
+        return
+    shutil.rmtree(trash, ignore_errors=True)
+
+
+def _entry_size(entry_dir: str | pathlib.Path) -> int:
+    size = 0
+    with os.scandir(entry_dir) as files:
+        for file in files:
+            try:
+                if file.is_file(follow_symlinks=False):
+                    size += file.stat(follow_symlinks=False).st_size
+            except FileNotFoundError:
+                pass
+    return size
+
+
+class CacheIndex:
+    """
+    Persistent index of cache entries: tape hash -> last used time and size.
+
+    Garbage collection consults the index instead of listing and measuring
+    every cache entry. The cache directory is re-scanned only when the index
+    is missing, or when it is older than `_RESCAN_INTERVAL`, to pick up
+    entries that other builds added without recording them.
+
+    Builds that share a cache may overwrite each other's updates. This is
+    harmless: before removing an entry, its modification time is checked
+    to make sure that nobody used it recently.
+
+    """
+
+    def __init__(self, cache_dir: pathlib.Path):
+        self.cache_dir = cache_dir
+
+        #: Last used time and size for every entry.
+        self.entries: dict[str, tuple[float, int]] = {}
+
+        #: When the cache dir was last scanned for unknown entries.
+        self.scanned_at: float = 0
+
+        self._removed: set[str] = set()
+
+    @property
+    def path(self) -> pathlib.Path:
+        return self.cache_dir / _INDEX_FILE
+
+    @property
+    def total_size(self) -> int:
+        return sum(size for _, size in self.entries.values())
+
+    @classmethod
+    def load(cls, cache_dir: pathlib.Path) -> CacheIndex:
+        """
+        Load index from disk, re-scanning cache directory if needed.
+
+        """
+
+        index = cls(cache_dir)
+        index._read()
+        if time.time() - index.scanned_at > _RESCAN_INTERVAL.total_seconds():
+            index.rescan()
+        return index
+
+    def rescan(self):
+        """
+        Find entries that are not in the index, and drop entries
+        that no longer exist.
+
+        """
+
+        _logger.debug("scanning VHS cache in %s", self.cache_dir, type="vhs")
+        entries: dict[str, tuple[float, int]] = {}
+        with os.scandir(self.cache_dir) as entry_dirs:
+            for entry_dir in entry_dirs:
+                if entry_dir.name.startswith("."):
+                    continue
+                try:
+                    if not entry_dir.is_dir(follow_symlinks=False):
+                        continue
+                    mtime = entry_dir.stat(follow_symlinks=False).st_mtime
+                    if entry_dir.name in self.entries:
+                        last_used, size = self.entries[entry_dir.name]
+                        entries[entry_dir.name] = (max(last_used, mtime), size)
+                    else:
+                        entries[entry_dir.name] = (mtime, _entry_size(entry_dir.path))
+                except FileNotFoundError:
+                    continue
+        self._removed.update(self.entries.keys() - entries.keys())
+        self.entries = entries
+        self.scanned_at = time.time()
+
+    def mark_used(self, tape_hash: str, now: float, changed: bool = False):
+        """
+        Record that an entry was used at the given time. Entry's size is measured
+        if it's not in the index, or if it has `changed` since the last time.
+
+        """
+
+        if not changed and tape_hash in self.entries:
+            size = self.entries[tape_hash][1]
+        else:
+            try:
+                size = _entry_size(self.cache_dir / tape_hash)
+            except FileNotFoundError:
+                return
+        self.entries[tape_hash] = (now, size)
+        self._removed.discard(tape_hash)
+
+    def is_marked(
+        self, tape_hash: str, now: float, max_age: timedelta | None = None
+    ) -> bool:
+        """
+        Check if an entry's last use was recorded recently enough, so that
+        it doesn't need to be marked as used again. Entries are re-marked
+        well before they become older than `max_age`.
+
+        """
+
+        if tape_hash not in self.entries:
+            return False
+        interval = _MARK_INTERVAL
+        if max_age is not None:
+            interval = min(interval, max_age / 2)
+        return now - self.entries[tape_hash][0] < interval.total_seconds()
+
+    def remove(self, tape_hash: str):
+        remove_entry(self.cache_dir / tape_hash)
+        self.entries.pop(tape_hash, None)
+        self._removed.add(tape_hash)
+
+    def save(self):
+        """
+        Save index, merging it with changes made by concurrent builds.
+
+        """
+
+        ours = self.entries
+        self._read()
+        for tape_hash, (last_used, size) in ours.items():
+            if tape_hash in self.entries:
+                last_used = max(last_used, self.entries[tape_hash][0])
+            self.entries[tape_hash] = (last_used, size)
+        for tape_hash in self._removed:
+            self.entries.pop(tape_hash, None)
+        self._removed.clear()
+
+        data = {
+            "version": _INDEX_VERSION,
+            "scanned_at": self.scanned_at,
+            "entries": self.entries,
+        }
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        atomic_write_text(self.path, json.dumps(data, separators=(",", ":")))
+
+    def _read(self):
+        scanned_at = self.scanned_at
+        try:
+            data = json.loads(self.path.read_text())
+            if data.get("version") != _INDEX_VERSION:
+                raise ValueError("unsupported index version")
+            self.entries = {
+                tape_hash: (float(last_used), int(size))
+                for tape_hash, (last_used, size) in data["entries"].items()
+            }
+            self.scanned_at = max(scanned_at, float(data["scanned_at"]))
+        except FileNotFoundError:
+            self.entries = {}
+        except (OSError, ValueError, TypeError, KeyError, AttributeError):
+            _logger.debug("ignoring broken VHS cache index", exc_info=True, type="vhs")
+            self.entries = {}
+
+
+def collect_garbage(
+    index: CacheIndex,
+    pinned: _t.Container[str],
+    max_age: timedelta | None,
+    max_size: int | None,
+):
+    """
+    Remove least recently used cache entries.
+
+    Entries that weren't used for longer than `max_age` are removed. After that,
+    if cache size is bigger than `max_size`, least recently used entries are
+    removed until it fits. Entries in `pinned` are never removed.
+
+    Only the index is consulted, apart from a single ``stat`` for every entry
+    that is about to be removed.
+
+    """
+
+    now = time.time()
+    total_size = index.total_size
+    entries = sorted(
+        (last_used, size, tape_hash)
+        for tape_hash, (last_used, size) in index.entries.items()
+        if tape_hash not in pinned
+    )
+    for last_used, size, tape_hash in entries:
+        too_old = max_age is not None and now - last_used > max_age.total_seconds()
+        too_big = (
+            max_size is not None
+            and total_size > max_size
+            and now - last_used > _EVICTION_GRACE.total_seconds()
+        )
+        if not too_old and not too_big:
+            # Entries are sorted by age, the rest are even newer.
+            break
+
+        # Index can be stale if another build used this entry.
+        try:
+            mtime = os.stat(index.cache_dir / tape_hash).st_mtime
+        except FileNotFoundError:
+            index.entries.pop(tape_hash, None)
+            total_size -= size
+            continue
+        if mtime - last_used > _MTIME_TOLERANCE:
+            index.entries[tape_hash] = (mtime, size)
+            continue
+
+        _logger.debug(
+            "removing %s: %s",
+            tape_hash,
+            "unused for too long" if too_old else "cache is too big",
+            type="vhs",
+        )
+        index.remove(tape_hash)
+        total_size -= size
+
+    if max_size is not None and total_size > max_size:
+        _logger.debug(
+            "VHS cache size is %s bytes, which is over the limit of %s bytes",
+            total_size,
+            max_size,
+            type="vhs",
+        )
+
+
+def evict(
+    cache_dir: pathlib.Path,
+    pinned: _t.Container[str],
+    max_age: timedelta | None,
+    max_size: int | None,
+):
+    """
+    Load cache index, remove least recently used entries, and save the index.
+    See `collect_garbage` for details.
+
+    """
+
+    index = CacheIndex.load(cache_dir)
+    collect_garbage(index, pinned, max_age, max_size)
+    index.save()
@@ -0,0 +1,402 @@
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import pathlib
+import sys
+import tempfile
+import typing as _t
+
+import sphinx.application
+import sphinx.cmd.build
+import sphinx.environment
+import sphinx.errors
+import sphinx.util.docutils
+import sphinx.util.matching
+import vhs
+from sphinx.util import logging
+
+import sphinx_vhs
+from sphinx_vhs import _backend, _bundle, _cache, _render, _shard, _worker
+
+_logger = logging.getLogger("sphinx-vhs")
+
+
+def find_unused_tapes(app: sphinx.application.Sphinx) -> list[str]:
+    """
+    Find tape files in the source dir that no directive uses, directly
+    or via ``Source``.
+
+    """
+
+    used = {
+        include
+        for data in sphinx_vhs._get_storage(app.env)
+        for include in data.includes
+    }
+    tapes = sphinx.util.matching.get_matching_files(
+        app.srcdir, ["**.tape"], app.config["exclude_patterns"]
+    )
+    return sorted(
+        path for path in tapes if pathlib.PurePath(path).as_posix() not in used
+    )
+
+
+class _Build:
+    """
+    Reads documents of a Sphinx project without writing any output,
+    so that tape directives are collected exactly like in a real build.
+
+    Build environment is kept in a temporary directory, so that it doesn't
+    interfere with the project's own builds, while renders go to the cache
+    that these builds use.
+
+    """
+
+    def __init__(self, args: argparse.Namespace, dry_run: bool, plan: bool = True):
+        self.args = args
+        self.dry_run = dry_run
+        self.make_plan = plan
+        self.cache_dir: pathlib.Path | None = None
+        self.used_hashes: set[str] = set()
+        self.plan: list[_render.PlanEntry] = []
+        self.stats: dict[tuple[str, str], _render.RenderStats] = {}
+        self.unused_tapes: list[str] = []
+
+    def run(self) -> None:
+        args = self.args
+        confoverrides: dict[str, _t.Any] = dict(args.define)
+        if args.cache_dir is not None:
+            confoverrides["vhs_cache_dir"] = str(args.cache_dir.resolve())
+        if args.shard is not None:
+            confoverrides["vhs_shard"] = args.shard
+
+        if self.dry_run or args.quiet:
+            status = None
+        else:
+            status = sys.stdout
+
+        confdir = args.confdir or args.sourcedir
+        with (
+            tempfile.TemporaryDirectory(prefix="sphinx-vhs-") as tmp,
+            sphinx.util.docutils.patch_docutils(confdir),
+            sphinx.util.docutils.docutils_namespace(),
+        ):
+            app = sphinx.application.Sphinx(
+                srcdir=args.sourcedir,
+                confdir=confdir,
+                outdir=pathlib.Path(tmp, "out"),
+                doctreedir=pathlib.Path(tmp, "doctrees"),
+                buildername="dummy",
+                confoverrides=confoverrides,
+                status=status,
+                warning=sys.stderr,
+                freshenv=True,
+                verbosity=args.verbose,
+                parallel=args.jobs,
+            )
+            if "sphinx_vhs" not in app.extensions:
+                app.setup_extension("sphinx_vhs")
+            if not app.config["vhs_cache_dir"] and not os.environ.get(
+                "SPHINX_VHS_CACHE_DIR"
+            ):
+                # Real builds keep renders in their doctree dir.
+                cache_dir = args.doctreedir.resolve() / "vhs_tapes_cache"
+                setattr(app.config, "vhs_cache_dir", str(cache_dir))
+            setattr(app, "vhs_dry_run", self.dry_run)
+            app.connect("env-updated", self._on_read, priority=400)
+            app.connect("env-updated", self._on_rendered, priority=900)
+            app.build()
+
+    def _on_read(
+        self, app: sphinx.application.Sphinx, env: sphinx.environment.BuildEnvironment
+    ):
+        self.unused_tapes = find_unused_tapes(app)
+        if not self.dry_run:
+            return
+        used_files = _shard.select(app, sphinx_vhs._get_used_files(env))
+        self.cache_dir = _cache.get_cache_dir(env)
+        self.used_hashes = set(used_files)
+        if not self.make_plan:
+            return
+        # Planning never installs VHS: renders are checked against the version
+        # of the previously resolved VHS, or of the one that's installed.
+        render_key = sphinx_vhs._get_render_queue(app).render_key
+        if used_files and "vhs_version" not in render_key:
+            _logger.warning(
+                "can't check renders against VHS version: VHS is not installed",
+                type="vhs",
+                subtype="plan",
+            )
+        self.plan = _render.make_plan(used_files, render_key)
+
+    def _on_rendered(
+        self, app: sphinx.application.Sphinx, env: sphinx.environment.BuildEnvironment
+    ):
+        if (queue := getattr(app, "vhs_render_queue", None)) is not None:
+            self.stats = dict(queue.stats)
+
+
+def plan(args: argparse.Namespace) -> int:
+    build = _Build(args, dry_run=True)
+    build.run()
+
+    if args.json:
+        for entry in build.plan:
+            sys.stdout.write(json.dumps(entry.to_json()) + "\n")
+        return 0
+
+    out: list[str] = []
+    for entry in build.plan:
+        locations = [f"{data.docname}:{data.lineno}" for data in entry.entries]
+        if len(locations) > 3:
+            locations[3:] = [f"(+{len(locations) - 3} more)"]
+        out.append(
+            f"{entry.status:<5} {_render.format_duration(entry.cost):>7}"
+            f"  {entry.tape_hash[:12]}  {entry.format:<14} {' '.join(locations)}"
+        )
+    todo = [entry for entry in build.plan if entry.status != "hit"]
+    out.append(
+        f"{len(build.plan)} renders, {len(todo)} to render,"
+        f" estimated render time {_render.format_duration(sum(e.cost for e in todo))}"
+    )
+    for path in build.unused_tapes:
+        out.append(f"not used by any document: {path}")
+    sys.stdout.write("\n".join(out) + "\n")
+    return 0
+
+
+def render(args: argparse.Namespace) -> int:
+    build = _Build(args, dry_run=False)
+    build.run()
+
+    stats = build.stats.values()
+    rendered = sum(s.cache != "hit" and s.error is None for s in stats)
+    cached = sum(s.cache == "hit" for s in stats)
+    if not args.quiet:
+        sys.stdout.write(f"rendered {rendered} tapes, {cached} found in cache\n")
+    return 0
+
+
+def merge(args: argparse.Namespace) -> int:
+    for source in args.sources:
+        if not source.is_dir():
+            raise sphinx.errors.SphinxError(f"cache dir not found: {source}")
+    changed = _shard.merge_caches(args.dest, args.sources)
+    if not args.quiet:
+        sys.stdout.write(f"merged {changed} entries into {args.dest}\n")
+    return 0
+
+
+def export(args: argparse.Namespace) -> int:
+    if not args.cache_dir.is_dir():
+        raise sphinx.errors.SphinxError(f"cache dir not found: {args.cache_dir}")
+    count = _bundle.export_bundle(args.cache_dir, args.bundle)
+    if not args.quiet:
+        size = args.bundle.stat().st_size
+        sys.stdout.write(
+            f"exported {count} entries into {args.bundle} ({size / 1e6:.1f} MB)\n"
+        )
+    return 0
+
+
+def import_(args: argparse.Namespace) -> int:
+    if not args.bundle.is_file():
+        raise sphinx.errors.SphinxError(f"bundle not found: {args.bundle}")
+    build = _Build(args, dry_run=True, plan=False)
+    build.run()
+    if build.cache_dir is None:
+        return 0
+
+    stats = _bundle.import_bundle(args.bundle, build.cache_dir, build.used_hashes)
+    for tape_hash in stats.corrupt:
+        sys.stderr.write(f"skipped corrupt entry {tape_hash}, it will be re-rendered\n")
+    if not args.quiet:
+        sys.stdout.write(
+            f"imported {stats.imported} entries, {stats.skipped} already in cache,"
+            f" {stats.missing} not in bundle\n"
+        )
+    return 0
+
+
+def serve(args: argparse.Namespace) -> int:
+    if args.token_file is not None:
+        token = args.token_file.read_text().strip()
+    else:
+        token = os.environ.get(_backend.TOKEN_ENV, "")
+    if not token:
+        sys.stderr.write(
+            f"Render worker error: set {_backend.TOKEN_ENV} or pass --token-file\n"
+        )
+        return 1
+    try:
+        runner = vhs.resolve(
+            cwd=args.cwd,
+            install=args.install,
+            env=_render.get_environ(),
+            repo=args.repo,
+        )
+        worker = _worker.RenderWorker(
+            _backend.LocalBackend(runner), args.cache_dir, args.jobs
+        )
+        _worker.serve(args.address, worker, token, args.allow_remote)
+    except (vhs.VhsError, OSError, ValueError) as e:
+        sys.stderr.write(f"Render worker error: {e}\n")
+        return 1
+    return 0
+
+
+def _shard_argument(value: str) -> str:
+    try:
+        _shard.parse_shard(value)
+    except sphinx.errors.ConfigError as e:
+        raise argparse.ArgumentTypeError(str(e)) from None
+    return value
+
+
+def _define(value: str) -> tuple[str, str]:
+    name, sep, setting = value.partition("=")
+    if not sep:
+        raise argparse.ArgumentTypeError(f"expected name=value, got {value!r}")
+    return name, setting
+
+
+def make_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="python -m sphinx_vhs",
+        description="Render tapes of a Sphinx project into the render cache.",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    for name, func, help in [
+        ("render", render, "render tapes that are missing from the cache"),
+        ("plan", plan, "list tapes and their cache status without rendering"),
+        ("import", import_, "unpack renders that the project uses from a bundle"),
+    ]:
+        command = commands.add_parser(name, help=help, description=help)
+        command.set_defaults(func=func)
+        command.add_argument("sourcedir", type=pathlib.Path, help="Sphinx source dir")
+        command.add_argument(
+            "-c", dest="confdir", type=pathlib.Path, help="dir with conf.py"
+        )
+        command.add_argument(
+            "-d",
+            dest="doctreedir",
+            type=pathlib.Path,
+            default=pathlib.Path("_build/doctrees"),
+            help="doctree dir of the builds that will use renders"
+            " (default: _build/doctrees)",
+        )
+        command.add_argument(
+            "--cache-dir", type=pathlib.Path, help="override vhs_cache_dir"
+        )
+        command.add_argument(
+            "-D",
+            dest="define",
+            type=_define,
+            action="append",
+            default=[],
+            metavar="setting=value",
+            help="override a setting in conf.py",
+        )
+        command.add_argument(
+            "-j",
+            "--jobs",
+            type=sphinx.cmd.build.jobs_argument,
+            default=1,
+            metavar="N",
+            help="read documents in parallel, also sets number of renders",
+        )
+        command.add_argument(
+            "--shard",
+            type=_shard_argument,
+            metavar="I/N",
+            help="only handle I-th of N parts of tapes, overrides vhs_shard",
+        )
+        command.add_argument("-v", dest="verbose", action="count", default=0)
+        command.add_argument("-q", dest="quiet", action="store_true")
+    commands.choices["plan"].add_argument(
+        "--json", action="store_true", help="print a JSON object per render"
+    )
+    commands.choices["import"].add_argument(
+        "bundle", type=pathlib.Path, help="bundle made by the export command"
+    )
+
+    help = "merge render caches of shards into a single cache"
+    command = commands.add_parser("merge", help=help, description=help)
+    command.set_defaults(func=merge)
+    command.add_argument("dest", type=pathlib.Path, help="cache dir to merge into")
+    command.add_argument(
+        "sources", type=pathlib.Path, nargs="+", help="cache dirs of shards"
+    )
+    command.add_argument("-q", dest="quiet", action="store_true")
+
+    help = "pack renders from a cache into a single bundle file"
+    command = commands.add_parser("export", help=help, description=help)
+    command.set_defaults(func=export)
+    command.add_argument("cache_dir", type=pathlib.Path, help="cache dir to export")
+    command.add_argument("bundle", type=pathlib.Path, help="bundle file to write")
+    command.add_argument("-q", dest="quiet", action="store_true")
+
+    help = "render tapes sent by builds that set vhs_backend"
+    command = commands.add_parser(
+        "serve",
+        help=help,
+        description=f"{help}. Tapes run shell commands, so anyone who can reach"
+        " the worker and knows its token can run commands on this machine."
+        " The worker only listens on loopback addresses and unix sockets,"
+        " unless --allow-remote is given.",
+    )
+    command.set_defaults(func=serve)
+    command.add_argument(
+        "address", help="host:port or unix:/path/to/socket to listen on"
+    )
+    command.add_argument(
+        "--cache-dir",
+        type=pathlib.Path,
+        required=True,
+        help="dir where renders are kept",
+    )
+    command.add_argument(
+        "--cwd", type=pathlib.Path, help="working dir for VHS (default: current)"
+    )
+    command.add_argument(
+        "-j",
+        "--jobs",
+        type=sphinx.cmd.build.jobs_argument,
+        default=1,
+        metavar="N",
+        help="number of renders that run at once",
+    )
+    command.add_argument(
+        "--no-install",
+        dest="install",
+        action="store_false",
+        help="don't install VHS if it isn't found",
+    )
+    command.add_argument(
+        "--token-file",
+        type=pathlib.Path,
+        help=f"file with the token that builds must send"
+        f" (default: {_backend.TOKEN_ENV} environment variable)",
+    )
+    command.add_argument(
+        "--allow-remote",
+        action="store_true",
+        help="allow listening on addresses that other machines can reach",
+    )
+    command.add_argument(
+        "--repo",
+        default="charmbracelet/vhs",
+        help="GitHub repo to install VHS from (default: charmbracelet/vhs)",
+    )
+    return parser
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = make_parser().parse_args(argv)
+    try:
+        return args.func(args)
+    except sphinx.errors.SphinxError as e:
+        sys.stderr.write(f"{e.category}: {e}\n")
+        return 1
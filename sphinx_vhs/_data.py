@@ -0,0 +1,165 @@
+from __future__ import annotations
+
+import pathlib
+import typing as _t
+from dataclasses import dataclass
+
+
+@dataclass(slots=True, eq=False)
+class VhsData:
+    """
+    A single tape directive.
+
+    Records are stored in the pickled environment and shipped between
+    parallel readers, so they're kept small: paths are derived on demand
+    from the tape hash and a few short names. Directories are shared
+    between all records, so pickle stores them only once.
+
+    """
+
+    docname: str
+    lineno: int
+    tape_hash: str
+
+    #: Render formats, comma-separated, i.e. ``"gif"`` or ``"webm,mp4"``.
+    #: All formats are rendered by a single VHS run.
+    format: str
+
+    #: Name of the rendered file in the output, without extension.
+    filename: str
+
+    #: Path to the tape file, or ``"<inline>"``.
+    origname: str
+
+    #: Root of the content-addressed render cache.
+    cache_dir: str
+
+    #: Root of the per-project links dir.
+    links_dir: str
+
+    estimated_render_time: float = 0
+    estimated_size: int = 0
+    parse_time: float = 0
+
+    #: Files that the tape was assembled from, relative to source dir.
+    includes: tuple[str, ...] = ()
+
+    #: Which video frame to use as a poster: ``"first"``, ``"last"``,
+    #: or empty string for no poster.
+    poster: str = ""
+
+    @property
+    def entry_dir(self) -> pathlib.Path:
+        return pathlib.Path(self.cache_dir, self.tape_hash)
+
+    @property
+    def tape_file(self) -> pathlib.Path:
+        return self.entry_dir / "vhs.tape"
+
+    @property
+    def formats(self) -> tuple[str, ...]:
+        return tuple(self.format.split(","))
+
+    @property
+    def render_file(self) -> pathlib.Path:
+        return self.get_render_file(self.formats[0])
+
+    @property
+    def gif_file(self) -> pathlib.Path:
+        return self.get_link_file(self.formats[0])
+
+    @property
+    def link_name(self) -> str:
+        return f"{self.filename}.{self.formats[0]}"
+
+    @property
+    def link_base(self) -> pathlib.Path:
+        """
+        Path of the rendered file in links dir, without extension.
+
+        """
+
+        return pathlib.Path(self.links_dir, self.tape_hash, self.filename)
+
+    def get_render_file(self, format: str) -> pathlib.Path:
+        return self.entry_dir / f"vhs.{format}"
+
+    def get_link_file(self, format: str) -> pathlib.Path:
+        return pathlib.Path(self.links_dir, self.tape_hash, f"{self.filename}.{format}")
+
+
+class UsedFiles:
+    """
+    Tape directives used by documents, indexed by docname and by tape hash.
+
+    Adding, purging and merging cost is proportional to the number
+    of affected directives.
+
+    """
+
+    __slots__ = ("_by_docname", "_by_hash")
+
+    def __init__(self, files: _t.Iterable[VhsData] = ()):
+        self._by_docname: dict[str, list[VhsData]] = {}
+        self._by_hash: dict[str, list[VhsData]] = {}
+        for data in files:
+            self.add(data)
+
+    def add(self, data: VhsData):
+        self._by_docname.setdefault(data.docname, []).append(data)
+        self._by_hash.setdefault(data.tape_hash, []).append(data)
+
+    def purge(self, docname: str):
+        """
+        Remove all directives of the given document.
+
+        """
+
+        for data in self._by_docname.pop(docname, ()):
+            entries = self._by_hash[data.tape_hash]
+            entries.remove(data)
+            if not entries:
+                del self._by_hash[data.tape_hash]
+
+    def merge(self, other: UsedFiles, docnames: _t.Iterable[str]):
+        """
+        Replace directives of the given documents with ones from `other`.
+
+        """
+
+        for docname in docnames:
+            self.purge(docname)
+            for data in other.get_docname(docname):
+                self.add(data)
+
+    def get_docname(self, docname: str) -> _t.Sequence[VhsData]:
+        return self._by_docname.get(docname, ())
+
+    def get_hash(self, tape_hash: str) -> _t.Sequence[VhsData]:
+        return self._by_hash.get(tape_hash, ())
+
+    @property
+    def by_hash(self) -> _t.Mapping[str, _t.Sequence[VhsData]]:
+        return self._by_hash
+
+    @property
+    def by_docname(self) -> _t.Mapping[str, _t.Sequence[VhsData]]:
+        return self._by_docname
+
+    def __iter__(self) -> _t.Iterator[VhsData]:
+        for entries in self._by_docname.values():
+            yield from entries
+
+    def __len__(self) -> int:
+        return sum(map(len, self._by_docname.values()))
+
+    def __getstate__(self):
+        # Hash index is rebuilt on load.
+        return self._by_docname
+
+    def __setstate__(self, state: dict[str, list[VhsData]]):
+        self._by_docname = state
+        self._by_hash = {}
+        for entries in state.values():
+            for data in entries:
+                self._by_hash.setdefault(data.tape_hash, []).append(data)
@@ -0,0 +1,213 @@
+from __future__ import annotations
+
+import re
+import typing as _t
+from dataclasses import dataclass
+
+from sphinx_vhs import _tape
+
+# Rough time it takes VHS to start a terminal and a browser.
+_STARTUP_SECONDS = 3.0
+
+# Rough time it takes to encode a single pixel of a single frame.
+_ENCODE_SECONDS_PER_PIXEL = 1e-8
+
+# Rough size of a single pixel of a single frame after compression.
+# Terminal recordings are mostly static, so these are very small.
+_BYTES_PER_PIXEL = {
+    "gif": 0.002,
+    "svg": 0.001,
+    "webm": 0.0003,
+    "mp4": 0.0004,
+}
+
+# Rough memory used by a single VHS run: ttyd, headless browser and ffmpeg.
+_RENDER_MEMORY = 384 * 1024 * 1024
+
+# Rough number of raw frames that browser and ffmpeg keep in memory.
+_BUFFERED_FRAMES = 32
+
+# VHS defaults.
+_DEFAULT_TYPING_SPEED = 0.05
+_DEFAULT_WIDTH = 1200
+_DEFAULT_HEIGHT = 600
+_DEFAULT_FRAMERATE = 50.0
+
+
+_DURATION_RE = re.compile(r"^(?P<value>\d+(?:\.\d*)?|\.\d+)(?P<unit>ms|s|m)?$")
+_COMMAND_RE = re.compile(
+    r"^(?P<command>[A-Za-z]+)(?:@(?P<speed>\S+))?(?:\s+(?P<args>.*))?$"
+)
+_STRING_RE = re.compile(r"([\"'`])(.*?)\1")
+
+
+@dataclass(frozen=True)
+class TapeEstimate:
+    """
+    Predicted cost of rendering a tape.
+
+    """
+
+    #: How long the tape plays, in seconds, including hidden parts.
+    duration: float
+
+    #: How long the visible part of the tape plays, in seconds.
+    visible_duration: float
+
+    #: Terminal width, in pixels.
+    width: int
+
+    #: Terminal height, in pixels.
+    height: int
+
+    #: Recording framerate.
+    framerate: float
+
+    @property
+    def frames(self) -> int:
+        """
+        Number of recorded frames.
+
+        """
+
+        return round(self.visible_duration * self.framerate)
+
+    @property
+    def render_time(self) -> float:
+        """
+        Estimated render time, in seconds. VHS records tapes in real time,
+        so this is the time it takes to play the tape, plus some overhead
+        for starting a browser and encoding the output.
+
+        """
+
+        pixels = self.frames * self.width * self.height
+        return _STARTUP_SECONDS + self.duration + pixels * _ENCODE_SECONDS_PER_PIXEL
+
+    def output_bytes(self, format: str) -> int:
+        """
+        Estimated size of the rendered file in the given format.
+
+        """
+
+        pixels = self.frames * self.width * self.height
+        return round(pixels * _BYTES_PER_PIXEL.get(format, _BYTES_PER_PIXEL["gif"]))
+
+    @property
+    def memory_bytes(self) -> int:
+        """
+        Estimated peak memory used while rendering the tape.
+
+        """
+
+        return _RENDER_MEMORY + self.width * self.height * 4 * _BUFFERED_FRAMES
+
+
+def parse_duration(text: str) -> float | None:
+    """
+    Parse VHS duration, like ``500ms`` or ``1.5s``, into seconds.
+    Numbers without units are seconds.
+
+    """
+
+    if match := _DURATION_RE.match(text.strip()):
+        value = float(match.group("value"))
+        unit = match.group("unit") or "s"
+        return value * {"ms": 0.001, "s": 1.0, "m": 60.0}[unit]
+    return None
+
+
+def _parse_number(text: str, default: float) -> float:
+    try:
+        return float(text.strip().strip("\"'`"))
+    except ValueError:
+        return default
+
+
+def estimate_tape(lines: _t.Iterable[str]) -> TapeEstimate:
+    """
+    Analyze a flattened tape, as returned by
+    `VhsDirective._get_tape_contents_inlined`.
+
+    """
+
+    typing_speed = _DEFAULT_TYPING_SPEED
+    width = _DEFAULT_WIDTH
+    height = _DEFAULT_HEIGHT
+    framerate = _DEFAULT_FRAMERATE
+    hidden = False
+    duration = 0.0
+    visible_duration = 0.0
+
+    for line in lines:
+        match = _COMMAND_RE.match(line.strip())
+        if not match:
+            continue
+        command = match.group("command").lower()
+        args = match.group("args") or ""
+        speed = parse_duration(match.group("speed") or "")
+        elapsed = 0.0
+        if command == "sleep":
+            elapsed = parse_duration(args) or 0
+        elif command == "type":
+            chars = sum(len(m.group(2)) for m in _STRING_RE.finditer(args))
+            elapsed = chars * (typing_speed if speed is None else speed)
+        elif command in _tape.KEYS:
+            # Key presses, i.e. `Enter` or `Backspace@100ms 3`.
+            count = args.split()[-1] if args else "1"
+            elapsed = (int(count) if count.isdigit() else 1) * (
+                typing_speed if speed is None else speed
+            )
+        elif command == "hide":
+            hidden = True
+        elif command == "show":
+            hidden = False
+        elif command == "set":
+            name, _, value = args.partition(" ")
+            name = name.lower()
+            if name == "typingspeed":
+                typing_speed = parse_duration(value) or typing_speed
+            elif name == "width":
+                width = int(_parse_number(value, width))
+            elif name == "height":
+                height = int(_parse_number(value, height))
+            elif name == "framerate":
+                framerate = _parse_number(value, framerate)
+        duration += elapsed
+        if not hidden:
+            visible_duration += elapsed
+
+    return TapeEstimate(
+        duration=duration,
+        visible_duration=visible_duration,
+        width=width,
+        height=height,
+        framerate=framerate,
+    )
+
+
+#: Estimate for a tape that doesn't change any settings.
+DEFAULT = TapeEstimate(
+    duration=0,
+    visible_duration=0,
+    width=_DEFAULT_WIDTH,
+    height=_DEFAULT_HEIGHT,
+    framerate=_DEFAULT_FRAMERATE,
+)
+
+
+def estimate_render_time(lines: _t.Iterable[str]) -> float:
+    """
+    Estimate render time of a flattened tape, in seconds.
+
+    """
+
+    return estimate_tape(lines).render_time
+
+
+def format_size(size: float) -> str:
+    for unit in ["B", "KB", "MB"]:
+        if size < 1024:
+            return f"{size:.0f}{unit}" if unit == "B" else f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}GB"
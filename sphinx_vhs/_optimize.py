@@ -0,0 +1,398 @@
+from __future__ import annotations
+
+import collections
+import io
+import pathlib
+import shutil
+import subprocess
+import time
+import typing as _t
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass
+from multiprocessing.pool import ThreadPool
+
+import sphinx.application
+from sphinx.util import logging
+
+from sphinx_vhs import _cache, _estimate, _render
+
+if _t.TYPE_CHECKING:
+    from sphinx_vhs._data import VhsData
+
+_logger = logging.getLogger("sphinx-vhs")
+
+# Bump this when optimizations change, to re-optimize cached renders.
+_OPTIMIZER_VERSION = 2
+
+# Formats that can be optimized.
+FORMATS = frozenset(["gif", "svg"])
+
+# Identical SVG groups smaller than this are not worth sharing.
+_MIN_SHARED_SIZE = 256
+
+_SVG = "{http://www.w3.org/2000/svg}"
+
+# Whitespace inside of these SVG elements is significant.
+_PRESERVE_WHITESPACE = frozenset(
+    f"{_SVG}{tag}"
+    for tag in ["text", "tspan", "textPath", "style", "script", "title", "desc"]
+)
+_XML_SPACE = "{http://www.w3.org/XML/1998/namespace}space"
+
+
+@dataclass
+class OptimizeStats:
+    """
+    Result of optimizing a single render.
+
+    """
+
+    #: Optimized file, or `None` if optimization failed.
+    output: pathlib.Path | None = None
+
+    #: Whether optimized file was found in cache.
+    cached: bool = False
+
+    #: Size of the original render.
+    source_bytes: int = 0
+
+    #: Size of the optimized file.
+    output_bytes: int = 0
+
+    #: Seconds spent optimizing.
+    time: float = 0
+
+    #: Error message, if optimization failed.
+    error: str | None = None
+
+
+def get_optimized_file(data: VhsData, format: str) -> pathlib.Path:
+    return data.entry_dir / f"vhs.opt.{format}"
+
+
+def get_gifsicle(app: sphinx.application.Sphinx) -> str | None:
+    gifsicle = app.config["vhs_optimize_gifsicle"]
+    if gifsicle is False:
+        return None
+    elif gifsicle:
+        return str(gifsicle)
+    else:
+        return shutil.which("gifsicle")
+
+
+def _get_gifsicle_version(gifsicle: str) -> str:
+    try:
+        output = subprocess.check_output([gifsicle, "--version"]).decode()
+    except (subprocess.SubprocessError, OSError, UnicodeDecodeError):
+        _logger.debug("failed to get gifsicle version", exc_info=True, type="vhs")
+        return "unknown"
+    return output.splitlines()[0].strip() if output else "unknown"
+
+
+def dedup_gif_frames(data: bytes) -> bytes:
+    """
+    Merge consecutive GIF frames that redraw the same pixels, adding up
+    their delays. The image data is compared as is, without decoding it.
+
+    :raises ValueError: if data is not a valid GIF.
+
+    """
+
+    if data[:6] not in (b"GIF87a", b"GIF89a"):
+        raise ValueError("not a GIF file")
+
+    def skip_sub_blocks(pos: int) -> int:
+        while size := data[pos]:
+            pos += 1 + size
+        return pos + 1
+
+    pos = 13
+    if data[10] & 0x80:
+        pos += 3 * (2 << (data[10] & 7))
+    out = bytearray(data[:pos])
+
+    # Graphic control extension of the current frame, other extensions before it.
+    gce: bytes | None = None
+    extensions = bytearray()
+    # Position of the previous frame's GCE in `out`, and its comparison key.
+    prev_gce_pos: int | None = None
+    prev_key: tuple[int, int, bytes] | None = None
+
+    try:
+        while (block := data[pos]) != 0x3B:
+            if block == 0x21:
+                end = skip_sub_blocks(pos + 2)
+                if data[pos + 1] == 0xF9 and data[pos + 2] == 4:
+                    gce = data[pos:end]
+                else:
+                    extensions += data[pos:end]
+                pos = end
+            elif block == 0x2C:
+                flags = data[pos + 9]
+                end = pos + 10
+                if flags & 0x80:
+                    end += 3 * (2 << (flags & 7))
+                end = skip_sub_blocks(end + 1)
+                image = data[pos:end]
+                pos = end
+
+                # Frames draw the same if they have the same disposal method,
+                # transparency, position, size, palette and pixels; only their
+                # delays may differ. Frames without GCE are never merged.
+                key = (gce[3], gce[6], image) if gce else None
+                if (
+                    key is not None
+                    and key == prev_key
+                    and prev_gce_pos is not None
+                    and not extensions
+                ):
+                    assert gce is not None
+                    delay = int.from_bytes(
+                        out[prev_gce_pos + 4 : prev_gce_pos + 6], "little"
+                    )
+                    delay += int.from_bytes(gce[4:6], "little")
+                    if delay <= 0xFFFF:
+                        out[prev_gce_pos + 4 : prev_gce_pos + 6] = delay.to_bytes(
+                            2, "little"
+                        )
+                        gce = None
+                        continue
+
+                out += extensions
+                extensions.clear()
+                prev_gce_pos = len(out) if gce else None
+                prev_key = key
+                out += gce or b""
+                out += image
+                gce = None
+            else:
+                raise ValueError(f"unexpected block 0x{block:02x} at {pos}")
+    except IndexError:
+        raise ValueError("truncated GIF file") from None
+
+    out += extensions
+    out += b"\x3b"
+    return bytes(out)
+
+
+def optimize_svg(data: bytes) -> bytes:
+    """
+    Minify SVG: drop comments and insignificant whitespace, and replace
+    repeating groups of elements with references to a single copy.
+
+    :raises ValueError: if data is not a valid XML.
+
+    """
+
+    try:
+        for _, (prefix, uri) in ET.iterparse(io.BytesIO(data), events=["start-ns"]):
+            try:
+                ET.register_namespace(prefix, uri)
+            except ValueError:
+                pass
+        root = ET.fromstring(data)
+    except ET.ParseError as e:
+        raise ValueError(str(e)) from None
+
+    _strip_whitespace(root)
+    _share_groups(root)
+    return ET.tostring(root, encoding="utf-8")
+
+
+def _strip_whitespace(element: ET.Element):
+    if element.tag in _PRESERVE_WHITESPACE or element.get(_XML_SPACE) == "preserve":
+        return
+    if element.text is not None and not element.text.strip():
+        element.text = None
+    for child in element:
+        if child.tail is not None and not child.tail.strip():
+            child.tail = None
+        _strip_whitespace(child)
+
+
+def _share_groups(root: ET.Element):
+    # Only contents of groups are shared. Groups themselves stay in place along
+    # with their attributes, so that CSS rules and keyframe animations that select
+    # them, like `.frame:nth-child(3)`, still apply. Contents with IDs are never
+    # shared, because IDs should be unique, and because instances created
+    # by `<use>` don't match ID selectors.
+    serialized: dict[ET.Element, bytes] = {}
+    for group in root.iter(f"{_SVG}g"):
+        if not len(group) or any(
+            "id" in element.attrib for element in group.iter() if element is not group
+        ):
+            continue
+        text = (group.text or "").encode() + b"".join(map(ET.tostring, group))
+        if len(text) >= _MIN_SHARED_SIZE:
+            serialized[group] = text
+    counts = collections.Counter(serialized.values())
+    if not any(count > 1 for count in counts.values()):
+        return
+
+    defs = ET.Element(f"{_SVG}defs")
+    ids: dict[bytes, str] = {}
+
+    def visit(parent: ET.Element):
+        for child in parent:
+            text = serialized.get(child)
+            if text is None or counts[text] < 2:
+                visit(child)
+                continue
+            if text not in ids:
+                ids[text] = f"vhs-shared-{len(ids)}"
+                shared = ET.SubElement(defs, f"{_SVG}g", {"id": ids[text]})
+                shared.text = child.text
+                shared.extend(child)
+            child.text = None
+            child[:] = [ET.Element(f"{_SVG}use", {"href": f"#{ids[text]}"})]
+
+    visit(root)
+    root.insert(0, defs)
+
+
+def optimize(
+    data: VhsData,
+    format: str,
+    render_key: _t.Mapping[str, _t.Any],
+    gifsicle: str | None,
+    gifsicle_version: str | None,
+    gifsicle_args: list[str],
+) -> OptimizeStats:
+    """
+    Optimize a render in the given format, or get an optimized file from cache.
+    `gifsicle_version` is that of `gifsicle`, it's a part of the cache key.
+
+    """
+
+    stats = OptimizeStats()
+    output = get_optimized_file(data, format)
+    manifest = _cache.read_manifest(data.entry_dir)
+    if format not in manifest:
+        stats.error = "render not found in cache"
+        return stats
+    key = {
+        **render_key,
+        "optimizer": _OPTIMIZER_VERSION,
+        "gifsicle": [gifsicle_version, *gifsicle_args] if format == "gif" else None,
+        # Source could've been re-rendered with the same key.
+        "source_rendered_at": manifest[format].get("rendered_at"),
+    }
+    record = manifest.get(f"opt.{format}")
+    if (
+        record is not None
+        and _cache.lookup(manifest, f"opt.{format}", key) == "hit"
+        and output.exists()
+    ):
+        stats.output = output
+        stats.cached = True
+        stats.source_bytes = record.get("source_size", 0)
+        stats.output_bytes = record.get("size", 0)
+        return stats
+
+    started_at = time.monotonic()
+    try:
+        source = data.get_render_file(format).read_bytes()
+        if format == "gif":
+            result = dedup_gif_frames(source)
+        else:
+            result = optimize_svg(source)
+        with _cache.atomic_output(output) as tmp:
+            tmp.write_bytes(result)
+            if gifsicle and format == "gif":
+                subprocess.run(
+                    [gifsicle, "--batch", *gifsicle_args, str(tmp)],
+                    check=True,
+                    capture_output=True,
+                )
+            if tmp.stat().st_size >= len(source):
+                # Optimization didn't help, publish the original.
+                tmp.write_bytes(source)
+    except (OSError, ValueError, subprocess.CalledProcessError) as e:
+        if isinstance(e, subprocess.CalledProcessError) and e.stderr:
+            stats.error = e.stderr.decode(errors="replace").strip()
+        else:
+            stats.error = str(e)
+        return stats
+
+    stats.time = time.monotonic() - started_at
+    _cache.update_manifest(
+        data.entry_dir, f"opt.{format}", key, None, source_size=len(source)
+    )
+    stats.output = output
+    stats.source_bytes = len(source)
+    stats.output_bytes = output.stat().st_size
+    return stats
+
+
+def optimize_all(
+    app: sphinx.application.Sphinx,
+    used_files: _t.Mapping[str, _t.Iterable[VhsData]],
+    render_key: _t.Mapping[str, _t.Any],
+) -> dict[tuple[str, str], OptimizeStats]:
+    """
+    Optimize all renders in a thread pool. Returns optimization results
+    for every tape hash and format.
+
+    """
+
+    jobs: dict[tuple[str, str], VhsData] = {}
+    for entries in used_files.values():
+        for data in entries:
+            for format in data.formats:
+                if format in FORMATS:
+                    jobs.setdefault((data.tape_hash, format), data)
+    if not jobs:
+        return {}
+
+    gifsicle = get_gifsicle(app)
+    gifsicle_version = None
+    gifsicle_args = list(app.config["vhs_optimize_gifsicle_args"])
+    has_gifs = any(format == "gif" for _, format in jobs)
+    if has_gifs and gifsicle is None:
+        _logger.verbose(
+            "gifsicle not found, GIFs will only have their duplicate frames removed",
+            type="vhs",
+        )
+    elif has_gifs and gifsicle is not None:
+        # Asked once, rather than for every GIF.
+        gifsicle_version = _get_gifsicle_version(gifsicle)
+
+    with ThreadPool(_render.get_parallel(app)) as pool:
+        results = pool.map(
+            lambda job: optimize(
+                job[1],
+                job[0][1],
+                render_key,
+                gifsicle,
+                gifsicle_version,
+                gifsicle_args,
+            ),
+            jobs.items(),
+        )
+    optimized = dict(zip(jobs, results))
+
+    for (_, format), stats in optimized.items():
+        if stats.error is not None:
+            data = jobs[_, format]
+            _logger.warning(
+                "failed to optimize %s: %s",
+                format,
+                stats.error,
+                location=(data.docname, data.lineno),
+                type="vhs",
+                subtype="optimize",
+            )
+
+    done = [stats for stats in optimized.values() if not stats.cached and stats.output]
+    if done:
+        source_bytes = sum(stats.source_bytes for stats in done)
+        output_bytes = sum(stats.output_bytes for stats in done)
+        _logger.info(
+            "optimized terminal renders: %s files, %s -> %s",
+            len(done),
+            _estimate.format_size(source_bytes),
+            _estimate.format_size(output_bytes),
+            type="vhs",
+        )
+
+    return optimized
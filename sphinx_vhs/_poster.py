@@ -0,0 +1,147 @@
+from __future__ import annotations
+
+import pathlib
+import shutil
+import subprocess
+import typing as _t
+from multiprocessing.pool import ThreadPool
+
+import sphinx.application
+from sphinx.util import logging
+
+from sphinx_vhs import _cache, _render
+
+if _t.TYPE_CHECKING:
+    from sphinx_vhs._data import VhsData
+
+_logger = logging.getLogger("sphinx-vhs")
+
+# Bump this when poster extraction changes, to re-extract cached posters.
+_POSTER_VERSION = 1
+
+#: Which frame of a video is used as its poster.
+POSITIONS = ("first", "last")
+
+#: Formats that can have posters.
+FORMATS = frozenset(["webm", "mp4"])
+
+
+def get_poster_format(data: VhsData) -> str | None:
+    """
+    Get rendered format that poster is extracted from, or `None` if directive
+    doesn't need a poster.
+
+    """
+
+    if data.poster not in POSITIONS:
+        return None
+    return next((format for format in data.formats if format in FORMATS), None)
+
+
+def get_poster_file(data: VhsData) -> pathlib.Path:
+    return data.entry_dir / f"vhs.poster.{data.poster}.png"
+
+
+def get_ffmpeg(path: str | None) -> str | None:
+    # VHS needs ffmpeg, so it is either in `PATH` or installed next to VHS.
+    return shutil.which("ffmpeg", path=path)
+
+
+def make_poster(
+    data: VhsData,
+    render_key: _t.Mapping[str, _t.Any],
+    ffmpeg: str,
+) -> pathlib.Path:
+    """
+    Extract poster frame from a video render, or get it from cache.
+
+    :raises OSError: when poster can't be extracted.
+    :raises subprocess.CalledProcessError: when ffmpeg fails.
+
+    """
+
+    format = get_poster_format(data)
+    assert format is not None
+    output = get_poster_file(data)
+    name = f"poster.{data.poster}.png"
+    manifest = _cache.read_manifest(data.entry_dir)
+    key = {
+        **render_key,
+        "poster": _POSTER_VERSION,
+        "source": format,
+        # Source could've been re-rendered with the same key.
+        "source_rendered_at": manifest.get(format, {}).get("rendered_at"),
+    }
+    if _cache.is_fresh(manifest, name, key) and output.exists():
+        return output
+
+    source = data.get_render_file(format)
+    if data.poster == "first":
+        args = ["-i", source, "-frames:v", "1"]
+    else:
+        # Decode the last second, overwriting output with every frame.
+        args = ["-sseof", "-1", "-i", source, "-update", "1"]
+    with _cache.atomic_output(output) as tmp:
+        subprocess.run(
+            [ffmpeg, "-v", "error", "-y", *args, tmp],
+            check=True,
+            capture_output=True,
+        )
+    _cache.update_manifest(data.entry_dir, name, key, None)
+    return output
+
+
+def make_posters(
+    app: sphinx.application.Sphinx,
+    used_files: _t.Mapping[str, _t.Iterable[VhsData]],
+    path: str | None,
+    render_key: _t.Mapping[str, _t.Any],
+) -> dict[tuple[str, str], pathlib.Path]:
+    """
+    Extract posters for all directives that need them, in a thread pool.
+    Returns poster files for every tape hash and poster position.
+
+    """
+
+    jobs: dict[tuple[str, str], VhsData] = {}
+    for entries in used_files.values():
+        for data in entries:
+            if get_poster_format(data) is not None:
+                jobs.setdefault((data.tape_hash, data.poster), data)
+    if not jobs:
+        return {}
+
+    ffmpeg = get_ffmpeg(path)
+    if ffmpeg is None:
+        _logger.warning(
+            "ffmpeg not found, video posters will not be generated",
+            type="vhs",
+            subtype="poster",
+        )
+        return {}
+
+    def run(data: VhsData) -> pathlib.Path | str:
+        try:
+            return make_poster(data, render_key, ffmpeg)
+        except subprocess.CalledProcessError as e:
+            return e.stderr.decode(errors="replace").strip() or str(e)
+        except OSError as e:
+            return str(e)
+
+    with ThreadPool(_render.get_parallel(app)) as pool:
+        results = pool.map(run, jobs.values())
+
+    posters: dict[tuple[str, str], pathlib.Path] = {}
+    for key, result in zip(jobs, results):
+        if isinstance(result, pathlib.Path):
+            posters[key] = result
+        else:
+            data = jobs[key]
+            _logger.warning(
+                "failed to extract video poster: %s",
+                result,
+                location=(data.docname, data.lineno),
+                type="vhs",
+                subtype="poster",
+            )
+    return posters
@@ -0,0 +1,503 @@
+from __future__ import annotations
+
+import contextlib
+import json
+import os
+import pathlib
+import re
+import subprocess
+import sys
+import time
+import typing as _t
+import xml.sax.saxutils
+
+import sphinx.application
+import sphinx.environment
+import vhs
+from sphinx.util import logging
+
+from sphinx_vhs import _backend, _cache, _estimate, _publish, _render
+
+if _t.TYPE_CHECKING:
+    from sphinx_vhs._data import VhsData
+
+_logger = logging.getLogger("sphinx-vhs")
+
+# Last good render of every directive, in doctree dir.
+_INDEX_FILE = "vhs_preview.json"
+
+# Worker's log, in doctree dir. Jobs are passed to it in temporary files
+# in the same dir.
+_LOG_FILE = "vhs_preview.log"
+
+# Worker is started with `python -c`, because `python -m` would import
+# this module twice.
+_WORKER = "import sys; from sphinx_vhs._preview import main; sys.exit(main())"
+
+# Bump this when the format of the job file changes.
+_JOB_VERSION = 3
+
+#: Formats that can have generated placeholders.
+FORMATS = frozenset(["gif", "svg"])
+
+# Colors and font size of generated placeholders, same as VHS defaults.
+_BACKGROUND = (0x17, 0x17, 0x17)
+_FOREGROUND = "#dddddd"
+_FONT_SIZE = 22
+_PADDING = 60
+
+_STRING_RE = re.compile(r"([\"'`])(.*?)\1")
+
+
+def get_placeholder_file(data: VhsData, format: str) -> pathlib.Path:
+    return data.entry_dir / f"vhs.preview.{format}"
+
+
+def get_directive_keys(data: _t.Iterable[VhsData]) -> dict[VhsData, str]:
+    """
+    Make keys that identify directives between edits of a tape.
+    Directives are identified by document, file name, and their number
+    among directives with the same file name, so that keys don't change
+    when lines are added above a directive.
+
+    """
+
+    keys: dict[VhsData, str] = {}
+    seen: dict[tuple[str, str], int] = {}
+    for entry in sorted(data, key=lambda entry: (entry.docname, entry.lineno)):
+        n = seen.get((entry.docname, entry.filename), 0)
+        seen[entry.docname, entry.filename] = n + 1
+        keys[entry] = f"{entry.docname}:{entry.filename}:{n}"
+    return keys
+
+
+def load_index(app: sphinx.application.Sphinx) -> dict[str, str]:
+    try:
+        with open(pathlib.Path(app.doctreedir, _INDEX_FILE)) as file:
+            index = json.load(file)
+    except (OSError, ValueError):
+        return {}
+    return index if isinstance(index, dict) else {}
+
+
+def save_index(app: sphinx.application.Sphinx, index: dict[str, str]):
+    try:
+        _cache.atomic_write_text(
+            pathlib.Path(app.doctreedir, _INDEX_FILE), json.dumps(index)
+        )
+    except OSError:
+        _logger.debug("failed to save preview index", exc_info=True, type="vhs")
+
+
+def transcript(lines: _t.Iterable[str]) -> list[str]:
+    """
+    Get text that is typed in the visible part of a flattened tape,
+    split into lines.
+
+    """
+
+    result = ["> "]
+    hidden = False
+    for line in lines:
+        command, _, args = line.strip().partition(" ")
+        command = command.split("@")[0].lower()
+        if command == "hide":
+            hidden = True
+        elif command == "show":
+            hidden = False
+        elif hidden:
+            continue
+        elif command == "type":
+            result[-1] += "".join(m.group(2) for m in _STRING_RE.finditer(args))
+        elif command == "enter":
+            result.append("> ")
+    return result
+
+
+def make_placeholder_svg(width: int, height: int, text: list[str]) -> bytes:
+    """
+    Render lines of text as a static terminal screen.
+
+    """
+
+    line_height = round(_FONT_SIZE * 1.2)
+    rows = max((height - 2 * _PADDING) // line_height, 1)
+    tspans = "".join(
+        f'<tspan x="{_PADDING}" y="{_PADDING + (i + 1) * line_height}">'
+        f"{xml.sax.saxutils.escape(line)}</tspan>"
+        for i, line in enumerate(text[-rows:])
+    )
+    background = "#{:02x}{:02x}{:02x}".format(*_BACKGROUND)
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" '
+        f'viewBox="0 0 {width} {height}">'
+        f'<rect width="100%" height="100%" fill="{background}"/>'
+        f'<text font-family="monospace" font-size="{_FONT_SIZE}" '
+        f'fill="{_FOREGROUND}" xml:space="preserve">{tspans}</text>'
+        "</svg>"
+    ).encode()
+
+
+def make_placeholder_gif(width: int, height: int) -> bytes:
+    """
+    Make a GIF with a single frame of terminal's background color.
+
+    """
+
+    width = min(max(width, 1), 0xFFFF)
+    height = min(max(height, 1), 0xFFFF)
+
+    # LZW-compress a run of identical pixels. Every code stands for
+    # a run that is one pixel longer than the previous one, so this
+    # takes a couple of thousand codes even for large frames.
+    clear, end = 4, 5
+    codes: list[tuple[int, int]] = [(clear, 3)]
+    bits, next_code, longest = 3, 6, 1
+    left = width * height
+    while left:
+        n = min(longest, left)
+        codes.append((0 if n == 1 else n + 4, bits))
+        left -= n
+        if next_code >= 1 << bits and bits < 12:
+            bits += 1
+        if n == longest and left:
+            if next_code >= 4095:
+                codes.append((clear, bits))
+                bits, next_code, longest = 3, 6, 1
+            else:
+                next_code += 1
+                longest += 1
+    codes.append((end, bits))
+
+    stream = bytearray()
+    acc = acc_bits = 0
+    for code, size in codes:
+        acc |= code << acc_bits
+        acc_bits += size
+        while acc_bits >= 8:
+            stream.append(acc & 0xFF)
+            acc >>= 8
+            acc_bits -= 8
+    if acc_bits:
+        stream.append(acc)
+
+    out = bytearray(b"GIF89a")
+    out += width.to_bytes(2, "little") + height.to_bytes(2, "little")
+    out += bytes([0x81, 0, 0])
+    out += bytes(_BACKGROUND) + bytes(9)
+    out += b"\x2c" + bytes(4)
+    out += width.to_bytes(2, "little") + height.to_bytes(2, "little") + b"\x00"
+    out += b"\x02"
+    for i in range(0, len(stream), 255):
+        chunk = stream[i : i + 255]
+        out += bytes([len(chunk)]) + chunk
+    out += b"\x00\x3b"
+    return bytes(out)
+
+
+def make_placeholder(data: VhsData, format: str) -> pathlib.Path | None:
+    """
+    Generate a placeholder for a tape that was never rendered, or return
+    `None` if format doesn't support placeholders.
+
+    """
+
+    if format not in FORMATS:
+        return None
+    path = get_placeholder_file(data, format)
+    if path.exists():
+        return path
+    try:
+        lines = data.tape_file.read_text().splitlines()
+    except OSError:
+        lines = []
+    estimate = _estimate.estimate_tape(lines)
+    if format == "gif":
+        content = make_placeholder_gif(estimate.width, estimate.height)
+    else:
+        content = make_placeholder_svg(
+            estimate.width, estimate.height, transcript(lines)
+        )
+    with _cache.atomic_output(path) as tmp:
+        tmp.write_bytes(content)
+    return path
+
+
+def is_rendered(data: VhsData, render_key: _t.Mapping[str, _t.Any]) -> bool:
+    manifest = _cache.read_manifest(data.entry_dir)
+    return all(
+        _cache.is_fresh(manifest, format, render_key)
+        and data.get_render_file(format).exists()
+        for format in data.formats
+    )
+
+
+def prepare(
+    app: sphinx.application.Sphinx,
+    used_files: _t.Mapping[str, _t.Sequence[VhsData]],
+    render_key: _t.Mapping[str, _t.Any],
+) -> set[str]:
+    """
+    Find tapes that need rendering, and link placeholders in place
+    of their renders. Placeholder is the last good render of the same
+    directive, or a generated frame. Returns hashes of pending tapes.
+
+    """
+
+    index = load_index(app)
+    keys = get_directive_keys(
+        data for entries in used_files.values() for data in entries
+    )
+    pending: set[str] = set()
+    for tape_hash, entries in used_files.items():
+        if is_rendered(entries[0], render_key):
+            for data in entries:
+                index[keys[data]] = tape_hash
+            continue
+        pending.add(tape_hash)
+        pathlib.Path(entries[0].links_dir, tape_hash).mkdir(parents=True, exist_ok=True)
+        for data in entries:
+            previous = index.get(keys[data])
+            missing = False
+            for format in data.formats:
+                source: pathlib.Path | None = None
+                if previous is not None:
+                    source = pathlib.Path(data.cache_dir, previous, f"vhs.{format}")
+                    # Don't let cache clean-up remove it while it's in use.
+                    _cache.touch(source.parent)
+                if source is None or not source.exists():
+                    source = make_placeholder(data, format)
+                if source is not None:
+                    _link_placeholder(source, data.get_link_file(format))
+                else:
+                    data.get_link_file(format).unlink(missing_ok=True)
+                    missing = True
+            # Shown when none of directive's formats have a placeholder.
+            if missing and (svg := make_placeholder(data, "svg")) is not None:
+                _link_placeholder(svg, data.get_link_file("preview.svg"))
+    save_index(app, index)
+    return pending
+
+
+# Documents with placeholders are re-read on the next build, so that
+# they pick up finished renders in formats that have no placeholders.
+def get_outdated(
+    app: sphinx.application.Sphinx,
+    env: sphinx.environment.BuildEnvironment,
+    added: set[str],
+    changed: set[str],
+    removed: set[str],
+) -> list[str]:
+    docnames: set[str] = getattr(env, "vhs_preview_docnames", None) or set()
+    setattr(env, "vhs_preview_docnames", set())
+    return sorted(docnames & env.found_docs - removed)
+
+
+def _link_placeholder(source: pathlib.Path, dest: pathlib.Path):
+    # Placeholders are replaced by regular links once tapes are rendered.
+    dest.unlink(missing_ok=True)
+    try:
+        dest.symlink_to(source)
+    except (NotImplementedError, OSError):
+        dest.write_bytes(source.read_bytes())
+
+
+def _make_jobs(
+    pending: _t.Iterable[VhsData],
+    images: _t.Mapping[str, str],
+    images_dir: pathlib.Path | None,
+) -> list[dict[str, _t.Any]]:
+    jobs: dict[str, dict[str, _t.Any]] = {}
+    for data in pending:
+        job = jobs.setdefault(
+            data.tape_hash,
+            {
+                "entry_dir": str(data.entry_dir),
+                "formats": list(data.formats),
+                "publish": [],
+            },
+        )
+        if images_dir is None:
+            continue
+        for format in data.formats:
+            if (dest := images.get(str(data.get_link_file(format)))) is not None:
+                job["publish"].append([format, str(images_dir / dest)])
+    return list(jobs.values())
+
+
+# Runs before `_publish.publish_images`, which removes renders from builder's
+# list of images. Records where pending renders should be published.
+def collect_destinations(app: sphinx.application.Sphinx):
+    pending: list[VhsData] | None = getattr(app, "vhs_preview_pending", None)
+    images: dict[str, str] | None = getattr(app.builder, "images", None)
+    imagedir: str | None = getattr(app.builder, "imagedir", None)
+    if pending and images is not None and imagedir is not None:
+        jobs = _make_jobs(pending, images, pathlib.Path(app.builder.outdir, imagedir))
+        setattr(app, "vhs_preview_jobs", jobs)
+    return []
+
+
+def start_worker(app: sphinx.application.Sphinx, exception: BaseException | None):
+    """
+    Pass pending renders to a detached worker process. Runs after Sphinx
+    has copied all images, so that placeholders don't overwrite
+    finished renders.
+
+    """
+
+    pending: list[VhsData] = getattr(app, "vhs_preview_pending", None) or []
+    jobs: list[dict[str, _t.Any]] | None = getattr(app, "vhs_preview_jobs", None)
+    setattr(app, "vhs_preview_pending", None)
+    setattr(app, "vhs_preview_jobs", None)
+    queue: _render.RenderQueue | None = getattr(app, "vhs_render_queue", None)
+    if exception is not None or not pending or queue is None:
+        return
+    if jobs is None:
+        jobs = _make_jobs(pending, {}, None)
+
+    backend, render_key = queue.resolve()
+    timeouts = {data.tape_hash: queue.get_render_timeout(data) for data in pending}
+    for job in jobs:
+        job["timeout"] = timeouts[pathlib.Path(job["entry_dir"]).name]
+    job_file = pathlib.Path(app.doctreedir, f"vhs_preview.{time.time_ns()}.json")
+    _cache.atomic_write_text(
+        job_file,
+        json.dumps(
+            {
+                "version": _JOB_VERSION,
+                "backend": backend.to_json(),
+                "cwd": str(app.config["vhs_cwd"] or app.srcdir),
+                "render_key": render_key,
+                "jobs": jobs,
+            }
+        ),
+    )
+    env = None
+    if isinstance(backend, _backend.RemoteBackend) and backend.token:
+        # Token may come from conf.py, and it's not stored in the job file.
+        env = {**os.environ, _backend.TOKEN_ENV: backend.token}
+    spawn(job_file, pathlib.Path(app.doctreedir, _LOG_FILE), env)
+    _logger.info(
+        "rendering %s terminal GIFs in background, reload the page to see them",
+        len(jobs),
+        type="vhs",
+    )
+
+
+def spawn(
+    job_file: pathlib.Path,
+    log_file: pathlib.Path,
+    env: _t.Mapping[str, str] | None = None,
+):
+    with open(log_file, "ab") as log:
+        subprocess.Popen(
+            [sys.executable, "-c", _WORKER, str(job_file)],
+            stdin=subprocess.DEVNULL,
+            stdout=log,
+            stderr=log,
+            env=env,
+            start_new_session=True,
+            creationflags=getattr(subprocess, "DETACHED_PROCESS", 0),
+        )
+
+
+@contextlib.contextmanager
+def _lock(path: pathlib.Path) -> _t.Iterator[None]:
+    # Workers from consecutive builds wait for each other, so that a tape
+    # is never rendered twice. Locks are released when a worker dies.
+    with open(path, "a+b") as file:
+        if sys.platform == "win32":
+            import msvcrt
+
+            while True:
+                try:
+                    msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+        else:
+            import fcntl
+
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+        yield
+
+
+# Worker doesn't have Sphinx logging, it writes to its log file instead.
+def _log(msg: str):
+    sys.stderr.write(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] {msg}\n")
+    sys.stderr.flush()
+
+
+def run_job(job: _t.Mapping[str, _t.Any], backend: _backend.Backend):
+    """
+    Render tapes from a job file and publish renders to their destinations.
+
+    """
+
+    render_key: dict[str, _t.Any] = job["render_key"]
+    for entry in job["jobs"]:
+        entry_dir = pathlib.Path(entry["entry_dir"])
+        formats: list[str] = entry["formats"]
+        try:
+            with _lock(entry_dir / "preview.lock"):
+                manifest = _cache.read_manifest(entry_dir)
+                if not all(
+                    _cache.is_fresh(manifest, format, render_key)
+                    and (entry_dir / f"vhs.{format}").exists()
+                    for format in formats
+                ):
+                    _render_entry(
+                        backend, entry_dir, formats, render_key, entry["timeout"]
+                    )
+            for format, dest in entry["publish"]:
+                _publish.publish(
+                    entry_dir / f"vhs.{format}", pathlib.Path(dest), "copy"
+                )
+        except (OSError, vhs.VhsError) as e:
+            _log(f"failed to render {entry_dir / 'vhs.tape'}:\n{e}")
+            continue
+        _log(f"rendered {entry_dir / 'vhs.tape'}")
+
+
+def _render_entry(
+    backend: _backend.Backend,
+    entry_dir: pathlib.Path,
+    formats: list[str],
+    render_key: _t.Mapping[str, _t.Any],
+    timeout: float | None,
+):
+    tape_file = entry_dir / "vhs.tape"
+    started_at = time.monotonic()
+    with contextlib.ExitStack() as stack:
+        outputs = {
+            format: stack.enter_context(
+                _cache.atomic_output(entry_dir / f"vhs.{format}")
+            )
+            for format in formats
+        }
+        backend.render(tape_file, entry_dir.name, outputs, timeout)
+    duration = time.monotonic() - started_at
+    for format in formats:
+        _cache.update_manifest(entry_dir, format, render_key, duration)
+
+
+# Entry point of the worker process.
+def main(argv: list[str] | None = None) -> int:
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 1:
+        _log("usage: sphinx_vhs._preview.main <job file>")
+        return 2
+    job_file = pathlib.Path(argv[0])
+    try:
+        job = json.loads(job_file.read_text())
+    finally:
+        job_file.unlink(missing_ok=True)
+    if job.get("version") != _JOB_VERSION:
+        _log(f"unsupported job file version {job.get('version')}")
+        return 1
+    backend = _backend.from_json(job["backend"], _render.get_environ(), job["cwd"])
+    try:
+        run_job(job, backend)
+    finally:
+        backend.close()
+    return 0
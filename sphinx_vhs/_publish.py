@@ -0,0 +1,193 @@
+from __future__ import annotations
+
+import collections
+import errno
+import os
+import pathlib
+import shutil
+import sys
+import typing as _t
+from dataclasses import dataclass, field
+
+import sphinx.application
+from sphinx.util import logging
+
+from sphinx_vhs import _cache, _estimate
+
+_logger = logging.getLogger("sphinx-vhs")
+
+#: Publishing methods, in order of preference for ``"auto"`` mode.
+METHODS = ("reflink", "hardlink", "copy")
+
+# From `linux/fs.h`.
+_FICLONE = 0x40049409
+
+# Errors that mean that a method is not supported for the given files.
+_UNSUPPORTED = frozenset(
+    [
+        errno.EXDEV,
+        errno.EPERM,
+        errno.EINVAL,
+        errno.ENOTTY,
+        errno.EOPNOTSUPP,
+        errno.EMLINK,
+        getattr(errno, "ENOTSUP", errno.EOPNOTSUPP),
+    ]
+)
+
+
+@dataclass
+class PublishStats:
+    """
+    Result of publishing renders into the output directory.
+
+    """
+
+    #: Number of files published by every method, or found unchanged.
+    files: collections.Counter[str] = field(default_factory=collections.Counter)
+
+    #: Bytes that weren't written thanks to links and unchanged files.
+    saved_bytes: int = 0
+
+    #: Bytes that were copied.
+    copied_bytes: int = 0
+
+
+def reflink(source: pathlib.Path, dest: pathlib.Path):
+    """
+    Make a copy-on-write clone of `source`.
+
+    :raises OSError: if file system doesn't support cloning.
+
+    """
+
+    if sys.platform != "linux":
+        raise OSError(errno.EOPNOTSUPP, "reflinks are not supported")
+
+    import fcntl
+
+    with open(source, "rb") as src, open(dest, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+        except BaseException:
+            dest.unlink(missing_ok=True)
+            raise
+
+
+def is_unchanged(
+    source: os.stat_result, dest: pathlib.Path, hardlink: bool = True
+) -> bool:
+    """
+    Check that `dest` is a copy of `source`, or its hardlink if `hardlink`
+    is `True`. Rendered files are never changed in place, so size
+    and modification time are enough to detect copies.
+
+    """
+
+    try:
+        st = dest.stat()
+    except FileNotFoundError:
+        return False
+    if os.path.samestat(source, st):
+        return hardlink
+    return source.st_size == st.st_size and source.st_mtime_ns == st.st_mtime_ns
+
+
+def publish(source: pathlib.Path, dest: pathlib.Path, mode: str) -> str:
+    """
+    Publish `source` to `dest` using the given method, falling back to copying
+    if it's not supported. In ``"auto"`` mode, try all methods in order.
+    Returns the method that was used, or ``"unchanged"``.
+
+    Destination is replaced atomically, so that existing hardlinks never
+    get overwritten.
+
+    """
+
+    source = pathlib.Path(os.path.realpath(source))
+    st = source.stat()
+    methods = METHODS if mode == "auto" else (mode, "copy")
+    if is_unchanged(st, dest, hardlink="hardlink" in methods):
+        return "unchanged"
+
+    with _cache.atomic_output(dest) as tmp:
+        for method in methods:
+            try:
+                if method == "reflink":
+                    reflink(source, tmp)
+                elif method == "hardlink":
+                    os.link(source, tmp)
+                else:
+                    shutil.copyfile(source, tmp)
+            except OSError as e:
+                if method == "copy" or e.errno not in _UNSUPPORTED:
+                    raise
+                _logger.debug("can't %s %s: %s", method, source, e, type="vhs")
+                continue
+            if method != "hardlink":
+                os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+            return method
+    raise AssertionError("unreachable")
+
+
+def unlink_hardlinks(paths: _t.Iterable[pathlib.Path]):
+    """
+    Remove files that have other hardlinks, so that Sphinx doesn't
+    overwrite cached renders when it copies images.
+
+    """
+
+    for path in paths:
+        try:
+            if path.stat().st_nlink > 1:
+                path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+# Runs right before HTML builder copies images. Renders are published here,
+# and removed from builder's list of images so that Sphinx doesn't copy them again.
+def publish_images(app: sphinx.application.Sphinx):
+    builder = app.builder
+    images: dict[str, str] | None = getattr(builder, "images", None)
+    imagedir: str | None = getattr(builder, "imagedir", None)
+    if not images or imagedir is None:
+        return []
+
+    links_dir = os.path.join(_cache.get_links_dir(app.env), "")
+    renders = {src: dest for src, dest in images.items() if src.startswith(links_dir)}
+    if not renders:
+        return []
+    images_dir = pathlib.Path(builder.outdir, imagedir)
+
+    mode = app.config["vhs_publish"]
+    if mode == "copy":
+        unlink_hardlinks(images_dir / dest for dest in renders.values())
+        return []
+
+    images_dir.mkdir(parents=True, exist_ok=True)
+    stats = PublishStats()
+    for src, dest in renders.items():
+        try:
+            method = publish(pathlib.Path(src), images_dir / dest, mode)
+        except OSError as e:
+            _logger.warning(
+                "cannot publish %s: %s", src, e, type="vhs", subtype="publish"
+            )
+            continue
+        size = os.stat(src).st_size
+        stats.files[method] += 1
+        if method == "copy":
+            stats.copied_bytes += size
+        else:
+            stats.saved_bytes += size
+        del images[src]
+
+    _logger.info(
+        "published terminal GIFs: %s, saved %s",
+        ", ".join(f"{n} {method}" for method, n in sorted(stats.files.items())),
+        _estimate.format_size(stats.saved_bytes),
+        type="vhs",
+    )
+    setattr(app, "vhs_publish_stats", stats)
+    return []
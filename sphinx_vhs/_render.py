@@ -0,0 +1,827 @@
+from __future__ import annotations
+
+import collections
+import contextlib
+import dataclasses
+import heapq
+import itertools
+import os
+import pathlib
+import threading
+import time
+import typing as _t
+from dataclasses import dataclass
+from multiprocessing.pool import ThreadPool
+
+import sphinx.application
+import sphinx.errors
+import sphinx.util.parallel
+import vhs
+from sphinx.util import logging
+from sphinx.util.console import colorize, term_width_line
+
+from sphinx_vhs import _backend, _cache, _estimate, _resources
+
+if _t.TYPE_CHECKING:
+    from sphinx_vhs._data import VhsData
+
+_logger = logging.getLogger("sphinx-vhs")
+
+
+# Everything that affects renders, apart from tape contents and output format.
+# Renders made with a different key are considered stale. If VHS version
+# isn't known, renders made with any version match the key.
+def get_render_key(
+    app: sphinx.application.Sphinx,
+    version: str | None,
+    environ: _t.Mapping[str, str],
+) -> dict[str, str]:
+    srcdir = app.srcdir
+    cwd = pathlib.Path(app.config["vhs_cwd"] or srcdir).expanduser().resolve()
+    key = {
+        "vhs_version": version,
+        "vhs_repo": app.config["vhs_repo"],
+        # Relative to srcdir, so that renders can be reused across checkouts.
+        "cwd": pathlib.Path(os.path.relpath(cwd, srcdir)).as_posix(),
+        "inputs": _cache.fingerprint_env(environ, app.config["vhs_cache_env_vars"]),
+    }
+    return {name: value for name, value in key.items() if value is not None}
+
+
+def is_cached(
+    used_files: _t.Mapping[str, _t.Iterable[VhsData]],
+    render_key: _t.Mapping[str, str],
+) -> bool:
+    """
+    Check that every render is in the cache, and was made with the given key.
+
+    """
+
+    for entries in used_files.values():
+        manifest: dict[str, dict[str, _t.Any]] | None = None
+        for data in entries:
+            if manifest is None:
+                manifest = _cache.read_manifest(data.entry_dir)
+            for format in data.formats:
+                if not _cache.is_fresh(manifest, format, render_key):
+                    return False
+    return True
+
+
+def get_environ() -> dict[str, str]:
+    environ = os.environ.copy()
+    if "READTHEDOCS" in environ:
+        environ["VHS_NO_SANDBOX"] = "true"
+    return environ
+
+
+# Seconds between checks of free memory and load when renders are throttled.
+_THROTTLE_INTERVAL = 0.5
+
+# Seconds it takes a new render to allocate most of its memory. Until then,
+# its estimated memory is reserved.
+_WARMUP_SECONDS = 5.0
+
+# Renders are throttled when load per CPU is above this.
+_MAX_LOAD_PER_CPU = 2.0
+
+
+def get_n_jobs(app: sphinx.application.Sphinx) -> int | str | None:
+    if "READTHEDOCS" in os.environ:
+        return app.config["vhs_n_jobs_read_the_docs"]
+    else:
+        return app.config["vhs_n_jobs"]
+
+
+def get_render_memory(app: sphinx.application.Sphinx) -> int:
+    return app.config["vhs_render_memory"] or _estimate.DEFAULT.memory_bytes
+
+
+def get_parallel(app: sphinx.application.Sphinx) -> int:
+    n_jobs = get_n_jobs(app)
+    if n_jobs == "auto":
+        return _resources.get_adaptive_parallel(get_render_memory(app))[0]
+    elif isinstance(n_jobs, int) and n_jobs > 0:
+        return n_jobs
+    elif app.parallel > 1:
+        # Don't let `-j auto` start more renders than machine can handle.
+        adaptive = _resources.get_adaptive_parallel(get_render_memory(app))[0]
+        return min(app.parallel, adaptive)
+    else:
+        return 1
+
+
+def _estimate_tape_file(data: VhsData) -> _estimate.TapeEstimate:
+    try:
+        tape = data.tape_file.read_text()
+    except OSError:
+        tape = ""
+    return _estimate.estimate_tape(tape.splitlines())
+
+
+def merge_formats(entries: _t.Iterable[VhsData]) -> VhsData:
+    """
+    Merge directives that use the same tape into one that has all of their
+    formats, so that the tape is rendered by a single VHS run.
+
+    """
+
+    first, *rest = entries
+    formats = dict.fromkeys(first.formats)
+    for data in rest:
+        formats.update(dict.fromkeys(data.formats))
+    if len(formats) == len(first.formats):
+        return first
+    return dataclasses.replace(first, format=",".join(formats))
+
+
+def predict_makespan(costs: _t.Iterable[float], parallel: int) -> float:
+    """
+    Predict how long it will take to run jobs with the given costs
+    on `parallel` workers, assuming that longest jobs are scheduled first.
+
+    """
+
+    workers = [0.0] * max(parallel, 1)
+    for cost in sorted(costs, reverse=True):
+        heapq.heapreplace(workers, workers[0] + cost)
+    return max(workers)
+
+
+def format_duration(seconds: float) -> str:
+    if seconds < 60:
+        return f"{seconds:.1f}s"
+    minutes, seconds = divmod(round(seconds), 60)
+    return f"{minutes}m {seconds:02}s"
+
+
+@dataclass
+class RenderStats:
+    """
+    Telemetry for a single render job.
+
+    """
+
+    #: Whether the render was found in cache: ``"hit"``, ``"miss"``,
+    #: or ``"stale"`` if it was rendered with a different VHS version or settings.
+    cache: _t.Literal["hit", "stale", "miss"] = "miss"
+
+    #: Static estimate or last measured render time, used for scheduling.
+    cost: float = 0
+
+    #: Seconds between job submission and start.
+    queue_wait: float = 0
+
+    #: Seconds it took VHS to render the tape.
+    render_time: float = 0
+
+    #: Size of the rendered file.
+    output_bytes: int = 0
+
+    #: Estimated peak memory used by VHS.
+    memory: int = 0
+
+    #: Seconds the job waited for free memory or CPU before starting.
+    throttle_wait: float = 0
+
+    #: Number of times VHS was run, including retries.
+    attempts: int = 0
+
+    #: Error message, if rendering failed.
+    error: str | None = None
+
+
+@dataclass(eq=False)
+class _Job:
+    data: VhsData
+    cost: float
+    stats: RenderStats
+    submitted_at: float
+
+
+class RenderQueue:
+    """
+    Renders tapes in a background thread pool.
+
+    Jobs are deduplicated by tape hash and every single format, so tapes
+    can be submitted as soon as they're discovered, and then submitted again
+    once all documents are read. No format of a tape is rendered twice. VHS is resolved lazily, when the first job starts.
+
+    Every job has a cost, which is its last measured render time, or a static
+    estimate for tapes that were never rendered. Free workers always pick
+    the most expensive job, so that long tapes don't end up rendering alone
+    at the end of the build.
+
+    With ``vhs_n_jobs = "auto"``, number of workers is chosen based on
+    CPU quota and free memory, and every job waits until there's enough free
+    memory for it, and until load average drops below the CPU limit.
+    At least one job is always running.
+
+    Every VHS run has a timeout that depends on job's cost. On timeout,
+    VHS is killed along with all of its child processes, and the job
+    is retried. With `keep_going`, failed jobs don't stop other jobs,
+    and all failures are reported once all jobs are done.
+
+    Queue belongs to the process that created it. Sphinx's parallel readers
+    are forked from the main process, and they should not submit jobs;
+    instead, their tapes are submitted once all documents are read.
+
+    """
+
+    def __init__(
+        self,
+        app: sphinx.application.Sphinx,
+        resolve: _t.Callable[[], _backend.Backend | vhs.Vhs],
+        cached: _t.Mapping[str, _t.Any] | None = None,
+        probe: _t.Callable[[], str | None] | None = None,
+    ):
+        self._app = app
+        self._resolve = resolve
+        # VHS runner resolved by a previous build, see `_runner.get_cached`.
+        self._cached = cached
+        # Finds version of VHS without installing it, or returns `None`
+        # if there's no VHS. Used when there's no cached runner.
+        self._probe = probe
+        self._probed = False
+        self._probed_version: str | None = None
+        self._probe_lock = threading.Lock()
+        self._pid = os.getpid()
+        self._adaptive = get_n_jobs(app) == "auto"
+        self._render_memory: int | None = app.config["vhs_render_memory"]
+
+        #: CPU limit and free memory, if concurrency was chosen adaptively.
+        self.cpu_limit: float | None = None
+        self.available_memory: int | None = None
+
+        if self._adaptive:
+            self._parallel, self.cpu_limit, self.available_memory = (
+                _resources.get_adaptive_parallel(get_render_memory(app))
+            )
+        else:
+            self._parallel = get_parallel(app)
+        self._running = 0
+        self._warming: collections.deque[tuple[float, int]] = collections.deque()
+
+        self._cond = threading.Condition()
+        self._pool: ThreadPool | None = None
+        self._seq = itertools.count()
+        self._heap: list[tuple[float, int, _Job]] = []
+        self._pending = 0
+        self._errors: list[BaseException] = []
+        self._started_at: float | None = None
+        self._in_progress: collections.Counter[str] = collections.Counter()
+        self._total = 0
+        self._show_progress = False
+
+        self._timeout: float | None = app.config["vhs_timeout"]
+        self._timeout_scale: float = app.config["vhs_timeout_scale"]
+        self._retries: int = app.config["vhs_retries"]
+        self._keep_going: bool = app.config["vhs_keep_going"]
+
+        #: Telemetry for every submitted job, including cache hits, keyed
+        #: by tape hash and formats that the job covers.
+        self.stats: dict[tuple[str, str], RenderStats] = {}
+        # Telemetry for every tape hash and single format.
+        self._stats_by_format: dict[tuple[str, str], RenderStats] = {}
+        # Formats of every tape hash that are fresh, or rendered by a job.
+        self._covered: collections.defaultdict[str, set[str]] = collections.defaultdict(
+            set
+        )
+
+        #: Seconds spent resolving VHS.
+        self.resolve_time: float = 0
+
+        #: Predicted and actual makespan of the last `join`.
+        self.predicted_makespan: float = 0
+        self.makespan: float = 0
+
+        self._resolve_lock = threading.Lock()
+        self._resolve_thread: threading.Thread | None = None
+        self._backend: _backend.Backend | None = None
+        self._render_key: dict[str, str] | None = None
+        self._resolve_error: sphinx.errors.ExtensionError | None = None
+
+    @property
+    def is_owner(self) -> bool:
+        """
+        Whether jobs can be submitted from the current process.
+
+        """
+
+        return os.getpid() == self._pid
+
+    @property
+    def parallel(self) -> int:
+        return self._parallel
+
+    def resolve(self) -> tuple[_backend.Backend, dict[str, str]]:
+        """
+        Resolve render backend and current render key. This is done once,
+        subsequent calls return cached results.
+
+        """
+
+        with self._resolve_lock:
+            if self._resolve_error is not None:
+                raise self._resolve_error
+            if self._backend is None or self._render_key is None:
+                started_at = time.monotonic()
+                try:
+                    backend = self._resolve()
+                    if not isinstance(backend, _backend.Backend):
+                        backend = _backend.LocalBackend(backend)
+                    render_key = get_render_key(
+                        self._app, backend.get_version(), get_environ()
+                    )
+                except vhs.VhsError as e:
+                    self._resolve_error = sphinx.errors.ExtensionError(str(e))
+                    raise self._resolve_error from e
+                self._render_key = render_key
+                self._backend = backend
+                self.resolve_time = time.monotonic() - started_at
+            return self._backend, self._render_key
+
+    @property
+    def is_resolved(self) -> bool:
+        return self._render_key is not None
+
+    @property
+    def render_key(self) -> dict[str, str]:
+        """
+        Render key to check cached renders against, without resolving VHS.
+
+        Until VHS is resolved, its version is taken from the runner
+        that a previous build resolved. If there's no such runner, or if VHS
+        was updated since, VHS is looked up without installing it. Only if it
+        can't be found, renders made with any version are accepted. This way,
+        builds that only use cached renders don't need VHS.
+
+        """
+
+        if self._render_key is not None:
+            return self._render_key
+        if self._cached is not None:
+            version = self._cached["version"]
+        else:
+            version = self._get_probed_version()
+        return get_render_key(self._app, version, get_environ())
+
+    def _get_probed_version(self) -> str | None:
+        with self._probe_lock:
+            if not self._probed and self._probe is not None:
+                self._probed_version = self._probe()
+            self._probed = True
+            return self._probed_version
+
+    @property
+    def path(self) -> str | None:
+        """
+        Search path for binaries that come with VHS, see `_backend.Backend.path`.
+        Doesn't resolve VHS.
+
+        """
+
+        if self._backend is not None:
+            return self._backend.path
+        return None if self._cached is None else self._cached["path"]
+
+    def start_resolve(self):
+        """
+        Start resolving VHS in a background thread, so that it doesn't
+        delay rendering. Errors are re-raised by `resolve`.
+
+        """
+
+        if self._resolve_thread is not None or not self.is_owner:
+            return
+
+        def run():
+            try:
+                self.resolve()
+            except Exception:
+                # Reported when main thread calls `resolve`.
+                pass
+
+        self._resolve_thread = threading.Thread(
+            target=run, name="sphinx-vhs-resolve", daemon=True
+        )
+        self._resolve_thread.start()
+
+    def submit(self, data: VhsData):
+        """
+        Schedule a render. Formats that are fresh in cache, or that were
+        scheduled already, are left out, so every format of a tape is rendered
+        at most once. Use `merge_formats` to render all formats of a tape
+        with a single VHS run.
+
+        """
+
+        assert self.is_owner, "can't submit render jobs from a forked process"
+
+        with self._cond:
+            covered = self._covered[data.tape_hash]
+            formats = [format for format in data.formats if format not in covered]
+            covered.update(formats)
+        if not formats:
+            return
+        key = (data.tape_hash, ",".join(formats))
+
+        manifest = _cache.read_manifest(data.entry_dir)
+        stale = [
+            format
+            for format in formats
+            if not _cache.is_fresh(manifest, format, self.render_key)
+        ]
+        if not stale:
+            self._add_stats(
+                key,
+                RenderStats(
+                    cache="hit",
+                    output_bytes=sum(
+                        manifest[format].get("size", 0) for format in formats
+                    ),
+                ),
+            )
+            return
+        if stale != list(data.formats):
+            data = dataclasses.replace(data, format=",".join(stale))
+        cost = (
+            _cache.get_duration(manifest, data.formats[0]) or data.estimated_render_time
+        )
+        memory = self._render_memory or 0
+        if not cost or (self._adaptive and not memory):
+            estimate = _estimate_tape_file(data)
+            cost = cost or estimate.render_time
+            memory = memory or estimate.memory_bytes
+
+        job = _Job(data, cost, RenderStats(cost=cost, memory=memory), time.monotonic())
+        self._add_stats(key, job.stats)
+        with self._cond:
+            if self._pool is None:
+                self._pool = ThreadPool(self._parallel)
+            heapq.heappush(self._heap, (-cost, next(self._seq), job))
+            self._pending += 1
+            self._in_progress[data.origname] += 1
+            self._total += 1
+            # Each task picks the most expensive job that's left.
+            self._pool.apply_async(self._run_next)
+
+    def _add_stats(self, key: tuple[str, str], stats: RenderStats):
+        with self._cond:
+            self.stats[key] = stats
+            tape_hash, formats = key
+            for format in formats.split(","):
+                self._stats_by_format[tape_hash, format] = stats
+
+    def get_stats(self, data: VhsData) -> RenderStats:
+        """
+        Get telemetry of the job that rendered a directive's first format.
+
+        """
+
+        with self._cond:
+            stats = self._stats_by_format.get((data.tape_hash, data.formats[0]))
+        return stats or RenderStats()
+
+    def join(self):
+        """
+        Wait for all submitted renders to finish, reporting progress.
+
+        :raises sphinx.errors.ExtensionError: when rendering fails.
+
+        """
+
+        with self._cond:
+            left = self._pending
+            costs = [job.cost for _, _, job in self._heap]
+
+        predicted = predict_makespan(costs, self._parallel)
+        if left:
+            self._show_progress = True
+            if sphinx.util.parallel.parallel_available and self._parallel <= 1:
+                _logger.info(
+                    colorize(
+                        "yellow",
+                        "rendering terminal GIFs in sequence; pass -j auto to enable parallel run",
+                    ),
+                    type="vhs",
+                )
+            else:
+                _logger.info(
+                    "rendering terminal GIFs: %s files, parallel=%s, estimated time %s",
+                    left,
+                    self._parallel,
+                    format_duration(predicted),
+                    type="vhs",
+                )
+                if self.cpu_limit is not None:
+                    _logger.verbose(
+                        "chose parallel=%s for %.1f CPUs and %s of free memory",
+                        self._parallel,
+                        self.cpu_limit,
+                        "unknown"
+                        if self.available_memory is None
+                        else _estimate.format_size(self.available_memory),
+                        type="vhs",
+                    )
+                self._on_tape_done(None)
+
+        try:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: (
+                        not self._pending or bool(self._errors and not self._keep_going)
+                    )
+                )
+                if len(self._errors) > 1:
+                    raise sphinx.errors.ExtensionError(
+                        f"failed to render {len(self._errors)} tapes:\n\n"
+                        + "\n\n".join(map(str, self._errors))
+                    )
+                elif self._errors:
+                    raise self._errors[0]
+                started_at, self._started_at = self._started_at, None
+        finally:
+            if left:
+                self._show_progress = False
+                if not self._app.verbosity:
+                    _logger.info("")
+
+        self.predicted_makespan = predicted
+        self.makespan = 0
+        if left and started_at is not None:
+            self.makespan = time.monotonic() - started_at
+            _logger.info(
+                "rendered terminal GIFs in %s (estimated %s)",
+                format_duration(self.makespan),
+                format_duration(predicted),
+                type="vhs",
+            )
+
+    def shutdown(self):
+        """
+        Stop worker threads once all renders are done, so that no threads run
+        while Sphinx forks parallel writers. Workers are started again
+        if more renders are submitted.
+
+        """
+
+        with self._cond:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if self._resolve_thread is not None:
+            self._resolve_thread.join()
+
+    def close(self):
+        """
+        Stop all workers. Renders that are still running are abandoned.
+
+        """
+
+        with self._cond:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool = None
+            self._heap.clear()
+            self.stats.clear()
+            self._stats_by_format.clear()
+            self._covered.clear()
+        if self._backend is not None:
+            self._backend.close()
+
+    def get_timeout(self, cost: float) -> float | None:
+        """
+        Get timeout for a job with the given cost.
+
+        """
+
+        if self._timeout is None:
+            return None
+        return self._timeout + self._timeout_scale * cost
+
+    def get_render_timeout(self, data: VhsData) -> float | None:
+        """
+        Get timeout for rendering a tape outside of the queue. Its cost is
+        the last measured render time, or an estimate.
+
+        """
+
+        if self._timeout is None:
+            return None
+        manifest = _cache.read_manifest(data.entry_dir)
+        cost = (
+            _cache.get_duration(manifest, data.formats[0])
+            or data.estimated_render_time
+            or _estimate_tape_file(data).render_time
+        )
+        return self.get_timeout(cost)
+
+    def _on_tape_done(self, origname: str | None):
+        with self._cond:
+            if origname:
+                orignames_left = self._in_progress[origname] - 1
+                if orignames_left > 0:
+                    self._in_progress[origname] = orignames_left
+                else:
+                    self._in_progress.pop(origname, None)
+
+            if self._app.verbosity or not self._show_progress:
+                return
+
+            total = self._total
+            left = self._in_progress.total()
+            done = total - left
+            tape = f" {sorted(self._in_progress)[0]}" if self._in_progress else ""
+            if left > 1:
+                tape += f" +{left - 1} more"
+            _logger.info(
+                term_width_line(
+                    f"{colorize('bold', 'rendering terminal GIFs...')} [{done}/{total}]{colorize('teal', tape)}"
+                ),
+                nonl=True,
+            )
+
+    def _run_next(self):
+        with self._cond:
+            _, _, job = heapq.heappop(self._heap)
+            now = time.monotonic()
+            if self._started_at is None:
+                self._started_at = now
+            job.stats.queue_wait = now - job.submitted_at
+        self._admit(job)
+        try:
+            self._render(job.data, job.stats)
+        except BaseException as e:
+            with self._cond:
+                self._errors.append(e)
+        finally:
+            with self._cond:
+                self._running -= 1
+                self._pending -= 1
+                self._cond.notify_all()
+            self._on_tape_done(job.data.origname)
+
+    def _admit(self, job: _Job):
+        started_at = time.monotonic()
+        with self._cond:
+            if self._adaptive:
+                while self._running and not self._has_room(job.stats.memory):
+                    self._cond.wait(_THROTTLE_INTERVAL)
+                self._warming.append((time.monotonic(), job.stats.memory))
+            self._running += 1
+        job.stats.throttle_wait = time.monotonic() - started_at
+        if job.stats.throttle_wait >= _THROTTLE_INTERVAL:
+            _logger.debug(
+                "waited %s for resources to render %s",
+                format_duration(job.stats.throttle_wait),
+                job.data.tape_file,
+                type="vhs",
+            )
+
+    def _has_room(self, memory: int) -> bool:
+        # Renders that just started didn't allocate their memory yet.
+        now = time.monotonic()
+        while self._warming and now - self._warming[0][0] > _WARMUP_SECONDS:
+            self._warming.popleft()
+        reserved = sum(memory for _, memory in self._warming)
+
+        available = _resources.get_available_memory()
+        if available is not None and available - reserved < memory:
+            return False
+        load = _resources.get_load()
+        if (
+            load is not None
+            and self.cpu_limit is not None
+            and load > self.cpu_limit * _MAX_LOAD_PER_CPU
+        ):
+            return False
+        return True
+
+    def _render(self, data: VhsData, stats: RenderStats):
+        backend, render_key = self.resolve()
+        entry_dir = data.entry_dir
+        formats = data.formats
+        manifest = _cache.read_manifest(entry_dir)
+        stats.cache = _combine_lookups(
+            _cache.lookup(manifest, format, render_key) for format in formats
+        )
+        if stats.cache == "hit":
+            # Either rendered by a concurrent build that shares our cache,
+            # or submitted during read phase and didn't need rendering at all.
+            _logger.debug("already rendered %s", data.tape_file, type="vhs")
+            stats.output_bytes = sum(
+                manifest[format].get("size", 0) for format in formats
+            )
+            return
+        _logger.debug("rendering %s", data.tape_file, type="vhs")
+        timeout = self.get_timeout(stats.cost)
+        while True:
+            stats.attempts += 1
+            started_at = time.monotonic()
+            try:
+                with contextlib.ExitStack() as stack:
+                    outputs = {
+                        format: stack.enter_context(
+                            _cache.atomic_output(data.get_render_file(format))
+                        )
+                        for format in formats
+                    }
+                    backend.render(data.tape_file, data.tape_hash, outputs, timeout)
+                break
+            except vhs.VhsError as e:
+                if stats.attempts > self._retries or not _backend.is_transient(e):
+                    stats.error = str(e)
+                    path = self._app.env.doc2path(data.docname)
+                    raise sphinx.errors.ExtensionError(
+                        f"at {path}:{data.lineno}:\n{e}"
+                    ) from e
+                _logger.info(
+                    "retrying %s (attempt %s of %s): %s",
+                    data.tape_file,
+                    stats.attempts + 1,
+                    self._retries + 1,
+                    str(e).splitlines()[0],
+                    type="vhs",
+                )
+        duration = time.monotonic() - started_at
+        _logger.debug(
+            "rendered %s in %s", data.tape_file, format_duration(duration), type="vhs"
+        )
+        for format in formats:
+            _cache.update_manifest(entry_dir, format, render_key, duration)
+        stats.render_time = duration
+        stats.output_bytes = sum(
+            data.get_render_file(format).stat().st_size for format in formats
+        )
+
+
+class PlanEntry(_t.NamedTuple):
+    """
+    A single render that a build needs: a tape in a set of formats.
+
+    """
+
+    tape_hash: str
+    format: str
+
+    #: Cache status, see `RenderStats.cache`.
+    status: _t.Literal["hit", "stale", "miss"]
+
+    #: Recorded or estimated render time.
+    cost: float
+
+    #: Directives that use this render.
+    entries: _t.Sequence[VhsData]
+
+    def to_json(self) -> dict[str, _t.Any]:
+        return {
+            "tape_hash": self.tape_hash,
+            "format": self.format,
+            "status": self.status,
+            "cost": round(self.cost, 3),
+            "origname": self.entries[0].origname,
+            "locations": [f"{data.docname}:{data.lineno}" for data in self.entries],
+        }
+
+
+def make_plan(
+    used_files: _t.Mapping[str, _t.Sequence[VhsData]],
+    render_key: _t.Mapping[str, str],
+) -> list[PlanEntry]:
+    """
+    Check every tape against the render cache, most expensive renders first.
+
+    """
+
+    plan: list[PlanEntry] = []
+    for tape_hash, instances in used_files.items():
+        by_format: dict[str, list[VhsData]] = {}
+        for data in instances:
+            by_format.setdefault(data.format, []).append(data)
+        manifest = _cache.read_manifest(instances[0].entry_dir)
+        for format, entries in by_format.items():
+            data = entries[0]
+            status = _combine_lookups(
+                _cache.lookup(manifest, format, render_key) for format in data.formats
+            )
+            cost = (
+                _cache.get_duration(manifest, data.formats[0])
+                or data.estimated_render_time
+            )
+            plan.append(PlanEntry(tape_hash, format, status, cost, entries))
+    plan.sort(key=lambda entry: (-entry.cost, entry.tape_hash, entry.format))
+    return plan
+
+
+def _combine_lookups(
+    results: _t.Iterable[_t.Literal["hit", "stale", "miss"]],
+) -> _t.Literal["hit", "stale", "miss"]:
+    results = set(results)
+    if results == {"hit"}:
+        return "hit"
+    elif "stale" in results:
+        return "stale"
+    else:
+        return "miss"
@@ -0,0 +1,150 @@
+from __future__ import annotations
+
+import math
+import os
+import pathlib
+import sys
+
+_CGROUP_ROOT = pathlib.Path("/sys/fs/cgroup")
+_PROC_CGROUP = pathlib.Path("/proc/self/cgroup")
+_PROC_MEMINFO = pathlib.Path("/proc/meminfo")
+
+# Cgroup v1 reports "no limit" as a very large number rounded to page size.
+_UNLIMITED = 1 << 60
+
+
+def _cgroup_dirs(controller: str) -> list[pathlib.Path]:
+    """
+    Get cgroup directories of the current process for the given controller,
+    from its own group up to the root. Limits can be set on any of them.
+
+    """
+
+    try:
+        lines = _PROC_CGROUP.read_text().splitlines()
+    except OSError:
+        return []
+
+    v1: tuple[pathlib.Path, str] | None = None
+    v2: tuple[pathlib.Path, str] | None = None
+    for line in lines:
+        hierarchy, controllers, path = line.split(":", 2)
+        if hierarchy == "0" and not controllers:
+            v2 = _CGROUP_ROOT, path
+        elif controller in controllers.split(","):
+            v1 = _CGROUP_ROOT / controllers, path
+    # In hybrid mode, controllers are still in v1 hierarchies.
+    if (found := v1 or v2) is None:
+        return []
+
+    root, path = found
+    leaf = root / path.lstrip("/")
+    if not leaf.is_relative_to(root) or not leaf.is_dir():
+        # With cgroup namespaces, our group is mounted as the root.
+        return [root]
+    return [leaf, *(p for p in leaf.parents if p.is_relative_to(root))]
+
+
+def _read_int(path: pathlib.Path) -> int | None:
+    try:
+        text = path.read_text().strip()
+    except OSError:
+        return None
+    try:
+        return int(text)
+    except ValueError:
+        return None
+
+
+def get_cpu_count() -> int:
+    """
+    Number of CPUs that the current process can run on.
+
+    """
+
+    if sys.platform == "linux":
+        return len(os.sched_getaffinity(0)) or 1
+    return os.cpu_count() or 1
+
+
+def get_cpu_limit() -> float:
+    """
+    Number of CPUs that the current process can use, taking into account
+    cgroup CPU quota.
+
+    """
+
+    limit = float(get_cpu_count())
+    for path in _cgroup_dirs("cpu"):
+        if (cpu_max := path / "cpu.max").exists():
+            try:
+                quota, period = cpu_max.read_text().split()
+                if quota != "max" and int(period) > 0:
+                    limit = min(limit, int(quota) / int(period))
+            except (OSError, ValueError):
+                pass
+        else:
+            quota = _read_int(path / "cpu.cfs_quota_us")
+            period = _read_int(path / "cpu.cfs_period_us")
+            if quota is not None and quota > 0 and period:
+                limit = min(limit, quota / period)
+    return limit
+
+
+def get_available_memory() -> int | None:
+    """
+    Memory that can be allocated without swapping or hitting cgroup limit,
+    in bytes, or `None` if it can't be determined.
+
+    """
+
+    available: int | None = None
+    try:
+        with open(_PROC_MEMINFO) as file:
+            for line in file:
+                if line.startswith("MemAvailable:"):
+                    available = int(line.split()[1]) * 1024
+                    break
+    except (OSError, ValueError, IndexError):
+        pass
+
+    for path in _cgroup_dirs("memory"):
+        if (path / "memory.max").exists():
+            limit = _read_int(path / "memory.max")
+            usage = _read_int(path / "memory.current")
+        else:
+            limit = _read_int(path / "memory.limit_in_bytes")
+            usage = _read_int(path / "memory.usage_in_bytes")
+        if limit is None or limit >= _UNLIMITED or usage is None:
+            continue
+        left = max(limit - usage, 0)
+        available = left if available is None else min(available, left)
+
+    return available
+
+
+def get_load() -> float | None:
+    """
+    One-minute load average, or `None` if it's not available.
+
+    """
+
+    try:
+        return os.getloadavg()[0]
+    except (AttributeError, OSError):
+        return None
+
+
+def get_adaptive_parallel(memory_per_render: int) -> tuple[int, float, int | None]:
+    """
+    Choose number of concurrent renders based on CPU and memory limits.
+    Returns the number of renders, CPU limit and available memory.
+
+    """
+
+    cpus = get_cpu_limit()
+    memory = get_available_memory()
+    parallel = max(math.ceil(cpus), 1)
+    if memory is not None and memory_per_render > 0:
+        parallel = min(parallel, max(memory // memory_per_render, 1))
+    return parallel, cpus, memory
@@ -0,0 +1,171 @@
+from __future__ import annotations
+
+import json
+import os
+import pathlib
+import re
+import shutil
+import subprocess
+import threading
+import typing as _t
+
+import sphinx.application
+import vhs
+from sphinx.util import logging
+
+from sphinx_vhs import _cache
+
+_logger = logging.getLogger("sphinx-vhs")
+
+# Resolved runner is cached in doctree dir under this name.
+_RUNNER_FILE = "vhs_runner.json"
+
+# Bump this when the format of the runner file changes.
+_RUNNER_VERSION = 1
+
+# Binaries that VHS needs. Resolved runner is stale if any of them change.
+_BINARIES = ("ttyd", "ffmpeg")
+
+# VHS versions, keyed by binary path, modification time and size.
+_versions: dict[tuple[str, int, int], str] = {}
+_versions_lock = threading.Lock()
+
+
+def _stat(path: str | pathlib.Path | None) -> list[int] | None:
+    if path is None:
+        return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+def _version_key(runner: vhs.Vhs) -> tuple[str, int, int] | None:
+    if (stat := _stat(runner._vhs_path)) is None:
+        return None
+    return str(runner._vhs_path), stat[0], stat[1]
+
+
+def get_version(runner: vhs.Vhs) -> str:
+    """
+    Get version of VHS binary. Versions are cached for the lifetime
+    of the process, and invalidated when binary changes.
+
+    """
+
+    key = _version_key(runner)
+    if key is not None:
+        with _versions_lock:
+            if (version := _versions.get(key)) is not None:
+                return version
+
+    try:
+        output = subprocess.check_output([runner._vhs_path, "--version"]).decode()
+    except (subprocess.SubprocessError, OSError, UnicodeDecodeError):
+        _logger.debug("failed to get VHS version", exc_info=True, type="vhs")
+        return "unknown"
+    if match := re.search(r"\d+\.\d+\.\d+", output):
+        version = match.group()
+    else:
+        version = output.strip()
+
+    if key is not None:
+        with _versions_lock:
+            _versions[key] = version
+    return version
+
+
+def _get_binaries(runner: vhs.Vhs) -> dict[str, list[int] | None]:
+    paths = [str(runner._vhs_path)]
+    paths += [shutil.which(name, path=runner._path) or name for name in _BINARIES]
+    return {path: _stat(path) for path in paths}
+
+
+def _get_key(
+    app: sphinx.application.Sphinx, environ: _t.Mapping[str, str]
+) -> dict[str, _t.Any]:
+    install_location = app.config["vhs_auto_install_location"]
+    return {
+        "version": _RUNNER_VERSION,
+        "min_version": app.config["vhs_min_version"],
+        "max_version": app.config["vhs_max_version"],
+        "install": app.config["vhs_auto_install"],
+        "install_location": install_location and str(install_location),
+        "repo": app.config["vhs_repo"],
+        "path": environ.get("PATH", ""),
+    }
+
+
+def get_cached(
+    app: sphinx.application.Sphinx, environ: _t.Mapping[str, str]
+) -> dict[str, _t.Any] | None:
+    """
+    Get VHS runner resolved by a previous build, with its path, search path
+    and version, or `None` if configuration changed, or if VHS
+    or its dependencies were updated. Doesn't run anything.
+
+    """
+
+    try:
+        with open(pathlib.Path(app.doctreedir, _RUNNER_FILE)) as file:
+            record = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if (
+        isinstance(record, dict)
+        and record.get("key") == _get_key(app, environ)
+        and isinstance(binaries := record.get("binaries"), dict)
+        and all(_stat(binary) == stat for binary, stat in binaries.items())
+    ):
+        return record
+    return None
+
+
+def resolve(
+    app: sphinx.application.Sphinx,
+    resolve: _t.Callable[[], vhs.Vhs],
+    environ: dict[str, str],
+) -> vhs.Vhs:
+    """
+    Resolve VHS runner, reusing result from a previous build if configuration
+    didn't change, and VHS and its dependencies weren't updated.
+
+    Resolving VHS involves running its binaries to check their versions,
+    which takes a noticeable time on every build.
+
+    """
+
+    path = pathlib.Path(app.doctreedir, _RUNNER_FILE)
+    cwd = app.config["vhs_cwd"] or app.srcdir
+    if (record := get_cached(app, environ)) is not None:
+        _logger.debug("using cached VHS at %s", record["vhs_path"], type="vhs")
+        runner = vhs.Vhs(
+            _vhs_path=pathlib.Path(record["vhs_path"]),
+            _path=record["path"],
+            _env=environ,
+            _cwd=cwd,
+        )
+        if (version_key := _version_key(runner)) is not None:
+            with _versions_lock:
+                _versions[version_key] = record["version"]
+        return runner
+
+    runner = resolve()
+    if _stat(runner._vhs_path) is None:
+        # Not a real binary, nothing to cache.
+        return runner
+    binaries = _get_binaries(runner)
+    record = {
+        "key": _get_key(app, environ),
+        "vhs_path": str(runner._vhs_path),
+        "path": runner._path,
+        "version": get_version(runner),
+        "binaries": binaries,
+    }
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        _cache.atomic_write_text(path, json.dumps(record))
+    except OSError:
+        _logger.debug("failed to save resolved VHS", exc_info=True, type="vhs")
+    return runner
@@ -0,0 +1,206 @@
+from __future__ import annotations
+
+import heapq
+import os
+import pathlib
+import re
+import time
+import typing as _t
+
+import sphinx.application
+import sphinx.errors
+from sphinx.util import logging
+
+from sphinx_vhs import _cache, _publish, _render
+
+if _t.TYPE_CHECKING:
+    from sphinx_vhs._data import VhsData
+
+_logger = logging.getLogger("sphinx-vhs")
+
+_SHARD_RE = re.compile(r"^\s*(\d+)\s*/\s*(\d+)\s*$")
+
+
+def parse_shard(value: str) -> tuple[int, int]:
+    """
+    Parse shard spec like ``"3/8"``. Returns zero-based shard index
+    and number of shards.
+
+    :raises ~sphinx.errors.ConfigError: if spec is invalid.
+
+    """
+
+    match = _SHARD_RE.match(value)
+    if match is None or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise sphinx.errors.ConfigError(
+            f"invalid VHS shard {value!r}, expected a value like '3/8'"
+        )
+    return int(match.group(1)) - 1, int(match.group(2))
+
+
+def get_shard(app: sphinx.application.Sphinx) -> tuple[int, int] | None:
+    """
+    Get shard of the current build from `vhs_shard` or ``SPHINX_VHS_SHARD``
+    environment variable, or `None` if build is not sharded.
+
+    """
+
+    value = app.config["vhs_shard"] or os.environ.get("SPHINX_VHS_SHARD")
+    if not value:
+        return None
+    return parse_shard(value)
+
+
+def partition(
+    used_files: _t.Mapping[str, _t.Sequence[VhsData]], count: int
+) -> dict[str, int]:
+    """
+    Assign every tape to one of `count` shards, balancing their estimated
+    render times. All formats of a tape go to the same shard, so that
+    shards never write to the same cache entry.
+
+    Only static estimates are used: they depend on tape contents alone,
+    so every shard arrives at the same assignment regardless of what's
+    in its cache.
+
+    """
+
+    # All formats of a tape are rendered by a single VHS run.
+    costs = {
+        tape_hash: _render.merge_formats(entries).estimated_render_time
+        for tape_hash, entries in used_files.items()
+    }
+    loads = [(0.0, shard) for shard in range(count)]
+    assignment: dict[str, int] = {}
+    for tape_hash in sorted(
+        costs, key=lambda tape_hash: (-costs[tape_hash], tape_hash)
+    ):
+        load, shard = heapq.heappop(loads)
+        assignment[tape_hash] = shard
+        heapq.heappush(loads, (load + costs[tape_hash], shard))
+    return assignment
+
+
+def select(
+    app: sphinx.application.Sphinx,
+    used_files: _t.Mapping[str, _t.Sequence[VhsData]],
+) -> _t.Mapping[str, _t.Sequence[VhsData]]:
+    """
+    Get tapes that the current shard should render.
+
+    """
+
+    if (shard := get_shard(app)) is None:
+        return used_files
+    index, count = shard
+    assignment = partition(used_files, count)
+    selected = {
+        tape_hash: entries
+        for tape_hash, entries in used_files.items()
+        if assignment[tape_hash] == index
+    }
+    _logger.info(
+        "VHS shard %s/%s: %s of %s tapes",
+        index + 1,
+        count,
+        len(selected),
+        len(used_files),
+        type="vhs",
+    )
+    return selected
+
+
+def check_missing(
+    used_files: _t.Mapping[str, _t.Sequence[VhsData]],
+    render_key: _t.Mapping[str, str],
+):
+    """
+    Fail if any render is missing from the cache or is stale.
+
+    :raises ~sphinx.errors.ExtensionError: listing missing renders.
+
+    """
+
+    missing = [
+        entry
+        for entry in _render.make_plan(used_files, render_key)
+        if entry.status != "hit"
+    ]
+    if not missing:
+        return
+    lines = [
+        f"\n  {entry.entries[0].docname}:{entry.entries[0].lineno}:"
+        f" {entry.entries[0].origname} ({entry.format}, {entry.status})"
+        for entry in missing[:10]
+    ]
+    if len(missing) > 10:
+        lines.append(f"\n  ... and {len(missing) - 10} more")
+    raise sphinx.errors.ExtensionError(
+        f"{len(missing)} tapes are not rendered:{''.join(lines)}"
+    )
+
+
+def merge_entry(source: pathlib.Path, dest: pathlib.Path) -> bool:
+    """
+    Merge a cache entry from another cache. Renders that are missing in `dest`,
+    or that were made later in `source`, are published into `dest` along
+    with their manifest records. Returns `True` if `dest` changed.
+
+    """
+
+    theirs = _cache.read_manifest(source)
+    ours = _cache.read_manifest(dest)
+    records = {
+        format: record
+        for format, record in theirs.items()
+        if format not in ours
+        or record.get("rendered_at", 0) > ours[format].get("rendered_at", 0)
+    }
+    names = [
+        f"vhs.{format}" for format in records if (source / f"vhs.{format}").exists()
+    ]
+    if not names:
+        # Shards store tapes of all entries, but only render some of them.
+        return False
+    if not (dest / "vhs.tape").exists():
+        names.append("vhs.tape")
+
+    dest.mkdir(parents=True, exist_ok=True)
+    for name in names:
+        _publish.publish(source / name, dest / name, "auto")
+    _cache.merge_manifest(
+        dest,
+        {
+            format: record
+            for format, record in records.items()
+            if (dest / f"vhs.{format}").exists()
+        },
+    )
+    return True
+
+
+def merge_caches(dest: pathlib.Path, sources: _t.Iterable[pathlib.Path]) -> int:
+    """
+    Merge render caches of several shards into `dest`. Returns the number
+    of entries that changed.
+
+    """
+
+    changed: set[str] = set()
+    for source in sources:
+        with os.scandir(source) as entry_dirs:
+            for entry_dir in entry_dirs:
+                if entry_dir.name.startswith(".") or not entry_dir.is_dir(
+                    follow_symlinks=False
+                ):
+                    continue
+                if merge_entry(pathlib.Path(entry_dir.path), dest / entry_dir.name):
+                    changed.add(entry_dir.name)
+
+    if changed:
+        index = _cache.CacheIndex.load(dest)
+        now = time.time()
+        for tape_hash in changed:
+            index.mark_used(tape_hash, now, changed=True)
+        index.save()
+    return len(changed)
@@ -0,0 +1,253 @@
+from __future__ import annotations
+
+import base64
+import decimal
+import difflib
+import functools
+import hashlib
+import os
+import pathlib
+import re
+import typing as _t
+from dataclasses import dataclass
+
+_SOURCE_RE = re.compile(r"^\s*Source\s+['\"`]?(?P<path>.*?)['\"`]?\s*$", re.IGNORECASE)
+# Strips comments, keeping `#` inside of strings.
+_COMMAND_RE = re.compile(r'^((["\'`]).*?\2|[^"\'`#])*')
+
+# Number of parsed tape files kept in memory.
+_CACHE_SIZE = 4096
+
+# Quoted strings and other tokens of a command. VHS strings can't contain
+# their own quote character.
+_TOKEN_RE = re.compile(r'"[^"]*"|\'[^\']*\'|`[^`]*`|[^\s"\'`]+')
+_DURATION_RE = re.compile(r"^(?P<value>\d+(?:\.\d*)?|\.\d+)(?P<unit>ms|s|m)?$")
+_DURATION_UNITS = {"ms": 1, "s": 1000, "m": 60000}
+
+#: Commands that press a key, optionally several times.
+KEYS = frozenset(
+    [
+        "backspace",
+        "ctrl",
+        "alt",
+        "shift",
+        "down",
+        "enter",
+        "escape",
+        "home",
+        "end",
+        "insert",
+        "delete",
+        "left",
+        "pagedown",
+        "pageup",
+        "right",
+        "space",
+        "tab",
+        "up",
+    ]
+)
+
+# Commands that can be reordered when they come before any other commands.
+_SETTINGS = ("output", "require", "set", "env")
+
+
+@dataclass(frozen=True, slots=True)
+class Command:
+    """
+    A tape line without comments and surrounding whitespace.
+
+    """
+
+    text: str
+
+    #: Zero-based line number in the original file.
+    lineno: int
+
+
+@dataclass(frozen=True, slots=True)
+class Source:
+    """
+    A ``Source`` command that includes another tape.
+
+    """
+
+    #: Path as written in the tape.
+    path: str
+
+    #: Full text of the line, for error messages.
+    text: str
+
+    #: Zero-based line number in the original file.
+    lineno: int
+
+
+Node: _t.TypeAlias = Command | Source
+
+
+@dataclass(frozen=True, slots=True)
+class Tape:
+    """
+    Parsed tape. Empty lines and comments are dropped.
+
+    """
+
+    nodes: tuple[Node, ...]
+
+    @property
+    def sources(self) -> list[Source]:
+        return [node for node in self.nodes if isinstance(node, Source)]
+
+
+def parse(lines: _t.Iterable[str]) -> Tape:
+    """
+    Parse tape contents.
+
+    """
+
+    nodes: list[Node] = []
+    for i, line in enumerate(lines):
+        if match := _SOURCE_RE.match(line):
+            nodes.append(Source(match.group("path"), match.group(), i))
+        elif (match := _COMMAND_RE.match(line)) and (text := match.group().strip()):
+            nodes.append(Command(text, i))
+    return Tape(tuple(nodes))
+
+
+def parse_file(path: pathlib.Path) -> Tape:
+    """
+    Parse a tape file. Results are cached for the lifetime of the process,
+    and invalidated when file's modification time or size change.
+
+    :raises OSError: when the file can't be read.
+
+    """
+
+    stat = os.stat(path)
+    return _parse_file(path, stat.st_mtime_ns, stat.st_size)
+
+
+@functools.lru_cache(maxsize=_CACHE_SIZE)
+def _parse_file(path: pathlib.Path, mtime_ns: int, size: int) -> Tape:
+    with path.open() as file:
+        return parse(file.read().splitlines())
+
+
+def clear_cache():
+    _parse_file.cache_clear()
+
+
+def _canonical_duration(text: str) -> str:
+    match = _DURATION_RE.match(text)
+    if not match:
+        return text
+    ms = (
+        decimal.Decimal(match.group("value"))
+        * _DURATION_UNITS[match.group("unit") or "s"]
+    )
+    if ms == ms.to_integral_value():
+        return f"{int(ms)}ms"
+    return f"{ms.normalize():f}ms"
+
+
+def _canonical_string(token: str) -> str:
+    if token[:1] not in ('"', "'", "`"):
+        return token
+    text = token[1:-1]
+    for quote in "\"'`":
+        if quote not in text:
+            return f"{quote}{text}{quote}"
+    return token
+
+
+def canonicalize_command(text: str) -> str:
+    """
+    Canonical form of a single command: tokens are separated by single spaces,
+    strings are quoted with double quotes when possible, and durations
+    are in milliseconds. Contents of strings and regular expressions
+    are kept as is.
+
+    """
+
+    name, _, payload = text.strip().partition(" ")
+    if name.lower().startswith("wait") and payload.lstrip().startswith("/"):
+        # Regular expressions are matched as written, whitespace included.
+        name, at, speed = name.partition("@")
+        head = f"{name}@{_canonical_duration(speed)}" if at else name
+        return f"{head} {payload.strip()}"
+
+    tokens = _TOKEN_RE.findall(text)
+    if not tokens or _TOKEN_RE.sub("", text).strip() or "{" in text:
+        # Unterminated string that VHS will report, or JSON theme
+        # that is parsed differently.
+        return text
+    name, at, speed = tokens[0].partition("@")
+    args = tokens[1:]
+    command = name.lower()
+    if command == "sleep" and args:
+        args[0] = _canonical_duration(args[0])
+    elif command == "set" and len(args) == 2 and args[0].lower() == "typingspeed":
+        args[1] = _canonical_duration(args[1])
+    elif command in KEYS and args == ["1"]:
+        args = []
+    head = f"{name}@{_canonical_duration(speed)}" if at else name
+    return " ".join([head, *map(_canonical_string, args)])
+
+
+def _command_name(command: str) -> str:
+    return command.split(" ", 1)[0].split("@", 1)[0].lower()
+
+
+def canonicalize(lines: _t.Iterable[str]) -> list[str]:
+    """
+    Canonical form of a flattened tape, i.e. one that has comments removed
+    and includes resolved. Tapes that only differ in formatting, quoting,
+    units of durations, or order of settings at the top of the tape
+    have the same canonical form.
+
+    """
+
+    commands = [canonicalize_command(line) for line in lines]
+
+    # Settings at the top of the tape are applied before recording starts,
+    # so their order doesn't matter, and repeated settings override each other.
+    n = 0
+    while n < len(commands) and _command_name(commands[n]) in _SETTINGS:
+        n += 1
+    settings: dict[tuple[int, str, str], str] = {}
+    for command in commands[:n]:
+        name = _command_name(command)
+        args = command.split(" ", 2)[1:]
+        if name in ("set", "env") and args:
+            # Names of settings and environment variables are case-sensitive.
+            key = (_SETTINGS.index(name), name, args[0])
+        else:
+            key = (_SETTINGS.index(name), name, command)
+        settings.pop(key, None)
+        settings[key] = command
+    return [settings[key] for key in sorted(settings)] + commands[n:]
+
+
+def get_hash(lines: _t.Iterable[str]) -> str:
+    """
+    Hash of a flattened tape, used as its cache key. Hash is computed
+    from the tape's canonical form, so that cosmetic changes don't change it.
+
+    """
+
+    text = "\n".join(canonicalize(lines))
+    return base64.urlsafe_b64encode(hashlib.sha256(text.encode()).digest()).decode()
+
+
+def diff(old: _t.Iterable[str], new: _t.Iterable[str]) -> list[str]:
+    """
+    Explain why two flattened tapes render differently: returns a unified diff
+    of their canonical forms, or an empty list if they're equivalent.
+
+    """
+
+    return list(
+        difflib.unified_diff(
+            canonicalize(old), canonicalize(new), "old", "new", lineterm="", n=1
+        )
+    )
@@ -0,0 +1,187 @@
+from __future__ import annotations
+
+import collections
+import json
+import pathlib
+import time
+import typing as _t
+
+import sphinx.application
+from sphinx.util import logging
+
+from sphinx_vhs import _estimate, _optimize, _render
+
+if _t.TYPE_CHECKING:
+    from sphinx_vhs._data import VhsData
+
+_logger = logging.getLogger("sphinx-vhs")
+
+# Number of slowest tapes listed in build summary.
+_SUMMARY_SLOWEST = 10
+
+
+def get_report_path(app: sphinx.application.Sphinx) -> pathlib.Path | None:
+    report = app.config["vhs_report"]
+    if report is True:
+        return pathlib.Path(app.doctreedir, "vhs_report.jsonl")
+    elif report:
+        return pathlib.Path(app.srcdir, report).expanduser().resolve()
+    else:
+        return None
+
+
+def make_report(
+    queue: _render.RenderQueue,
+    used_files: _t.Mapping[str, _t.Iterable[VhsData]],
+    link_times: _t.Mapping[VhsData, float],
+    optimized: _t.Mapping[tuple[str, str], _optimize.OptimizeStats] = {},
+) -> tuple[dict[str, _t.Any], list[dict[str, _t.Any]]]:
+    """
+    Collect telemetry for the current build. Returns a build-level record,
+    and a list of records for every tape directive.
+
+    """
+
+    tapes: list[dict[str, _t.Any]] = []
+    for entries in used_files.values():
+        for data in entries:
+            format = data.format
+            stats = queue.get_stats(data)
+            opts = [
+                opt
+                for format in data.formats
+                if (opt := optimized.get((data.tape_hash, format))) is not None
+            ]
+            tapes.append(
+                {
+                    "type": "tape",
+                    "docname": data.docname,
+                    "lineno": data.lineno,
+                    "origname": data.origname,
+                    "tape_hash": data.tape_hash,
+                    "includes": list(data.includes),
+                    "format": format,
+                    "parse_time": data.parse_time,
+                    "estimated_render_time": data.estimated_render_time,
+                    "estimated_size": data.estimated_size,
+                    "cache": stats.cache,
+                    "cost": stats.cost,
+                    "queue_wait": stats.queue_wait,
+                    "render_time": stats.render_time,
+                    "attempts": stats.attempts,
+                    "memory": stats.memory,
+                    "throttle_wait": stats.throttle_wait,
+                    "output_bytes": stats.output_bytes,
+                    "optimize_time": sum(opt.time for opt in opts),
+                    "optimized_bytes": sum(
+                        opt.output_bytes for opt in opts if opt.output
+                    ),
+                    "link_time": link_times.get(data, 0),
+                }
+            )
+    tapes.sort(key=lambda tape: (tape["docname"], tape["lineno"]))
+
+    cache = collections.Counter(stats.cache for stats in queue.stats.values())
+    build: dict[str, _t.Any] = {
+        "type": "build",
+        "timestamp": time.time(),
+        "parallel": queue.parallel,
+        "cpu_limit": queue.cpu_limit,
+        "available_memory": queue.available_memory,
+        "tapes": len(tapes),
+        "renders": len(queue.stats),
+        "hits": cache["hit"],
+        "misses": cache["miss"],
+        "stale": cache["stale"],
+        "resolve_time": queue.resolve_time,
+        "predicted_makespan": queue.predicted_makespan,
+        "makespan": queue.makespan,
+        "render_time": sum(stats.render_time for stats in queue.stats.values()),
+        "throttle_wait": sum(stats.throttle_wait for stats in queue.stats.values()),
+        "retries": sum(max(stats.attempts - 1, 0) for stats in queue.stats.values()),
+        "output_bytes": sum(stats.output_bytes for stats in queue.stats.values()),
+        "optimize_time": sum(opt.time for opt in optimized.values()),
+        "optimized_bytes": sum(
+            opt.output_bytes for opt in optimized.values() if opt.output
+        ),
+        "parse_time": sum(tape["parse_time"] for tape in tapes),
+        "link_time": sum(link_times.values()),
+    }
+
+    return build, tapes
+
+
+def write_report(
+    path: pathlib.Path,
+    build: dict[str, _t.Any],
+    tapes: list[dict[str, _t.Any]],
+):
+    """
+    Write report in JSON-lines format: build-level record goes first,
+    followed by a record for every tape directive.
+
+    """
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as file:
+        for record in [build, *tapes]:
+            file.write(json.dumps(record))
+            file.write("\n")
+
+
+def log_summary(build: dict[str, _t.Any], tapes: list[dict[str, _t.Any]]):
+    fmt = _render.format_duration
+
+    _logger.info("terminal GIFs summary:", type="vhs")
+    _logger.info(
+        "  %s tapes, %s renders: %s cached, %s rendered, %s re-rendered",
+        build["tapes"],
+        build["renders"],
+        build["hits"],
+        build["misses"],
+        build["stale"],
+        type="vhs",
+    )
+    _logger.info(
+        "  parsing: %s, resolving VHS: %s, linking: %s",
+        fmt(build["parse_time"]),
+        fmt(build["resolve_time"]),
+        fmt(build["link_time"]),
+        type="vhs",
+    )
+    _logger.info(
+        "  rendering: %s (estimated %s, total %s, parallel=%s)",
+        fmt(build["makespan"]),
+        fmt(build["predicted_makespan"]),
+        fmt(build["render_time"]),
+        build["parallel"],
+        type="vhs",
+    )
+    _logger.info(
+        "  output size: %s", _estimate.format_size(build["output_bytes"]), type="vhs"
+    )
+    if build["optimized_bytes"]:
+        _logger.info(
+            "  optimized GIF and SVG size: %s (optimizing: %s)",
+            _estimate.format_size(build["optimized_bytes"]),
+            fmt(build["optimize_time"]),
+            type="vhs",
+        )
+
+    rendered: dict[tuple[str, str], dict[str, _t.Any]] = {}
+    for tape in tapes:
+        if tape["render_time"]:
+            rendered.setdefault((tape["tape_hash"], tape["format"]), tape)
+    slowest = sorted(rendered.values(), key=lambda tape: -tape["render_time"])
+    if slowest:
+        _logger.info("  slowest renders:", type="vhs")
+        for tape in slowest[:_SUMMARY_SLOWEST]:
+            _logger.info(
+                "    %8s  %s:%s  %s (%s)",
+                fmt(tape["render_time"]),
+                tape["docname"],
+                tape["lineno"],
+                tape["origname"],
+                _estimate.format_size(tape["output_bytes"]),
+                type="vhs",
+            )
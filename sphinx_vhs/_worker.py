@@ -0,0 +1,290 @@
+from __future__ import annotations
+
+import collections
+import concurrent.futures
+import contextlib
+import hmac
+import http.server
+import ipaddress
+import json
+import os
+import pathlib
+import re
+import socket
+import socketserver
+import sys
+import threading
+import time
+import typing as _t
+import urllib.parse
+
+import vhs
+
+from sphinx_vhs import _backend, _cache, _tape
+
+# Format names end up in file names, so only simple names are accepted.
+_FORMAT_RE = re.compile(r"^[a-z0-9]+$")
+
+# Largest accepted request body.
+_MAX_REQUEST_BYTES = 16 << 20
+
+
+class RenderWorker:
+    """
+    Renders tapes sent by remote builds, see `~sphinx_vhs._backend.RemoteBackend`.
+
+    VHS is resolved once, when the worker starts. Renders are kept
+    in a content-addressed cache, keyed by tape hash, so tapes that were
+    rendered for one build are served to all other builds. Requests for a tape
+    that is being rendered wait for that render instead of starting another one.
+
+    """
+
+    def __init__(self, backend: _backend.Backend, cache_dir: pathlib.Path, jobs: int):
+        self.backend = backend
+        self.cache_dir = cache_dir
+        self.version = backend.get_version()
+        self._render_key = {"vhs_version": self.version}
+        self._slots = threading.BoundedSemaphore(max(jobs, 1))
+        self._lock = threading.Lock()
+        self._in_flight: dict[
+            tuple[str, tuple[str, ...]], concurrent.futures.Future[None]
+        ] = {}
+
+        #: Number of requests that were rendered, found in cache,
+        #: or joined a render that was already running.
+        self.stats: collections.Counter[str] = collections.Counter()
+
+    def render(
+        self,
+        tape: str,
+        tape_hash: str,
+        formats: _t.Sequence[str],
+        timeout: float | None,
+    ) -> dict[str, pathlib.Path]:
+        """
+        Render a tape, or get it from cache. Returns rendered file
+        for every format.
+
+        :raises ValueError: if request is invalid.
+        :raises vhs.VhsError: if rendering fails.
+
+        """
+
+        if _tape.get_hash(tape.splitlines()) != tape_hash:
+            raise ValueError("tape doesn't match its hash")
+        if not formats or not all(map(_FORMAT_RE.match, formats)):
+            raise ValueError(f"invalid formats {formats!r}")
+
+        entry_dir = self.cache_dir / tape_hash
+        key = (tape_hash, tuple(formats))
+        with self._lock:
+            future = self._in_flight.get(key)
+            owner = future is None
+            if future is None:
+                future = self._in_flight[key] = concurrent.futures.Future()
+
+        if owner:
+            try:
+                self._render(entry_dir, tape, formats, timeout)
+            except BaseException as e:
+                future.set_exception(e)
+                raise
+            else:
+                future.set_result(None)
+            finally:
+                with self._lock:
+                    del self._in_flight[key]
+        else:
+            with self._lock:
+                self.stats["joined"] += 1
+            future.result()
+        return {format: entry_dir / f"vhs.{format}" for format in formats}
+
+    def _render(
+        self,
+        entry_dir: pathlib.Path,
+        tape: str,
+        formats: _t.Sequence[str],
+        timeout: float | None,
+    ):
+        manifest = _cache.read_manifest(entry_dir)
+        if all(
+            _cache.is_fresh(manifest, format, self._render_key)
+            and (entry_dir / f"vhs.{format}").exists()
+            for format in formats
+        ):
+            _cache.touch(entry_dir)
+            with self._lock:
+                self.stats["cached"] += 1
+            return
+
+        tape_file = entry_dir / "vhs.tape"
+        _cache.write_once(tape_file, tape)
+        with self._slots:
+            started_at = time.monotonic()
+            with contextlib.ExitStack() as stack:
+                outputs = {
+                    format: stack.enter_context(
+                        _cache.atomic_output(entry_dir / f"vhs.{format}")
+                    )
+                    for format in formats
+                }
+                self.backend.render(tape_file, entry_dir.name, outputs, timeout)
+            duration = time.monotonic() - started_at
+        for format in formats:
+            _cache.update_manifest(entry_dir, format, self._render_key, duration)
+        with self._lock:
+            self.stats["rendered"] += 1
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    @property
+    def worker(self) -> RenderWorker:
+        return _t.cast("_TCPServer | _UnixServer", self.server).worker
+
+    def do_GET(self):
+        if not self._authorize():
+            return
+        if self.path == "/version":
+            self._send_json(200, {"version": self.worker.version})
+        else:
+            self._send_json(404, {"error": f"not found: {self.path}"})
+
+    def do_POST(self):
+        if not self._authorize():
+            return
+        if self.path != "/render":
+            self._send_json(404, {"error": f"not found: {self.path}"})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            if not 0 < length <= _MAX_REQUEST_BYTES:
+                raise ValueError("invalid request size")
+            request = json.loads(self.rfile.read(length))
+            timeout = request.get("timeout")
+            files = self.worker.render(
+                str(request["tape"]),
+                str(request["hash"]),
+                [str(format) for format in request["formats"]],
+                None if timeout is None else float(timeout),
+            )
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            self._send_json(400, {"error": f"bad request: {e}"})
+            return
+        except _backend.RenderTimeoutError as e:
+            self._send_json(504, {"error": str(e)})
+            return
+        except (vhs.VhsError, OSError) as e:
+            self._send_json(500, {"error": str(e)})
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.end_headers()
+        _backend.send_files(self.wfile, files)
+
+    def _authorize(self) -> bool:
+        # Tapes run shell commands, so only clients that know the token
+        # may send them.
+        token = _t.cast("_TCPServer | _UnixServer", self.server).token
+        expected = f"Bearer {token}".encode()
+        given = self.headers.get("Authorization", "").encode()
+        if hmac.compare_digest(given, expected):
+            return True
+        # Drain the request, so that the client gets the response
+        # instead of a broken pipe.
+        with contextlib.suppress(ValueError, OSError):
+            length = int(self.headers.get("Content-Length", 0))
+            if 0 < length <= _MAX_REQUEST_BYTES:
+                self.rfile.read(length)
+        self.close_connection = True
+        self._send_json(401, {"error": "invalid or missing token"})
+        return False
+
+    def _send_json(self, status: int, data: _t.Any):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self) -> str:
+        # Unix sockets don't have client addresses.
+        if isinstance(self.client_address, tuple):
+            return str(self.client_address[0])
+        return "local"
+
+
+class _TCPServer(http.server.ThreadingHTTPServer):
+    def __init__(self, address: tuple[str, int], worker: RenderWorker, token: str):
+        self.worker = worker
+        self.token = token
+        super().__init__(address, _Handler)
+
+
+# Same as `socketserver.UnixStreamServer`, which is missing on some platforms.
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    address_family = getattr(socket, "AF_UNIX", socket.AF_INET)
+
+    def __init__(self, path: str, worker: RenderWorker, token: str):
+        self.worker = worker
+        self.token = token
+        super().__init__(path, _Handler)  # type: ignore
+
+
+def _is_loopback(host: str) -> bool:
+    try:
+        infos = socket.getaddrinfo(host, None)
+    except OSError:
+        return False
+    return all(
+        ipaddress.ip_address(str(info[4][0]).split("%", 1)[0]).is_loopback
+        for info in infos
+    )
+
+
+def make_server(
+    address: str, worker: RenderWorker, token: str, allow_remote: bool = False
+) -> _TCPServer | _UnixServer:
+    """
+    Create a server for the worker. Address is either ``host:port``,
+    or ``unix:/path/to/socket``. Clients must send the given token.
+
+    Anyone who can send tapes to the worker can run commands on its machine,
+    so addresses that aren't loopback are refused unless `allow_remote` is set.
+
+    :raises ValueError: if token is empty, or address is not allowed.
+
+    """
+
+    if not token:
+        raise ValueError("render worker requires a token")
+    if address.startswith("unix:"):
+        path = urllib.parse.urlsplit(address).path
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path)
+        return _UnixServer(path, worker, token)
+    host, _, port = address.removeprefix("http://").rpartition(":")
+    host = host.strip("[]") or "127.0.0.1"
+    if not allow_remote and not _is_loopback(host):
+        raise ValueError(
+            f"refusing to listen on {host}, which other machines can reach;"
+            " pass --allow-remote if this network is trusted"
+        )
+    return _TCPServer((host, int(port)), worker, token)
+
+
+def serve(address: str, worker: RenderWorker, token: str, allow_remote: bool = False):
+    server = make_server(address, worker, token, allow_remote)
+    sys.stderr.write(f"rendering tapes with VHS {worker.version} at {address}\n")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        worker.backend.close()
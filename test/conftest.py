@@ -1,10 +1,97 @@
+import os
 import pathlib
+import threading
+import time
+import typing as _t
 
 import pytest
+import vhs
+
+from sphinx_vhs import VhsData
 
 pytest_plugins = "sphinx.testing.fixtures"
 
 
+class FakeVhs:
+    # In-process fake VHS that writes a GIF header to every output.
+    _vhs_path = pathlib.Path("/nonexistent/vhs")
+
+    def __init__(self):
+        self.calls: list[pathlib.Path] = []
+        self.lock = threading.Lock()
+        #: Seconds that every run takes.
+        self.delay = 0.0
+        #: Most runs that were in progress at once.
+        self.max_running = 0
+        self._running = 0
+
+    def run(self, input_path: pathlib.Path, output_path: pathlib.Path | None = None):
+        with self.lock:
+            self.calls.append(input_path)
+            self._running += 1
+            self.max_running = max(self.max_running, self._running)
+        time.sleep(self.delay)
+        with self.lock:
+            self._running -= 1
+        if output_path is not None:
+            output_path.write_bytes(b"GIF89a")
+            return
+        for line in input_path.read_text().splitlines():
+            if line.startswith("Output "):
+                pathlib.Path(line[7:].strip("\"'`")).write_bytes(b"GIF89a")
+
+
 @pytest.fixture(scope="session")
 def rootdir():
     return pathlib.Path(__file__).parent / "roots"
+
+
+@pytest.fixture
+def fake_vhs(monkeypatch: pytest.MonkeyPatch) -> FakeVhs:
+    runner = FakeVhs()
+    monkeypatch.setattr(vhs, "resolve", lambda **kwargs: runner)
+    return runner
+
+
+@pytest.fixture
+def renders(monkeypatch: pytest.MonkeyPatch, tmp_path: pathlib.Path) -> pathlib.Path:
+    # Fake VHS that logs every tape it renders to the returned file.
+    renders = tmp_path / "renders.log"
+    binary = tmp_path / "vhs"
+    binary.write_text(
+        "#!/bin/sh\n"
+        'if [ "$1" = --version ]; then echo "vhs version v0.9.0"; exit 0; fi\n'
+        "for last; do :; done\n"
+        f'echo "$last" >> {renders}\n'
+        'if [ "$2" = -o ]; then printf rendered > "$3"; exit 0; fi\n'
+        'sed -n \'s/^Output "\\(.*\\)"$/\\1/p\' "$last" |'
+        ' while read -r f; do printf rendered > "$f"; done\n'
+    )
+    binary.chmod(0o755)
+    runner = vhs.Vhs(_vhs_path=binary, _path=os.environ["PATH"])
+    monkeypatch.setattr(vhs, "resolve", lambda **kwargs: runner)
+    monkeypatch.delenv("SPHINX_VHS_CACHE_DIR", raising=False)
+    monkeypatch.delenv("SPHINX_VHS_SHARD", raising=False)
+    monkeypatch.delenv("SPHINX_VHS_BACKEND", raising=False)
+    return renders
+
+
+@pytest.fixture
+def make_data(tmp_path: pathlib.Path) -> _t.Callable[..., VhsData]:
+    # Cache entry with a tape, for feeding render queues directly.
+    def make_data(tape_hash: str, docname: str = "index") -> VhsData:
+        entry = tmp_path / tape_hash
+        entry.mkdir(exist_ok=True)
+        (entry / "vhs.tape").write_text('Type "pwd"')
+        return VhsData(
+            docname=docname,
+            lineno=1,
+            tape_hash=tape_hash,
+            format="gif",
+            filename="vhs-a",
+            origname="a.tape",
+            cache_dir=str(tmp_path),
+            links_dir=str(tmp_path),
+        )
+
+    return make_data
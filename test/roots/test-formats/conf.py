@@ -0,0 +1,2 @@
+extensions = ["sphinx_vhs"]
+vhs_format = ["webm", "mp4"]
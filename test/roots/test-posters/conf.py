@@ -0,0 +1,3 @@
+extensions = ["sphinx_vhs"]
+vhs_format = "mp4"
+vhs_poster = "first"
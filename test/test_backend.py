@@ -0,0 +1,138 @@
+import pathlib
+import shutil
+import threading
+import typing as _t
+
+import pytest
+import vhs
+from sphinx.testing import util
+
+from sphinx_vhs import _backend, _tape, _worker
+
+TOKEN = "secret"
+
+
+@pytest.fixture
+def worker(
+    tmp_path: pathlib.Path, renders: pathlib.Path
+) -> _t.Iterator[tuple[_worker.RenderWorker, str]]:
+    worker = _worker.RenderWorker(
+        _backend.LocalBackend(vhs.resolve()), tmp_path / "worker", 2
+    )
+    url = f"unix:{tmp_path / 'worker.sock'}"
+    server = _worker.make_server(url, worker, TOKEN)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield worker, url
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+def test_remote_build(
+    make_app: _t.Callable[..., util.SphinxTestApp],
+    rootdir: pathlib.Path,
+    tmp_path: pathlib.Path,
+    renders: pathlib.Path,
+    worker: tuple[_worker.RenderWorker, str],
+):
+    render_worker, url = worker
+    srcdir = tmp_path / "src"
+    shutil.copytree(rootdir / "test-basics", srcdir)
+
+    for build in ["a", "b"]:
+        cache_dir = tmp_path / f"cache-{build}"
+        app = make_app(
+            "html",
+            srcdir=srcdir,
+            freshenv=True,
+            confoverrides={
+                "vhs_backend": url,
+                "vhs_backend_token": TOKEN,
+                "vhs_cache_dir": str(cache_dir),
+            },
+        )
+        app.build()
+        assert "[vhs" not in app.warning.getvalue()
+        rendered = [p for p in cache_dir.glob("*/vhs.*") if p.suffix != ".tape"]
+        assert len(rendered) == 4
+        assert all(path.read_text() == "rendered" for path in rendered)
+
+    # Second build gets renders from worker's cache.
+    assert len(renders.read_text().splitlines()) == 3
+    assert render_worker.stats["rendered"] == 3
+    assert render_worker.stats["cached"] == 3
+
+
+def test_remote_render(
+    tmp_path: pathlib.Path,
+    renders: pathlib.Path,
+    worker: tuple[_worker.RenderWorker, str],
+):
+    render_worker, url = worker
+    backend = _backend.RemoteBackend(url, TOKEN)
+    assert backend.get_version() == render_worker.version
+
+    text = 'Type "echo hi"\n'
+    tape_file = tmp_path / "vhs.tape"
+    tape_file.write_text(text)
+    tape_hash = _tape.get_hash(text.splitlines())
+
+    # Concurrent requests for the same tape are rendered once.
+    outputs = [
+        {format: tmp_path / f"{i}.{format}" for format in ["gif", "mp4"]}
+        for i in range(4)
+    ]
+    threads = [
+        threading.Thread(target=backend.render, args=(tape_file, tape_hash, o, 30))
+        for o in outputs
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(renders.read_text().splitlines()) == 1
+    for output in outputs:
+        for path in output.values():
+            assert path.read_text() == "rendered"
+
+    with pytest.raises(vhs.VhsError, match="doesn't match its hash"):
+        backend.render(tape_file, "x" + tape_hash[1:], {"gif": tmp_path / "x"}, 30)
+    with pytest.raises(vhs.VhsError, match="invalid formats"):
+        backend.render(tape_file, tape_hash, {"../gif": tmp_path / "x"}, 30)
+    backend.close()
+
+    with pytest.raises(vhs.VhsError, match="invalid render worker address"):
+        _backend.RemoteBackend("ftp://example.com", TOKEN)
+
+
+def test_worker_auth(
+    tmp_path: pathlib.Path,
+    renders: pathlib.Path,
+    worker: tuple[_worker.RenderWorker, str],
+):
+    render_worker, url = worker
+    text = 'Type "echo hi"\n'
+    tape_file = tmp_path / "vhs.tape"
+    tape_file.write_text(text)
+    tape_hash = _tape.get_hash(text.splitlines())
+
+    for token in [None, "wrong"]:
+        backend = _backend.RemoteBackend(url, token)
+        with pytest.raises(vhs.VhsError, match="rejected the token"):
+            backend.get_version()
+        with pytest.raises(vhs.VhsError, match="rejected the token"):
+            backend.render(tape_file, tape_hash, {"gif": tmp_path / "a.gif"}, 30)
+    # Nothing was rendered.
+    assert not renders.exists()
+
+    with pytest.raises(ValueError, match="requires a token"):
+        _worker.make_server(f"unix:{tmp_path / 'other.sock'}", render_worker, "")
+    # Only loopback addresses are allowed by default.
+    with pytest.raises(ValueError, match="refusing to listen on 0.0.0.0"):
+        _worker.make_server("0.0.0.0:0", render_worker, TOKEN)
+    for address, allow_remote in [("127.0.0.1:0", False), ("0.0.0.0:0", True)]:
+        server = _worker.make_server(address, render_worker, TOKEN, allow_remote)
+        server.server_close()
@@ -0,0 +1,17 @@
+import json
+import pathlib
+
+from bench import __main__ as bench
+
+
+def test_bench(tmp_path: pathlib.Path):
+    output = tmp_path / "results.json"
+    args = ["--tapes", "10", "--tapes-per-doc", "5", "--delay", "0", "--repeat", "1"]
+    assert bench.main([*args, "--workdir", str(tmp_path), "-o", str(output)]) == 0
+
+    results = json.loads(output.read_text())["tapes=10"]
+    assert results["renders"] == 10
+    assert results["edit_renders"] == 1
+
+    assert bench.compare({"a": {"build_time": 2}}, {"a": {"build_time": 1}}, 0.2)
+    assert not bench.compare({"a": {"renders": 2}}, {"a": {"renders": 1}}, 0.2)
@@ -0,0 +1,131 @@
+import json
+import pathlib
+import shutil
+
+import pytest
+
+from sphinx_vhs import _bundle, _cli
+
+
+@pytest.fixture
+def cache_dir(
+    rootdir: pathlib.Path, tmp_path: pathlib.Path, renders: pathlib.Path
+) -> pathlib.Path:
+    srcdir = tmp_path / "src"
+    shutil.copytree(rootdir / "test-basics", srcdir)
+    cache_dir = tmp_path / "cache"
+    assert _cli.main(["render", str(srcdir), "--cache-dir", str(cache_dir), "-q"]) == 0
+
+    # An entry that the project doesn't use.
+    unused = cache_dir / "unused"
+    shutil.copytree(next(cache_dir.glob("*/manifest.json")).parent, unused)
+    return cache_dir
+
+
+def test_export_import(
+    cache_dir: pathlib.Path,
+    tmp_path: pathlib.Path,
+    renders: pathlib.Path,
+    capsys: pytest.CaptureFixture[str],
+):
+    srcdir = tmp_path / "src"
+    bundle = tmp_path / "renders.bundle"
+    assert _cli.main(["export", str(cache_dir), str(bundle)]) == 0
+    assert "exported 4 entries" in capsys.readouterr().out
+
+    with open(bundle, "rb") as file:
+        index = _bundle.read_index(file)
+    assert set(index) == {p.parent.name for p in cache_dir.glob("*/manifest.json")}
+    for entry in index.values():
+        assert "vhs.tape" in entry["files"]
+        for record in entry["manifest"].values():
+            assert record["vhs_version"] == "0.9.0"
+
+    # Only entries that the project uses are imported.
+    restored = tmp_path / "restored"
+    args = [str(srcdir), str(bundle), "--cache-dir", str(restored)]
+    assert _cli.main(["import", *args]) == 0
+    out = capsys.readouterr().out
+    assert "imported 3 entries, 0 already in cache, 0 not in bundle" in out
+    assert not (restored / "unused").exists()
+    assert (restored / "index.json").exists()
+    for entry_dir in restored.glob("*/manifest.json"):
+        name = entry_dir.parent.name
+        for path in (cache_dir / name).iterdir():
+            assert (restored / name / path.name).read_bytes() == path.read_bytes()
+
+    assert _cli.main(["plan", str(srcdir), "--cache-dir", str(restored), "--json"]) == 0
+    plan = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [entry["status"] for entry in plan] == ["hit"] * 4
+    assert len(renders.read_text().splitlines()) == 3
+
+    # Importing again changes nothing.
+    assert _cli.main(["import", *args]) == 0
+    assert "imported 0 entries, 3 already in cache" in capsys.readouterr().out
+
+
+def test_corrupt_bundle(cache_dir: pathlib.Path, tmp_path: pathlib.Path):
+    bundle = tmp_path / "renders.bundle"
+    assert _bundle.export_bundle(cache_dir, bundle) == 4
+    with open(bundle, "rb") as file:
+        index = _bundle.read_index(file)
+
+    # Damage one render, its entry is skipped as a whole.
+    corrupt = next(h for h in sorted(index) if h != "unused")
+    info = index[corrupt]["files"]["vhs.gif"]
+    data = bytearray(bundle.read_bytes())
+    data[info["offset"]] ^= 0xFF
+    bundle.write_bytes(data)
+
+    restored = tmp_path / "restored"
+    stats = _bundle.import_bundle(bundle, restored, {corrupt, "unused", "other"})
+    assert stats.corrupt == [corrupt]
+    assert stats.imported == 1
+    assert stats.missing == 1
+    assert not list((restored / corrupt).iterdir())
+
+    bundle.write_bytes(data[:-1])
+    with pytest.raises(_bundle.BundleError, match="truncated"):
+        _bundle.import_bundle(bundle, restored)
+    bundle.write_bytes(b"not a bundle" * 10)
+    with pytest.raises(_bundle.BundleError, match="not a bundle"):
+        _bundle.import_bundle(bundle, restored)
+
+
+@pytest.mark.parametrize(
+    ("formats", "files"),
+    [
+        (["gif"], ["vhs.gif", "../../escaped"]),
+        (["gif"], ["vhs.gif", "vhs.webm"]),
+        (["../../escaped"], ["vhs.../../escaped"]),
+        (["gif/../../escaped"], ["vhs.gif/../../escaped"]),
+    ],
+)
+def test_malicious_bundle(
+    cache_dir: pathlib.Path,
+    tmp_path: pathlib.Path,
+    formats: list[str],
+    files: list[str],
+):
+    bundle = tmp_path / "renders.bundle"
+    _bundle.export_bundle(cache_dir, bundle, {"unused"})
+    data = bundle.read_bytes()
+    trailer = _bundle._TRAILER
+    index_offset, index_size, _ = trailer.unpack(data[-trailer.size :])
+    index = json.loads(data[index_offset : index_offset + index_size])
+    # Every file points at a valid render, only their names are crafted.
+    entry = index["entries"]["unused"]
+    record, info = entry["manifest"]["gif"], entry["files"]["vhs.gif"]
+    entry["manifest"] = {format: record for format in formats}
+    entry["files"] = {name: info for name in files}
+    index_data = json.dumps(index).encode()
+    bundle.write_bytes(
+        data[:index_offset]
+        + index_data
+        + trailer.pack(index_offset, len(index_data), _bundle._MAGIC)
+    )
+
+    restored = tmp_path / "restored" / "cache"
+    with pytest.raises(_bundle.BundleError, match="corrupt"):
+        _bundle.import_bundle(bundle, restored)
+    assert not (tmp_path / "restored").exists()
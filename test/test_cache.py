@@ -0,0 +1,222 @@
+import os
+import pathlib
+import shutil
+import time
+import typing as _t
+from datetime import timedelta
+
+import pytest
+import sphinx.errors
+import vhs
+from sphinx.testing import util
+
+from sphinx_vhs import _cache
+
+
+def make_entry(cache_dir: pathlib.Path, name: str, size: int, age: timedelta):
+    entry = cache_dir / name
+    entry.mkdir()
+    (entry / "vhs.gif").write_bytes(b"x" * size)
+    t = time.time() - age.total_seconds()
+    os.utime(entry, (t, t))
+    return entry
+
+
+def test_evict_by_age(tmp_path: pathlib.Path):
+    make_entry(tmp_path, "old", 10, timedelta(days=3))
+    make_entry(tmp_path, "old-pinned", 10, timedelta(days=3))
+    make_entry(tmp_path, "new", 10, timedelta(minutes=1))
+
+    _cache.evict(tmp_path, {"old-pinned"}, max_age=timedelta(days=1), max_size=None)
+
+    assert sorted(p.name for p in tmp_path.iterdir() if p.is_dir()) == [
+        "new",
+        "old-pinned",
+    ]
+
+
+def test_evict_by_size(tmp_path: pathlib.Path):
+    make_entry(tmp_path, "a", 100, timedelta(hours=5))
+    make_entry(tmp_path, "b", 100, timedelta(hours=4))
+    make_entry(tmp_path, "c", 100, timedelta(hours=3))
+    make_entry(tmp_path, "d", 100, timedelta(hours=2))
+    make_entry(tmp_path, "recent", 100, timedelta(minutes=1))
+
+    _cache.evict(tmp_path, {"b"}, max_age=None, max_size=300)
+
+    assert sorted(p.name for p in tmp_path.iterdir() if p.is_dir()) == [
+        "b",
+        "d",
+        "recent",
+    ]
+
+
+def test_index(tmp_path: pathlib.Path):
+    make_entry(tmp_path, "a", 100, timedelta(days=3))
+    index = _cache.CacheIndex.load(tmp_path)
+    assert index.total_size == 100
+    index.save()
+
+    # New entries are not picked up by a loaded index until re-scan.
+    make_entry(tmp_path, "b", 100, timedelta(days=3))
+    index = _cache.CacheIndex.load(tmp_path)
+    assert set(index.entries) == {"a"}
+    now = time.time()
+    index.mark_used("b", now)
+    assert index.total_size == 200
+    assert index.is_marked("b", now + 60)
+    assert not index.is_marked("b", now + 3600)
+    assert not index.is_marked("b", now + 60, max_age=timedelta(seconds=60))
+    assert not index.is_marked("c", now)
+
+    # Entry used by another build is kept, even if index says otherwise.
+    os.utime(tmp_path / "a")
+    _cache.collect_garbage(index, set(), max_age=timedelta(days=1), max_size=None)
+    index.save()
+    assert set(_cache.CacheIndex.load(tmp_path).entries) == {"a", "b"}
+    assert (tmp_path / "a").exists()
+
+
+def test_atomic_output(tmp_path: pathlib.Path):
+    dest = tmp_path / "vhs.gif"
+    with _cache.atomic_output(dest) as tmp:
+        assert tmp.suffix == ".gif"
+        tmp.write_text("data")
+        assert not dest.exists()
+    assert dest.read_text() == "data"
+    assert list(tmp_path.iterdir()) == [dest]
+
+    try:
+        with _cache.atomic_output(dest) as tmp:
+            tmp.write_text("broken")
+            raise RuntimeError()
+    except RuntimeError:
+        pass
+    assert dest.read_text() == "data"
+    assert list(tmp_path.iterdir()) == [dest]
+
+
+def test_manifest(tmp_path: pathlib.Path):
+    key = {"vhs_version": "0.9.0", "vhs_repo": "charmbracelet/vhs"}
+    assert not _cache.is_fresh(_cache.read_manifest(tmp_path), "gif", key)
+
+    (tmp_path / "vhs.gif").write_bytes(b"GIF89a")
+    _cache.update_manifest(tmp_path, "gif", key, duration=1.5)
+    manifest = _cache.read_manifest(tmp_path)
+    assert manifest["gif"]["size"] == 6
+    assert _cache.get_duration(manifest, "gif") == 1.5
+    assert _cache.get_duration(manifest, "mp4") == 1.5
+    assert _cache.is_fresh(manifest, "gif", key)
+    assert not _cache.is_fresh(manifest, "svg", key)
+    assert not _cache.is_fresh(manifest, "gif", {**key, "vhs_version": "0.10.0"})
+
+
+def test_fingerprint_env():
+    a = _cache.fingerprint_env({"VHS_X": "1", "HOME": "/a"}, ["VHS_*"])
+    b = _cache.fingerprint_env({"VHS_X": "1", "HOME": "/b"}, ["VHS_*"])
+    c = _cache.fingerprint_env({"VHS_X": "2", "HOME": "/a"}, ["VHS_*"])
+    assert a == b
+    assert a != c
+
+
+def test_write_once(tmp_path: pathlib.Path):
+    path = tmp_path / "entry" / "vhs.tape"
+    assert _cache.write_once(path, "Type 'a'")
+    os.utime(path.parent, (0, 0))
+    assert not _cache.write_once(path, "Type 'a'")
+    assert path.read_text() == "Type 'a'"
+    assert path.parent.stat().st_mtime == 0
+
+
+def test_cached_build_without_vhs(
+    make_app: _t.Callable[..., util.SphinxTestApp],
+    rootdir: pathlib.Path,
+    tmp_path: pathlib.Path,
+    renders: pathlib.Path,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    cache_dir = tmp_path / "cache"
+    for name in ["a", "b"]:
+        shutil.copytree(rootdir / "test-basics", tmp_path / name)
+    overrides = {"vhs_cache_dir": str(cache_dir)}
+    app = make_app("html", srcdir=tmp_path / "a", confoverrides=overrides)
+    app.build()
+    assert len(renders.read_text().splitlines()) == 3
+    images = sorted(p.name for p in pathlib.Path(app.outdir, "_images").iterdir())
+
+    # A fresh checkout that only uses cached renders doesn't need VHS.
+    def resolve(**kwargs: _t.Any):
+        raise vhs.VhsError("VHS is not installed")
+
+    monkeypatch.setattr(vhs, "resolve", resolve)
+    overrides["vhs_require_cache"] = True
+    app = make_app("html", srcdir=tmp_path / "b", confoverrides=overrides)
+    app.build()
+    assert "[vhs" not in app.warning.getvalue()
+    assert len(renders.read_text().splitlines()) == 3
+    assert sorted(p.name for p in pathlib.Path(app.outdir, "_images").iterdir()) == (
+        images
+    )
+
+    # VHS is resolved once something needs rendering.
+    (tmp_path / "b" / "index.rst").write_text(
+        ".. vhs-inline::\n\n   Type 'new'\n", encoding="utf-8"
+    )
+    overrides["vhs_require_cache"] = False
+    app = make_app("html", srcdir=tmp_path / "b", confoverrides=overrides)
+    with pytest.raises(sphinx.errors.ExtensionError, match="VHS is not installed"):
+        app.build()
+
+
+def test_vhs_upgrade(
+    make_app: _t.Callable[..., util.SphinxTestApp],
+    rootdir: pathlib.Path,
+    tmp_path: pathlib.Path,
+    renders: pathlib.Path,
+):
+    srcdir = tmp_path / "src"
+    shutil.copytree(rootdir / "test-basics", srcdir)
+    cache_dir = tmp_path / "cache"
+    overrides = {"vhs_cache_dir": str(cache_dir)}
+    app = make_app("html", srcdir=srcdir, confoverrides=overrides)
+    app.build()
+    assert len(renders.read_text().splitlines()) == 3
+
+    # Cached runner is stale, so VHS is looked up again before checking renders.
+    # With parallel reading, it's not resolved in background while reading.
+    binary = tmp_path / "vhs"
+    binary.write_text(binary.read_text().replace("0.9.0", "1.0.0"))
+    app = make_app("html", srcdir=srcdir, confoverrides=overrides, parallel=2)
+    app.build()
+    assert len(renders.read_text().splitlines()) == 6
+    for manifest in cache_dir.glob("*/manifest.json"):
+        for record in _cache.read_manifest(manifest.parent).values():
+            assert record["vhs_version"] == "1.0.0"
+
+
+def test_index_updated_incrementally(
+    make_app: _t.Callable[..., util.SphinxTestApp],
+    rootdir: pathlib.Path,
+    tmp_path: pathlib.Path,
+    renders: pathlib.Path,
+):
+    srcdir = tmp_path / "src"
+    shutil.copytree(rootdir / "test-basics", srcdir)
+    cache_dir = tmp_path / "cache"
+    overrides = {"vhs_cache_dir": str(cache_dir)}
+    make_app("html", srcdir=srcdir, confoverrides=overrides).build()
+    entries = [p.parent for p in cache_dir.glob("*/manifest.json")]
+    assert len(entries) == 3
+
+    # Entries that were marked recently are left alone.
+    for entry in entries:
+        os.utime(entry, (1000, 1000))
+    make_app("html", srcdir=srcdir, confoverrides=overrides).build()
+    assert all(entry.stat().st_mtime == 1000 for entry in entries)
+
+    # Entries that the index doesn't know about are marked again.
+    (cache_dir / "index.json").unlink()
+    make_app("html", srcdir=srcdir, confoverrides=overrides).build()
+    assert all(entry.stat().st_mtime > 1000 for entry in entries)
+    index = _cache.CacheIndex.load(cache_dir)
+    assert all(time.time() - index.entries[entry.name][0] < 60 for entry in entries)
@@ -0,0 +1,90 @@
+import json
+import pathlib
+import shutil
+
+import pytest
+import vhs
+
+from sphinx_vhs import _cli
+
+
+@pytest.fixture
+def srcdir(rootdir: pathlib.Path, tmp_path: pathlib.Path) -> pathlib.Path:
+    srcdir = tmp_path / "src"
+    shutil.copytree(rootdir / "test-basics", srcdir)
+    (srcdir / "_tapes" / "unused.tape").write_text('Type "unused"\n')
+    return srcdir
+
+
+def _plan(
+    srcdir: pathlib.Path, doctreedir: pathlib.Path, capsys: pytest.CaptureFixture[str]
+) -> list[dict[str, object]]:
+    assert _cli.main(["plan", str(srcdir), "-d", str(doctreedir), "--json"]) == 0
+    return [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+
+
+def test_plan_doesnt_install_vhs(
+    srcdir: pathlib.Path,
+    tmp_path: pathlib.Path,
+    monkeypatch: pytest.MonkeyPatch,
+    capsys: pytest.CaptureFixture[str],
+):
+    installs: list[bool] = []
+
+    def resolve(install: bool, **kwargs: object):
+        installs.append(install)
+        raise vhs.VhsError("vhs not found")
+
+    monkeypatch.setattr(vhs, "resolve", resolve)
+    plan = _plan(srcdir, tmp_path / "doctrees", capsys)
+    assert [entry["status"] for entry in plan] == ["miss"] * 4
+    assert installs == [False]
+
+
+def test_plan_and_render(
+    srcdir: pathlib.Path,
+    tmp_path: pathlib.Path,
+    renders: pathlib.Path,
+    capsys: pytest.CaptureFixture[str],
+):
+    doctreedir = tmp_path / "doctrees"
+
+    plan = _plan(srcdir, doctreedir, capsys)
+    assert [entry["status"] for entry in plan] == ["miss"] * 4
+    a_gif = next(e for e in plan if e["origname"] == "_tapes/a.tape")
+    assert a_gif["locations"] == ["index:7", "index:10", "index:17"]
+    # Reading documents only stores tapes.
+    assert not list(doctreedir.glob("vhs_tapes_cache/*/vhs.gif"))
+
+    assert _cli.main(["plan", str(srcdir), "-d", str(doctreedir)]) == 0
+    out = capsys.readouterr().out
+    assert "4 renders, 4 to render" in out
+    assert "not used by any document: _tapes/unused.tape" in out
+
+    assert _cli.main(["render", str(srcdir), "-d", str(doctreedir), "-q"]) == 0
+    assert capsys.readouterr().out == ""
+    assert len(renders.read_text().splitlines()) == 3
+
+    # Renders are where a real build with this doctree dir looks for them.
+    for entry in plan:
+        entry_dir = doctreedir / "vhs_tapes_cache" / str(entry["tape_hash"])
+        assert (entry_dir / f"vhs.{entry['format']}").read_text() == "rendered"
+    assert [entry["status"] for entry in _plan(srcdir, doctreedir, capsys)] == [
+        "hit"
+    ] * 4
+
+    assert _cli.main(["render", str(srcdir), "-d", str(doctreedir)]) == 0
+    assert "rendered 0 tapes, 3 found in cache" in capsys.readouterr().out
+    assert len(renders.read_text().splitlines()) == 3
+
+
+def test_cache_dir(
+    srcdir: pathlib.Path,
+    tmp_path: pathlib.Path,
+    renders: pathlib.Path,
+):
+    cache_dir = tmp_path / "cache"
+    args = ["render", str(srcdir), "-q", "-d", str(tmp_path / "doctrees")]
+    assert _cli.main([*args, "--cache-dir", str(cache_dir)]) == 0
+    assert len(list(cache_dir.glob("*/manifest.json"))) == 3
+    assert not (tmp_path / "doctrees").exists()
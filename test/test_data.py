@@ -0,0 +1,36 @@
+import pickle
+
+from sphinx_vhs._data import UsedFiles, VhsData
+
+
+def make_data(docname: str, tape_hash: str):
+    return VhsData(
+        docname=docname,
+        lineno=1,
+        tape_hash=tape_hash,
+        format="gif",
+        filename="vhs-inline",
+        origname="<inline>",
+        cache_dir="/cache",
+        links_dir="/links",
+    )
+
+
+def test_used_files():
+    used_files = UsedFiles([make_data("a", "x"), make_data("b", "x")])
+    used_files.add(make_data("b", "y"))
+    assert len(used_files) == 3
+    assert set(used_files.by_hash) == {"x", "y"}
+
+    used_files.purge("b")
+    assert [d.docname for d in used_files.get_hash("x")] == ["a"]
+    assert "y" not in used_files.by_hash
+
+    other = UsedFiles([make_data("a", "z"), make_data("c", "y")])
+    used_files.merge(other, ["c"])
+    assert sorted(used_files.by_hash) == ["x", "y"]
+
+    loaded = pickle.loads(pickle.dumps(used_files))
+    assert sorted(loaded.by_docname) == ["a", "c"]
+    assert loaded.get_hash("y")[0] is loaded.get_docname("c")[0]
+    assert loaded.get_hash("y")[0].render_file.as_posix() == "/cache/y/vhs.gif"
@@ -0,0 +1,49 @@
+import pytest
+
+from sphinx_vhs import _estimate
+
+
+@pytest.mark.parametrize(
+    ("text", "expected"),
+    [
+        ("500ms", 0.5),
+        ("1.5s", 1.5),
+        ("2", 2),
+        ("1m", 60),
+        ("abc", None),
+    ],
+)
+def test_parse_duration(text, expected):
+    assert _estimate.parse_duration(text) == expected
+
+
+def test_estimate_tape():
+    tape = [
+        "Set Width 800",
+        "Set Height 400",
+        "Set Framerate 20",
+        'Type "pwd"',
+        "Sleep 500ms",
+        "Enter",
+        "Hide",
+        "Sleep 5s",
+        "Show",
+        "Set TypingSpeed 100ms",
+        'Type@1s "ab"',
+        "Backspace 3",
+    ]
+    estimate = _estimate.estimate_tape(tape)
+    assert estimate.duration == pytest.approx(0.15 + 0.5 + 0.05 + 5 + 2 + 0.3)
+    assert estimate.visible_duration == pytest.approx(0.15 + 0.5 + 0.05 + 2 + 0.3)
+    assert (estimate.width, estimate.height) == (800, 400)
+    assert estimate.frames == 60
+    assert estimate.render_time > estimate.duration
+    assert estimate.output_bytes("gif") > estimate.output_bytes("webm") > 0
+
+
+def test_estimate_long_tape():
+    short = _estimate.estimate_tape(["Sleep 1s"])
+    long = _estimate.estimate_tape(["Sleep 30s"])
+    big = _estimate.estimate_tape(["Set Width 1920", "Set Height 1080", "Sleep 1s"])
+    assert long.render_time > short.render_time + 25
+    assert big.output_bytes("gif") > short.output_bytes("gif") * 2
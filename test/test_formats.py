@@ -0,0 +1,107 @@
+import pathlib
+
+import pytest
+from sphinx.testing import util
+
+from .conftest import FakeVhs
+from .test_sphinx_vhs import parse
+
+
+@pytest.mark.sphinx("html", testroot="formats")
+def test_formats(app: util.SphinxTestApp, fake_vhs: FakeVhs):
+
+    app.build()
+
+    # Every tape is rendered once, in all of its formats.
+    assert len(fake_vhs.calls) == 3
+
+    outdir = pathlib.Path(app.outdir)
+    images = sorted(p.suffix for p in (outdir / "_images").iterdir())
+    assert images == [".gif", ".gif", ".mp4", ".mp4", ".svg", ".webm", ".webm"]
+
+    etree = parse(outdir / "index.html")
+    videos = etree.findall(".//video")
+    assert len(videos) == 2
+    assert [source.attrib["type"] for source in videos[1].findall("source")] == [
+        "video/webm",
+        "video/mp4",
+    ]
+    assert videos[0].find("img") is None
+    fallback = videos[1].find("img")
+    assert fallback is not None
+    assert fallback.attrib["alt"] == "video"
+    assert fallback.attrib["src"].endswith(".gif")
+
+    picture = etree.find(".//picture")
+    assert picture is not None
+    source = picture.find("source")
+    assert source is not None
+    assert source.attrib["type"] == "image/svg+xml"
+    assert source.attrib["srcset"].endswith(".svg")
+    fallback = picture.find("img")
+    assert fallback is not None
+    assert fallback.attrib["src"].endswith(".gif")
+
+    for src in [
+        *(e.attrib["src"] for e in etree.iter("source") if "src" in e.attrib),
+        *(e.attrib["srcset"] for e in etree.iter("source") if "srcset" in e.attrib),
+        *(e.attrib["src"] for e in etree.iter("img")),
+    ]:
+        assert (outdir / src).exists()
+
+
+@pytest.mark.sphinx("html", testroot="posters")
+def test_posters(
+    app: util.SphinxTestApp,
+    fake_vhs: FakeVhs,
+    tmp_path: pathlib.Path,
+    recwarn: pytest.WarningsRecorder,
+):
+    ffmpeg = tmp_path / "ffmpeg"
+    ffmpeg.write_text('#!/bin/sh\nfor last; do :; done\necho "$*" > "$last"\n')
+    ffmpeg.chmod(0o755)
+    fake_vhs._path = str(tmp_path)  # type: ignore
+
+    app.build()
+
+    outdir = pathlib.Path(app.outdir)
+    etree = parse(outdir / "index.html")
+    default, custom, none = etree.findall(".//video")
+
+    assert default.attrib["preload"] == "metadata"
+    assert "autoplay" in default.attrib
+    poster = outdir / default.attrib["poster"]
+    assert "-frames:v 1" in poster.read_text()
+
+    assert custom.attrib["preload"] == "none"
+    assert "autoplay" not in custom.attrib
+    assert "data-vhs-autoplay" in custom.attrib
+    poster = outdir / custom.attrib["poster"]
+    assert "-sseof" in poster.read_text()
+    fallback = custom.find("img")
+    assert fallback is not None
+    assert fallback.attrib["loading"] == "lazy"
+
+    assert "poster" not in none.attrib
+    assert "autoplay" not in none.attrib
+    assert "data-vhs-autoplay" not in none.attrib
+
+    assert "IntersectionObserver" in (outdir / "index.html").read_text()
+    # Sphinx deprecates access to the app from transforms.
+    assert not [w for w in recwarn if "ProcessVhsNodes" in str(w.message)]
+
+
+@pytest.mark.sphinx(
+    "html", testroot="posters", confoverrides={"vhs_autoplay": "visible"}
+)
+def test_autoplay_config(app: util.SphinxTestApp, fake_vhs: FakeVhs):
+    app.build()
+
+    default, custom, none = parse(pathlib.Path(app.outdir, "index.html")).findall(
+        ".//video"
+    )
+    # Directive options override the config value.
+    for video in [default, custom]:
+        assert "autoplay" not in video.attrib
+        assert "data-vhs-autoplay" in video.attrib
+    assert "data-vhs-autoplay" not in none.attrib
@@ -0,0 +1,53 @@
+import pathlib
+import typing as _t
+
+import pytest
+from sphinx.testing import util
+
+import sphinx_vhs
+
+from .conftest import FakeVhs
+
+
+def build(make_app: _t.Callable[..., util.SphinxTestApp], srcdir: pathlib.Path):
+    app = make_app("html", srcdir=srcdir)
+    read: list[str] = []
+    app.connect(
+        "env-before-read-docs", lambda app, env, docnames: read.extend(docnames)
+    )
+    app.build()
+    return app, sorted(read)
+
+
+@pytest.mark.sphinx("html", testroot="includes")
+def test_includes(
+    app: util.SphinxTestApp,
+    make_app: _t.Callable[..., util.SphinxTestApp],
+    fake_vhs: FakeVhs,
+):
+    srcdir = pathlib.Path(app.srcdir)
+
+    app.build()
+    assert len(fake_vhs.calls) == 4
+
+    graph = sphinx_vhs.get_include_graph(app.env)
+    assert set(graph) == {"_tapes/a.tape", "_tapes/setup.tape", "_tapes/leaf.tape"}
+    assert {d for ds in graph["_tapes/setup.tape"].values() for d in ds} == {
+        "index",
+        "setup",
+    }
+    assert sphinx_vhs.get_include_dependents(app.env, "_tapes/leaf.tape") == {
+        "index",
+        "leaf",
+        "setup",
+    }
+
+    # Nothing changed, nothing is re-read.
+    _, read = build(make_app, srcdir)
+    assert read == []
+
+    # Only documents that include the changed file are re-read and re-rendered.
+    (srcdir / "_tapes/leaf.tape").write_text("Set FontSize 16\n")
+    _, read = build(make_app, srcdir)
+    assert read == ["index", "leaf", "setup"]
+    assert len(fake_vhs.calls) == 7
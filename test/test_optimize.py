@@ -0,0 +1,117 @@
+import xml.etree.ElementTree as ET
+
+from sphinx_vhs import _optimize
+
+_SVG = "{http://www.w3.org/2000/svg}"
+
+# 2-color global palette.
+_HEADER = b"GIF89a\x01\x00\x01\x00\x80\x00\x00" + b"\x00\x00\x00\xff\xff\xff"
+
+
+def make_frame(
+    delay: int, pixel: int, flags: int = 0x04, transparent: int = 0, left: int = 0
+) -> bytes:
+    gce = (
+        bytes([0x21, 0xF9, 0x04, flags])
+        + delay.to_bytes(2, "little")
+        + bytes([transparent, 0x00])
+    )
+    descriptor = b"\x2c" + left.to_bytes(2, "little") + b"\x00\x00\x01\x00\x01\x00\x00"
+    data = b"\x02\x02" + (b"\x44\x01" if pixel == 0 else b"\x4c\x01") + b"\x00"
+    return gce + descriptor + data
+
+
+def count_frames(gif: bytes) -> list[int]:
+    delays: list[int] = []
+    pos = gif.find(b"\x21\xf9\x04")
+    while pos != -1:
+        delays.append(int.from_bytes(gif[pos + 4 : pos + 6], "little"))
+        pos = gif.find(b"\x21\xf9\x04", pos + 1)
+    return delays
+
+
+def test_dedup_gif_frames():
+    gif = (
+        _HEADER
+        + make_frame(10, 0)
+        + make_frame(20, 0)
+        + make_frame(30, 1)
+        + make_frame(40, 0)
+        + make_frame(50, 0)
+        + b"\x3b"
+    )
+    result = _optimize.dedup_gif_frames(gif)
+    assert count_frames(result) == [30, 30, 90]
+    assert result.startswith(_HEADER)
+    assert result.endswith(b"\x3b")
+
+
+def test_dedup_gif_frames_draw_differently():
+    gif = (
+        _HEADER
+        + make_frame(10, 0)
+        # Restored to background after it's drawn.
+        + make_frame(20, 0, flags=0x08)
+        # Color 1 is transparent.
+        + make_frame(30, 0, flags=0x09, transparent=1)
+        + make_frame(40, 0, flags=0x09, transparent=0)
+        # Drawn at a different position.
+        + make_frame(50, 0, flags=0x09, left=1)
+        + make_frame(60, 0, flags=0x09, left=1)
+        + b"\x3b"
+    )
+    result = _optimize.dedup_gif_frames(gif)
+    assert count_frames(result) == [10, 20, 30, 40, 110]
+
+
+def test_optimize_svg():
+    frame = (
+        '<g class="frame"><rect width="10" height="10"/>'
+        + ('<text x="1"> $ echo  hi </text>' * 10)
+        + "</g>"
+    )
+    svg = (
+        '<svg xmlns="http://www.w3.org/2000/svg" width="10" height="10">\n'
+        f"  <!-- frames -->\n  {frame}\n  {frame}\n  <g id='x'/>\n</svg>"
+    ).encode()
+    result = _optimize.optimize_svg(svg).decode()
+    assert len(result) < len(svg)
+    assert "<!--" not in result
+    assert "> $ echo  hi </" in result
+    assert result.count('<g class="frame"><use href="#vhs-shared-0" /></g>') == 2
+    assert result.count('<g id="vhs-shared-0">') == 1
+    assert result.startswith('<svg xmlns="http://www.w3.org/2000/svg"')
+
+
+def test_optimize_svg_animation():
+    # Frames are shown one after another by a CSS animation that selects them
+    # by class, with a delay for each frame. Cursor is animated by its ID.
+    lines = '<text x="1"> $ echo hi </text>' * 10
+    frames = "".join(
+        f'<g class="frame" style="animation-delay: {i}s">{lines}</g>' for i in range(3)
+    )
+    svg = (
+        '<svg xmlns="http://www.w3.org/2000/svg">'
+        "<style>@keyframes show { from { opacity: 1 } to { opacity: 1 } }"
+        " .frame { opacity: 0; animation: show 1s step-end }"
+        " #cursor { animation: blink 1s infinite }</style>"
+        f'{frames}<g class="frame">{lines}<rect id="cursor"/></g></svg>'
+    ).encode()
+    root = ET.fromstring(_optimize.optimize_svg(svg))
+
+    # Frames keep their classes and delays, only their contents are shared.
+    groups = root.findall(f"{_SVG}g")
+    assert [g.get("class") for g in groups] == ["frame"] * 4
+    assert [g.get("style") for g in groups[:3]] == [
+        f"animation-delay: {i}s" for i in range(3)
+    ]
+    for group in groups[:3]:
+        assert [(use.tag, use.attrib) for use in group] == [
+            (f"{_SVG}use", {"href": "#vhs-shared-0"})
+        ]
+    [shared] = root.findall(f"{_SVG}defs/{_SVG}g")
+    assert shared.attrib == {"id": "vhs-shared-0"}
+    assert len(shared) == 10
+    # Contents with IDs are not shared, `<use>` instances don't match ID selectors.
+    assert groups[3].find(f"{_SVG}rect[@id='cursor']") is not None
+    assert groups[3].find(f"{_SVG}use") is None
@@ -0,0 +1,105 @@
+import json
+import pathlib
+
+import pytest
+from sphinx.testing import util
+
+from sphinx_vhs import _preview
+
+from .test_sphinx_vhs import parse
+
+
+def decode_gif_pixels(data: bytes) -> int:
+    # Minimal LZW decoder for a single-frame GIF, counts decoded pixels.
+    pos = 13 + 3 * (2 << (data[10] & 7)) + 10
+    min_size = data[pos]
+    pos += 1
+    stream = bytearray()
+    while size := data[pos]:
+        stream += data[pos + 1 : pos + 1 + size]
+        pos += 1 + size
+    bits = int.from_bytes(stream, "little")
+    clear, end = 1 << min_size, (1 << min_size) + 1
+    width = min_size + 1
+    table: list[bytes] = []
+    prev: bytes | None = None
+    offset = pixels = 0
+    while True:
+        code = (bits >> offset) & ((1 << width) - 1)
+        offset += width
+        if code == clear:
+            table = [bytes([i]) for i in range(clear)] + [b"", b""]
+            width = min_size + 1
+            prev = None
+            continue
+        if code == end:
+            return pixels
+        if code < len(table):
+            entry = table[code]
+        else:
+            assert prev is not None
+            assert code == len(table)
+            entry = prev + prev[:1]
+        if prev is not None:
+            table.append(prev + entry[:1])
+        pixels += len(entry)
+        prev = entry
+        if len(table) == 1 << width and width < 12:
+            width += 1
+
+
+@pytest.mark.parametrize("size", [(1, 1), (3, 7), (1200, 600), (4000, 3000)])
+def test_placeholder_gif(size: tuple[int, int]):
+    data = _preview.make_placeholder_gif(*size)
+    assert decode_gif_pixels(data) == size[0] * size[1]
+
+
+def test_transcript():
+    lines = ['Type "ls"', "Enter", "Hide", 'Type "secret"', "Show", 'Type@10ms "pwd"']
+    assert _preview.transcript(lines) == ["> ls", "> pwd"]
+
+
+@pytest.mark.sphinx(
+    "html", testroot="formats", srcdir="preview", confoverrides={"vhs_preview": True}
+)
+def test_preview(
+    app: util.SphinxTestApp,
+    monkeypatch: pytest.MonkeyPatch,
+    renders: pathlib.Path,
+):
+    jobs: list[pathlib.Path] = []
+    monkeypatch.setattr(_preview, "spawn", lambda job, log, env: jobs.append(job))
+
+    app.build()
+
+    # Build doesn't wait for renders.
+    assert len(jobs) == 1
+    assert not list(pathlib.Path(app.outdir).rglob("*.webm"))
+    # Worker's renders have the same timeouts as renders made during a build.
+    job = json.loads(jobs[0].read_text())
+    assert all(entry["timeout"] > 120 for entry in job["jobs"])
+
+    outdir = pathlib.Path(app.outdir)
+    etree = parse(outdir / "index.html")
+    default, video, picture = [outdir / img.attrib["src"] for img in etree.iter("img")]
+    assert etree.find(".//video") is None
+    # Videos without placeholders show the tape's text.
+    assert default.suffix == ".svg"
+    assert "echo default" in default.read_text()
+    # Images get placeholders under their final names.
+    assert video.suffix == ".gif"
+    assert video.read_bytes().startswith(b"GIF89a")
+    source = etree.find(".//picture/source")
+    assert source is not None
+    assert "echo picture" in (outdir / source.attrib["srcset"]).read_text()
+
+    # Worker publishes renders in place of placeholders.
+    assert _preview.main([str(jobs[0])]) == 0
+    assert video.read_text() == "rendered"
+    assert (outdir / source.attrib["srcset"]).read_text() == "rendered"
+
+    # Next build picks up rendered videos.
+    app.build()
+    assert len(jobs) == 1
+    etree = parse(outdir / "index.html")
+    assert len(etree.findall(".//video")) == 2
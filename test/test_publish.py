@@ -0,0 +1,52 @@
+import os
+import pathlib
+
+import pytest
+from sphinx.testing import util
+
+from sphinx_vhs import _publish
+
+from .conftest import FakeVhs
+
+
+def test_publish(tmp_path: pathlib.Path):
+    source = tmp_path / "cache" / "vhs.gif"
+    source.parent.mkdir()
+    source.write_bytes(b"GIF89a")
+    link = tmp_path / "link.gif"
+    link.symlink_to(source)
+    dest = tmp_path / "out" / "vhs-a.gif"
+    dest.parent.mkdir()
+
+    # Links are resolved, so that hardlinks point to cached renders.
+    assert _publish.publish(link, dest, "hardlink") == "hardlink"
+    assert os.path.samefile(source, dest)
+    assert _publish.publish(link, dest, "hardlink") == "unchanged"
+
+    # Hardlinks are replaced, not overwritten.
+    assert _publish.publish(link, dest, "copy") == "copy"
+    assert not os.path.samefile(source, dest)
+    assert dest.read_bytes() == source.read_bytes()
+    assert _publish.publish(link, dest, "copy") == "unchanged"
+
+    # Auto mode picks the first method that works.
+    dest.unlink()
+    assert _publish.publish(source, dest, "auto") in ("reflink", "hardlink")
+    assert dest.read_bytes() == b"GIF89a"
+    assert source.read_bytes() == b"GIF89a"
+
+
+@pytest.mark.sphinx(
+    "html",
+    testroot="includes",
+    srcdir="publish",
+    confoverrides={"vhs_publish": "hardlink"},
+)
+def test_publish_images(app: util.SphinxTestApp, fake_vhs: FakeVhs):
+    app.build()
+
+    stats: _publish.PublishStats = getattr(app, "vhs_publish_stats")
+    images = list(pathlib.Path(app.outdir, "_images").iterdir())
+    assert len(images) == stats.files["hardlink"] == 4
+    assert all(image.stat().st_nlink > 1 for image in images)
+    assert stats.saved_bytes == 4 * len(b"GIF89a")
@@ -0,0 +1,318 @@
+import dataclasses
+import os
+import pathlib
+import shutil
+import threading
+import time
+import typing as _t
+
+import pytest
+import sphinx.errors
+import vhs
+from sphinx.testing import util
+
+from sphinx_vhs import VhsData, _backend, _render
+
+from .conftest import FakeVhs
+
+
+@pytest.mark.sphinx("html", testroot="basics")
+def test_render_queue_dedup(
+    app: util.SphinxTestApp,
+    tmp_path: pathlib.Path,
+    fake_vhs: FakeVhs,
+    make_data: _t.Callable[..., VhsData],
+):
+    queue = _render.RenderQueue(app, lambda: fake_vhs)
+    try:
+        queue.submit(make_data("a"))
+        queue.submit(make_data("a", docname="other"))
+        queue.submit(make_data("b"))
+        queue.join()
+        # Workers are started again after a shutdown.
+        queue.shutdown()
+        queue.submit(make_data("c"))
+        queue.join()
+    finally:
+        queue.close()
+
+    assert sorted(p.parent.name for p in fake_vhs.calls) == ["a", "b", "c"]
+    assert (tmp_path / "a" / "vhs.gif").exists()
+    assert (tmp_path / "a" / "manifest.json").exists()
+
+    # Already rendered entries are skipped by a fresh queue.
+    queue = _render.RenderQueue(app, lambda: fake_vhs)
+    try:
+        queue.submit(make_data("a"))
+        queue.join()
+    finally:
+        queue.close()
+
+    assert len(fake_vhs.calls) == 3
+
+
+@pytest.mark.sphinx("html", testroot="basics")
+def test_render_queue_merges_formats(
+    app: util.SphinxTestApp,
+    tmp_path: pathlib.Path,
+    fake_vhs: FakeVhs,
+    make_data: _t.Callable[..., VhsData],
+):
+    gif = make_data("a")
+    gif_webm = dataclasses.replace(make_data("a"), format="gif,webm")
+    merged = _render.merge_formats([gif, gif_webm])
+    assert merged.formats == ("gif", "webm")
+    assert _render.merge_formats([gif_webm, gif]) is gif_webm
+
+    queue = _render.RenderQueue(app, lambda: fake_vhs)
+    try:
+        queue.submit(merged)
+        queue.submit(gif)
+        queue.submit(gif_webm)
+        # Only the format that isn't rendered yet gets a run of its own.
+        queue.submit(dataclasses.replace(gif, format="webm,mp4"))
+        queue.join()
+        assert queue.get_stats(gif) is queue.get_stats(gif_webm)
+        assert queue.get_stats(gif).cache == "miss"
+        jobs = sorted(queue.stats)
+    finally:
+        queue.close()
+
+    assert jobs == [("a", "gif,webm"), ("a", "mp4")]
+    assert len(fake_vhs.calls) == 2
+    for format in ["gif", "webm", "mp4"]:
+        assert (tmp_path / "a" / f"vhs.{format}").exists()
+
+
+def test_predict_makespan():
+    assert _render.predict_makespan([], 4) == 0
+    assert _render.predict_makespan([5, 1, 1, 1], 1) == 8
+    assert _render.predict_makespan([5, 3, 2, 2], 2) == 7
+    assert _render.predict_makespan([40, 1, 1, 1, 1, 1], 4) == 40
+
+
+def make_vhs(tmp_path: pathlib.Path, script: str) -> vhs.Vhs:
+    binary = tmp_path / "vhs"
+    binary.write_text(
+        "#!/bin/sh\n"
+        'if [ "$1" = --version ]; then echo "vhs version v0.9.0"; exit 0; fi\n'
+        f"cd {tmp_path}\n"
+        f"{script}\n"
+        'printf GIF89a > "$3"\n'
+    )
+    binary.chmod(0o755)
+    return vhs.Vhs(_vhs_path=binary, _path=os.environ.get("PATH", ""))
+
+
+@pytest.mark.sphinx(
+    "html",
+    testroot="basics",
+    confoverrides={"vhs_timeout": 0.5, "vhs_timeout_scale": 0},
+)
+def test_render_timeout(
+    app: util.SphinxTestApp,
+    tmp_path: pathlib.Path,
+    make_data: _t.Callable[..., VhsData],
+):
+    # First run hangs in a child process, second one succeeds.
+    runner = make_vhs(
+        tmp_path,
+        "echo >> attempts\n"
+        'if [ "$(wc -l < attempts)" -eq 1 ]; then sleep 30 & echo $! > pid; wait; fi',
+    )
+    queue = _render.RenderQueue(app, lambda: runner)
+    try:
+        queue.submit(make_data("a"))
+        queue.join()
+        stats = next(iter(queue.stats.values()))
+    finally:
+        queue.close()
+
+    assert (tmp_path / "a" / "vhs.gif").read_bytes() == b"GIF89a"
+    assert (tmp_path / "attempts").read_text() == "\n\n"
+    assert stats.attempts == 2
+    assert stats.render_time < 0.5
+
+    # Hung child was killed along with VHS.
+    pid = int((tmp_path / "pid").read_text())
+    for _ in range(50):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            break
+        time.sleep(0.1)
+    else:
+        pytest.fail("child process is still running")
+
+
+@pytest.mark.sphinx("html", testroot="basics", confoverrides={"vhs_retries": 2})
+def test_render_retries(
+    app: util.SphinxTestApp,
+    tmp_path: pathlib.Path,
+    make_data: _t.Callable[..., VhsData],
+):
+    # First run crashes, second one succeeds.
+    runner = make_vhs(
+        tmp_path,
+        "echo >> attempts\n"
+        'case "$3" in */bad*) echo "Error: parser: 1 error(s)" >&2; exit 1;; esac\n'
+        'if [ "$(wc -l < attempts)" -eq 1 ]; then echo "crashed" >&2; exit 1; fi',
+    )
+    queue = _render.RenderQueue(app, lambda: runner)
+    try:
+        queue.submit(make_data("ok"))
+        queue.join()
+        queue.submit(make_data("bad"))
+        with pytest.raises(sphinx.errors.ExtensionError, match="parser: 1 error"):
+            queue.join()
+        stats = {key[0]: s for key, s in queue.stats.items()}
+    finally:
+        queue.close()
+
+    assert stats["ok"].attempts == 2
+    # Errors in the tape are not retried.
+    assert stats["bad"].attempts == 1
+
+
+def test_is_transient():
+    def run_error(stderr: bytes) -> vhs.VhsRunError:
+        return vhs.VhsRunError(1, ["vhs"], b"", stderr)
+
+    assert _backend.is_transient(_backend.RenderTimeoutError("timed out"))
+    assert _backend.is_transient(run_error(b"could not open ttyd"))
+    assert _backend.is_transient(_backend.RenderFailedError("connection refused"))
+    assert not _backend.is_transient(run_error(b"Error: parser: 2 error(s)"))
+    assert not _backend.is_transient(
+        _backend.RenderFailedError("failed: VHS run failed\n\nparser: 1 error(s)")
+    )
+    assert not _backend.is_transient(vhs.VhsError("tape doesn't match its hash"))
+
+
+@pytest.mark.sphinx(
+    "html",
+    testroot="basics",
+    confoverrides={"vhs_retries": 0, "vhs_keep_going": True},
+)
+def test_render_keep_going(
+    app: util.SphinxTestApp,
+    tmp_path: pathlib.Path,
+    make_data: _t.Callable[..., VhsData],
+):
+    runner = make_vhs(
+        tmp_path, 'case "$3" in */fail*) echo "broken tape" >&2; exit 1;; esac'
+    )
+    queue = _render.RenderQueue(app, lambda: runner)
+    try:
+        queue.submit(make_data("fail-a"))
+        queue.submit(make_data("fail-b"))
+        queue.submit(make_data("ok"))
+        with pytest.raises(sphinx.errors.ExtensionError, match="render 2 tapes"):
+            queue.join()
+        errors = sorted(s.error is not None for s in queue.stats.values())
+    finally:
+        queue.close()
+
+    assert errors == [False, True, True]
+    assert (tmp_path / "ok" / "vhs.gif").exists()
+    assert not (tmp_path / "fail-a" / "vhs.gif").exists()
+
+
+@pytest.mark.parametrize("parallel", [1, 4])
+def test_pipeline(
+    make_app: _t.Callable[..., util.SphinxTestApp],
+    rootdir: pathlib.Path,
+    tmp_path: pathlib.Path,
+    renders: pathlib.Path,
+    parallel: int,
+):
+    srcdir = tmp_path / "src"
+    shutil.copytree(rootdir / "test-basics", srcdir)
+    # Sphinx reads in parallel only if there are enough documents.
+    for i in range(8):
+        (srcdir / f"doc{i}.rst").write_text(
+            f":orphan:\n\nDoc {i}\n=====\n\n.. vhs:: _tapes/a.tape\n\n"
+            f".. vhs-inline::\n\n   Type 'doc {i % 2}'\n"
+        )
+
+    app = make_app(
+        "html", srcdir=srcdir, parallel=parallel, confoverrides={"vhs_pipeline": True}
+    )
+    submitted_while_reading: list[int] = []
+    app.connect(
+        "env-updated",
+        lambda app, env: submitted_while_reading.append(
+            len(getattr(app, "vhs_render_queue").stats)
+        ),
+        priority=100,
+    )
+    # Nothing runs in background when Sphinx forks parallel writers.
+    workers_after_render: list[str] = []
+    app.connect(
+        "env-updated",
+        lambda app, env: workers_after_render.extend(
+            thread.name
+            for thread in threading.enumerate()
+            if thread.name.endswith("(worker)")
+            or thread.name == "sphinx-vhs-resolve"
+            or (parallel > 1 and thread.name == "sphinx-vhs-gc")
+        ),
+        priority=600,
+    )
+    app.build()
+
+    assert workers_after_render == []
+    if parallel > 1:
+        # Readers are forked, so nothing runs in background while they are read.
+        assert submitted_while_reading == [0]
+    else:
+        assert submitted_while_reading[0] > 0
+    # Every format of a tape is rendered once, and every document gets its
+    # renders. When reading serially, `a.tape` is queued as gif before `index`
+    # asks for it as mp4, so mp4 gets a run of its own.
+    assert len(renders.read_text().splitlines()) == (6 if parallel == 1 else 5)
+    for i in range(8):
+        html = pathlib.Path(app.outdir, f"doc{i}.html").read_text()
+        assert html.count("<img") == 2
+
+
+@pytest.mark.parametrize("parallel", [1, 4])
+def test_resolve_before_fork(
+    make_app: _t.Callable[..., util.SphinxTestApp],
+    rootdir: pathlib.Path,
+    tmp_path: pathlib.Path,
+    renders: pathlib.Path,
+    monkeypatch: pytest.MonkeyPatch,
+    parallel: int,
+):
+    events: list[str] = []
+    start_resolve = _render.RenderQueue.start_resolve
+
+    def record_start_resolve(self: _render.RenderQueue):
+        events.append("start_resolve")
+        start_resolve(self)
+
+    monkeypatch.setattr(_render.RenderQueue, "start_resolve", record_start_resolve)
+
+    srcdir = tmp_path / "src"
+    shutil.copytree(rootdir / "test-basics", srcdir)
+    for i in range(8):
+        (srcdir / f"doc{i}.rst").write_text(f":orphan:\n\nDoc {i}\n=====\n")
+
+    for build in ["a", "b"]:
+        if build == "b":
+            # Previous build had tapes, and there's a new one.
+            (srcdir / "doc0.rst").write_text(
+                ":orphan:\n\nDoc 0\n=====\n\n.. vhs-inline::\n\n   Type 'new'\n"
+            )
+        app = make_app("html", srcdir=srcdir, parallel=parallel)
+        app.connect("env-updated", lambda app, env: events.append("read"), priority=100)
+        events.clear()
+        app.build()
+        assert "[vhs" not in app.warning.getvalue()
+        read = events.index("read")
+        if parallel > 1:
+            # Readers are forked, so VHS is only resolved once they're done.
+            assert "start_resolve" not in events[:read]
+        else:
+            assert "start_resolve" in events[:read]
+    assert len(renders.read_text().splitlines()) == 4
@@ -0,0 +1,79 @@
+import pathlib
+import typing as _t
+
+import pytest
+from sphinx.testing import util
+
+from sphinx_vhs import VhsData, _render, _resources
+
+from .conftest import FakeVhs
+
+
+@pytest.fixture
+def cgroup(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch):
+    root = tmp_path / "cgroup"
+    group = root / "build.slice" / "docs"
+    group.mkdir(parents=True)
+    (tmp_path / "cgroup.txt").write_text("0::/build.slice/docs\n")
+    (tmp_path / "meminfo").write_text(
+        "MemTotal:       16777216 kB\nMemAvailable:    8388608 kB\n"
+    )
+    monkeypatch.setattr(_resources, "_CGROUP_ROOT", root)
+    monkeypatch.setattr(_resources, "_PROC_CGROUP", tmp_path / "cgroup.txt")
+    monkeypatch.setattr(_resources, "_PROC_MEMINFO", tmp_path / "meminfo")
+    monkeypatch.setattr(_resources, "get_cpu_count", lambda: 64)
+    return root
+
+
+def test_cgroup_v2_limits(cgroup: pathlib.Path):
+    assert _resources.get_cpu_limit() == 64
+    assert _resources.get_available_memory() == 8 << 30
+
+    # Limits are inherited from parent groups.
+    (cgroup / "build.slice" / "cpu.max").write_text("max 100000\n")
+    (cgroup / "build.slice" / "docs" / "cpu.max").write_text("250000 100000\n")
+    (cgroup / "build.slice" / "memory.max").write_text(f"{4 << 30}\n")
+    (cgroup / "build.slice" / "memory.current").write_text(f"{1 << 30}\n")
+    (cgroup / "build.slice" / "docs" / "memory.max").write_text("max\n")
+    (cgroup / "build.slice" / "docs" / "memory.current").write_text("0\n")
+    assert _resources.get_cpu_limit() == 2.5
+    assert _resources.get_available_memory() == 3 << 30
+
+    assert _resources.get_adaptive_parallel(512 << 20) == (3, 2.5, 3 << 30)
+    assert _resources.get_adaptive_parallel(2 << 30) == (1, 2.5, 3 << 30)
+
+
+@pytest.mark.sphinx(
+    "html",
+    testroot="basics",
+    confoverrides={"vhs_n_jobs": "auto", "vhs_render_memory": 1 << 30},
+)
+def test_adaptive_throttling(
+    app: util.SphinxTestApp,
+    monkeypatch: pytest.MonkeyPatch,
+    fake_vhs: FakeVhs,
+    make_data: _t.Callable[..., VhsData],
+):
+    monkeypatch.setattr(_resources, "get_cpu_limit", lambda: 4.0)
+    monkeypatch.setattr(_resources, "get_load", lambda: None)
+    monkeypatch.setattr(_render, "_THROTTLE_INTERVAL", 0.01)
+    memory = [8 << 30]
+    monkeypatch.setattr(_resources, "get_available_memory", lambda: memory[0])
+
+    fake_vhs.delay = 0.05
+    queue = _render.RenderQueue(app, lambda: fake_vhs)
+    assert queue.parallel == 4
+
+    # Only enough memory for a single render.
+    memory[0] = 1 << 30
+    try:
+        for name in "abcd":
+            queue.submit(make_data(name))
+        queue.join()
+        throttled = sum(s.throttle_wait > 0.01 for s in queue.stats.values())
+    finally:
+        queue.close()
+
+    assert len(fake_vhs.calls) == 4
+    assert fake_vhs.max_running == 1
+    assert throttled >= 3
@@ -0,0 +1,54 @@
+import pathlib
+
+import pytest
+import vhs
+from sphinx.testing import util
+
+from sphinx_vhs import _runner
+
+
+@pytest.mark.sphinx("html", testroot="basics")
+def test_resolve_cache(
+    app: util.SphinxTestApp,
+    tmp_path: pathlib.Path,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    log = tmp_path / "log"
+    binary = tmp_path / "vhs"
+    binary.write_text(f'#!/bin/sh\necho "$@" >> {log}\necho "vhs version v0.9.0"\n')
+    binary.chmod(0o755)
+    resolved: list[vhs.Vhs] = []
+
+    def resolve():
+        runner = vhs.Vhs(_vhs_path=binary, _path=str(tmp_path))
+        resolved.append(runner)
+        return runner
+
+    def run():
+        # Simulate a new process.
+        monkeypatch.setattr(_runner, "_versions", {})
+        runner = _runner.resolve(app, resolve, {"PATH": str(tmp_path)})
+        return runner, _runner.get_version(runner)
+
+    runner, version = run()
+    assert len(resolved) == 1
+    assert version == "0.9.0"
+    assert log.read_text() == "--version\n"
+
+    # Nothing changed, binary is not probed again.
+    runner, version = run()
+    assert len(resolved) == 1
+    assert runner._vhs_path == binary
+    assert runner._path == str(tmp_path)
+    assert version == "0.9.0"
+    assert log.read_text() == "--version\n"
+
+    # Binary changed.
+    binary.write_text(binary.read_text().replace("0.9.0", "0.10.0"))
+    runner, version = run()
+    assert len(resolved) == 2
+    assert version == "0.10.0"
+
+    # Environment changed.
+    _runner.resolve(app, resolve, {"PATH": "/usr/bin"})
+    assert len(resolved) == 3
@@ -0,0 +1,100 @@
+import json
+import pathlib
+import shutil
+
+import pytest
+import sphinx.errors
+from sphinx.testing import util
+
+from sphinx_vhs import _cli, _shard
+from sphinx_vhs._data import VhsData
+
+
+def make_data(tape_hash: str, cost: float, format: str = "gif"):
+    return VhsData(
+        docname="index",
+        lineno=1,
+        tape_hash=tape_hash,
+        format=format,
+        filename="vhs-inline",
+        origname="<inline>",
+        cache_dir="/cache",
+        links_dir="/links",
+        estimated_render_time=cost,
+    )
+
+
+def test_parse_shard():
+    assert _shard.parse_shard("3/8") == (2, 8)
+    assert _shard.parse_shard(" 1 / 1 ") == (0, 1)
+    for value in ["0/8", "9/8", "3", "a/b", "-1/2"]:
+        with pytest.raises(sphinx.errors.ConfigError):
+            _shard.parse_shard(value)
+
+
+def test_partition():
+    costs = [10, 9, 8, 7, 6, 5, 4, 3, 2, 1]
+    used_files = {f"h{cost}": [make_data(f"h{cost}", cost)] for cost in costs}
+    # All formats of the same tape are rendered at once, and counted once.
+    used_files["h10"].append(make_data("h10", 10, "mp4"))
+    used_files["h10"].append(make_data("h10", 10, "gif,webm"))
+
+    assignment = _shard.partition(used_files, 3)
+    assert set(assignment) == set(used_files)
+    loads = [0.0] * 3
+    for tape_hash, shard in assignment.items():
+        loads[shard] += used_files[tape_hash][0].estimated_render_time
+    assert max(loads) - min(loads) <= 1
+
+    # Assignment doesn't depend on order of tapes.
+    reordered = dict(reversed(list(used_files.items())))
+    assert _shard.partition(reordered, 3) == assignment
+
+
+def test_shard_and_merge(
+    rootdir: pathlib.Path,
+    tmp_path: pathlib.Path,
+    renders: pathlib.Path,
+    capsys: pytest.CaptureFixture[str],
+):
+    srcdir = tmp_path / "src"
+    shutil.copytree(rootdir / "test-basics", srcdir)
+
+    for shard in ["1/2", "2/2"]:
+        cache_dir = tmp_path / f"shard{shard[0]}"
+        args = ["--cache-dir", str(cache_dir), "--shard", shard, "-q"]
+        assert _cli.main(["render", str(srcdir), *args]) == 0
+    # Every tape is rendered by exactly one shard.
+    assert len(renders.read_text().splitlines()) == 3
+    shard1 = {p.parent.name for p in (tmp_path / "shard1").glob("*/manifest.json")}
+    shard2 = {p.parent.name for p in (tmp_path / "shard2").glob("*/manifest.json")}
+    assert shard1
+    assert shard2
+    assert not shard1 & shard2
+
+    cache_dir = tmp_path / "cache"
+    sources = [str(tmp_path / "shard1"), str(tmp_path / "shard2")]
+    assert _cli.main(["merge", str(cache_dir), *sources]) == 0
+    assert "merged 3 entries" in capsys.readouterr().out
+    assert (cache_dir / "index.json").exists()
+
+    args = ["--cache-dir", str(cache_dir), "--json"]
+    assert _cli.main(["plan", str(srcdir), *args]) == 0
+    plan = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [entry["status"] for entry in plan] == ["hit"] * 4
+
+    # Merging again changes nothing.
+    assert _cli.main(["merge", str(cache_dir), *sources, "-q"]) == 0
+    assert _shard.merge_caches(cache_dir, [tmp_path / "shard1"]) == 0
+
+
+@pytest.mark.sphinx(
+    "html",
+    testroot="basics",
+    srcdir="require-cache",
+    confoverrides={"vhs_require_cache": True},
+)
+def test_require_cache(app: util.SphinxTestApp, renders: pathlib.Path):
+    with pytest.raises(sphinx.errors.ExtensionError, match="4 tapes are not rendered"):
+        app.build()
+    assert not renders.exists()
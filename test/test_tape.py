@@ -0,0 +1,117 @@
+import os
+import pathlib
+
+import pytest
+from sphinx.testing import util
+
+from sphinx_vhs import _tape
+
+
+def test_parse():
+    tape = _tape.parse(
+        [
+            "# comment",
+            "",
+            "  Source 'setup.tape'  ",
+            'Type "# not a comment"  # comment',
+            "Enter",
+        ]
+    )
+    assert tape.nodes == (
+        _tape.Source("setup.tape", "  Source 'setup.tape'  ", 2),
+        _tape.Command('Type "# not a comment"', 3),
+        _tape.Command("Enter", 4),
+    )
+    assert tape.sources == [tape.nodes[0]]
+
+
+def test_parse_file_cache(tmp_path: pathlib.Path):
+    path = tmp_path / "a.tape"
+    path.write_text("Enter\n")
+    first = _tape.parse_file(path)
+    assert _tape.parse_file(path) is first
+
+    path.write_text("Enter\nEnter\n")
+    os.utime(path, ns=(0, 0))
+    second = _tape.parse_file(path)
+    assert second is not first
+    assert len(second.nodes) == 2
+
+
+def test_canonicalize():
+    a = [
+        "Set  Width 800",
+        "Set TypingSpeed 0.05",
+        "Output demo.gif",
+        "Type 'echo hi'",
+        "Sleep 1s",
+        "Enter 1",
+        "Type@0.1s `x`",
+    ]
+    b = [
+        "Output demo.gif",
+        "Set TypingSpeed 50ms",
+        "Set Width 600",
+        "Set Width 800",
+        'Type "echo hi"',
+        "Sleep 1000ms",
+        "Enter",
+        'Type@100ms "x"',
+    ]
+    assert _tape.canonicalize(a) == _tape.canonicalize(b)
+    assert _tape.canonicalize(a) == [
+        "Output demo.gif",
+        "Set TypingSpeed 50ms",
+        "Set Width 800",
+        'Type "echo hi"',
+        "Sleep 1000ms",
+        "Enter",
+        'Type@100ms "x"',
+    ]
+    assert _tape.diff(a, b) == []
+
+    # Only settings at the top can be reordered.
+    assert _tape.canonicalize(["Enter", "Set Width 1", "Set Height 1"]) == [
+        "Enter",
+        "Set Width 1",
+        "Set Height 1",
+    ]
+    # Strings keep their contents and whitespace.
+    assert _tape.canonicalize(["Type  'say \"hi\"  '"]) == ["Type 'say \"hi\"  '"]
+    assert _tape.canonicalize(["Sleep .25", "Sleep 1.5m"]) == [
+        "Sleep 250ms",
+        "Sleep 90000ms",
+    ]
+    # Lines that can't be parsed are left as is.
+    assert _tape.canonicalize(['Type "oops']) == ['Type "oops']
+
+    # Names of environment variables are case-sensitive.
+    assert _tape.canonicalize(["Env FOO a", "Env foo b"]) == ["Env FOO a", "Env foo b"]
+    # Regular expressions keep their whitespace.
+    assert _tape.canonicalize(["Wait+Screen@5s  /foo  bar/"]) == [
+        "Wait+Screen@5000ms /foo  bar/"
+    ]
+    assert _tape.get_hash(["Wait /a  b/"]) != _tape.get_hash(["Wait /a b/"])
+    assert _tape.get_hash(a) == _tape.get_hash(b)
+
+
+def test_diff():
+    assert _tape.diff(["Sleep 1", "Enter"], ["Sleep 2s", "Enter"]) == [
+        "--- old",
+        "+++ new",
+        "@@ -1,2 +1,2 @@",
+        "-Sleep 1000ms",
+        "+Sleep 2000ms",
+        " Enter",
+    ]
+
+
+@pytest.mark.sphinx("html", testroot="basics", srcdir="tape-as-written")
+def test_tape_as_written(app: util.SphinxTestApp, renders: pathlib.Path):
+    app.build()
+    cache_dir = pathlib.Path(app.doctreedir, "vhs_tapes_cache")
+    tapes = [path.read_text() for path in cache_dir.glob("*/vhs.tape")]
+    assert tapes
+    # Tapes are rendered as written, not in their canonical form.
+    assert any("Sleep 5s" in tape for tape in tapes)
+    assert not any("Sleep 5000ms" in tape for tape in tapes)